@@ -0,0 +1,174 @@
+import collections
+import logging
+import re
+import threading
+import time
+
+import psycopg2.extensions
+
+from instrumentation import INSTRUMENTATION
+from instrumentation import StatementEvent
+
+# Matches psycopg2 placeholders: escaped '%%', '%(name)s' and '%s'.
+PLACEHOLDER_RE = re.compile(r'%%|%\((\w+)\)s|%s')
+# SQLSTATE raised when EXECUTE names an unknown prepared statement.
+INVALID_SQL_STATEMENT_NAME = '26000'
+
+
+class PreparedStatementStats(object):
+    """Thread-safe hit/miss/eviction counters, shareable between caches."""
+
+    def __init__(self):
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def record(self, hits=0, misses=0, evictions=0):
+        with self._lock:
+            self.hits += hits
+            self.misses += misses
+            self.evictions += evictions
+
+    def as_dict(self):
+        with self._lock:
+            return {
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+class PreparedStatementCache(object):
+    """LRU of server-side prepared statements for a single connection.
+    Maps parameterized statement text to its PREPAREd name; evicted
+    statements are DEALLOCATEd.
+    """
+
+    def __init__(self, max_size=100, stats=None):
+        self.max_size = max_size
+        self.stats = stats if stats is not None else PreparedStatementStats()
+        self._names = collections.OrderedDict()
+        self._counter = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._names)
+
+    def get_name(self, cursor, statement):
+        """Returns the prepared statement name for statement, running
+        PREPARE on the cursor's connection if it is not cached yet.
+        :param cursor: cursor to run PREPARE/DEALLOCATE on.
+        :param statement: sql text using $1..$n parameters.
+        """
+        with self._lock:
+            name = self._names.pop(statement, None)
+            if name is not None:
+                # Re-insert to mark as most recently used.
+                self._names[statement] = name
+                self.stats.record(hits=1)
+                return name
+
+            self._counter += 1
+            name = 'amg_stmt_{}'.format(self._counter)
+            logging.debug('Preparing statement %s:\n%s', name, statement)
+            cursor.execute_raw('PREPARE {} AS {}'.format(name, statement))
+            self._names[statement] = name
+            evicted = 0
+            while len(self._names) > self.max_size:
+                _, old_name = self._names.popitem(last=False)
+                cursor.execute_raw('DEALLOCATE {}'.format(old_name))
+                evicted += 1
+            self.stats.record(misses=1, evictions=evicted)
+            return name
+
+    def forget(self, statement):
+        """Drops statement from the cache without DEALLOCATE, e.g. after the
+        server lost it to a rolled back transaction.
+        """
+        with self._lock:
+            self._names.pop(statement, None)
+
+
+class AmgConnection(psycopg2.extensions.connection):
+    """psycopg2 connection carrying per-connection execution settings and
+    its prepared statement cache.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(AmgConnection, self).__init__(*args, **kwargs)
+        # When true, AmgCursor.execute skips client-side mogrify/dedent.
+        self.fast_execute = False
+        self.prepared = PreparedStatementCache()
+        # Session statement_timeout in seconds, None if unlimited.
+        self.statement_timeout = None
+        # Instrumentation used by this connection's cursors.
+        self.instrumentation = INSTRUMENTATION
+
+    def commit(self):
+        """Commits, passing a 'commit' StatementEvent to the instrumentation
+        hooks, as writes only become visible to other connections now.
+        """
+        instrumentation = self.instrumentation
+        if not instrumentation.hooks:
+            super(AmgConnection, self).commit()
+            return
+        event = StatementEvent('commit')
+        event.connection = self
+        instrumentation.before(event)
+        started_at = time.time()
+        try:
+            super(AmgConnection, self).commit()
+        except Exception as err:
+            event.error = err
+            raise
+        finally:
+            event.wall_time = time.time() - started_at
+            instrumentation.after(event)
+
+
+def parameterize(query, q_vars, mogrify):
+    """Rewrites a psycopg2-style query into PREPARE-able text.
+    Regular values become $1..$n parameters. AsIs values (identifiers from
+    `no_quotes`) and tuples (which expand to a value list) change the
+    statement's shape, so they are inlined into the text instead.
+    :param query: sql string using %(name)s or %s placeholders.
+    :param q_vars: dictionary or sequence of values for the placeholders.
+    :param mogrify: cursor.mogrify, used to quote inlined values.
+    :return: tuple of (statement text, list of parameter values).
+    """
+    values = []
+    positions = {}
+    sequence = None if isinstance(q_vars, dict) else iter(q_vars)
+
+    def replace(match):
+        token = match.group(0)
+        if token == '%%':
+            return '%'
+        if sequence is None:
+            name = match.group(1)
+            if name is None:
+                raise TypeError(
+                    'Query mixes positional and named placeholders.')
+            value = q_vars[name]
+        else:
+            name = None
+            value = next(sequence)
+
+        if isinstance(value, (psycopg2.extensions.AsIs, tuple)):
+            quoted = mogrify('%s', (value,))
+            return quoted if isinstance(quoted, str) else quoted.decode(
+                'utf-8')
+        if name is not None and name in positions:
+            return '${}'.format(positions[name])
+        values.append(value)
+        if name is not None:
+            positions[name] = len(values)
+        return '${}'.format(len(values))
+
+    return PLACEHOLDER_RE.sub(replace, query), values
+
+
+def is_missing_statement_error(err):
+    """Returns true if err means a prepared statement no longer exists."""
+    return getattr(err, 'pgcode', None) == INVALID_SQL_STATEMENT_NAME
@@ -1,15 +1,362 @@
+import array
+import collections
+import contextlib
 import logging
 import textwrap
+import time
 import psycopg2
 import psycopg2.extras
 
+import amg_connection
+import bulk_load
+import sql_cache
+import timeouts
+from instrumentation import INSTRUMENTATION
+from instrumentation import StatementEvent
+from plan_capture import hide_secrets
+from plan_capture import redact_sql
+from utils import no_quotes
+from utils import redshift_cred_string
+
+# Row formats understood by AmgCursor.fetch_as.
+ROW_FORMATS = ('dict', 'tuple', 'record', 'columnar')
+# Upsert change detection strategies understood by AmgCursor.upsert.
+UPSERT_STRATEGIES = ('compare', 'hash')
+# Redshift expression turning the uniqueness keys into a partition number.
+# On PostgreSQL use e.g. "('x' || LEFT(MD5({keys}), 8))::BIT(32)::BIGINT".
+DEFAULT_PARTITION_HASH = 'STRTOL(LEFT(MD5({keys}), 8), 16)'
+# Type values are cast to before hashing. A bare VARCHAR is VARCHAR(256) on
+# Redshift, which would truncate longer values. Use 'TEXT' on PostgreSQL.
+DEFAULT_HASH_TEXT_TYPE = 'VARCHAR(MAX)'
+# Rows or statements sent per round trip by execute_values/execute_batch.
+DEFAULT_PAGE_SIZE = 1000
+
 class AmgCursor(psycopg2.extras.DictCursor):
     """Adds additional logic to the psycopg2 DictCursor."""
 
-    def execute(self, query, q_vars=None):
-        final_sql = textwrap.dedent(self.mogrify(query, q_vars))
+    def __init__(self, *args, **kwargs):
+        super(AmgCursor, self).__init__(*args, **kwargs)
+        # Callback run once when the cursor is closed. Set by DbConnection to
+        # return pooled connections.
+        self.on_close = None
+        # Hooks notified around every execute, copy and upsert.
+        self.instrumentation = getattr(
+            self.connection, 'instrumentation', INSTRUMENTATION)
+        # Seconds spent waiting for this cursor's connection, reported with
+        # the first instrumented statement.
+        self.conn_wait = 0.0
+
+    def close(self):
+        try:
+            super(AmgCursor, self).close()
+        finally:
+            on_close, self.on_close = self.on_close, None
+            if on_close is not None:
+                on_close()
+
+    def execute(self, query, q_vars=None, dedent=True):
+        if getattr(self.connection, 'fast_execute', False):
+            # Let psycopg2 interpolate in a single pass, skipping the extra
+            # mogrify/dedent copies of the statement.
+            self.execute_raw(query, q_vars)
+            return
+        if q_vars is None and not dedent:
+            final_sql = query
+        else:
+            final_sql = self.mogrify(query, q_vars)
+            if dedent:
+                final_sql = textwrap.dedent(final_sql)
         logging.debug('Executing sql query:\n%s', final_sql)
-        super(AmgCursor, self).execute(final_sql)
+        # Hooks get the statement before interpolation, so values can be
+        # redacted and statements differing only in values group together.
+        self._send(final_sql, event_query=query, event_params=q_vars)
+
+    def _send(self, query, q_vars=None, event_query=None, event_params=None):
+        if not self.instrumentation.hooks:
+            super(AmgCursor, self).execute(query, q_vars)
+            return
+        if event_query is None:
+            event_query, event_params = query, q_vars
+        with self.instrumented('execute', event_query, event_params) as event:
+            super(AmgCursor, self).execute(query, q_vars)
+            # COPY and UNLOAD statements hold credentials once interpolated.
+            event.sql = redact_sql(self.query) if self.query else None
+            event.bytes_sent = len(self.query or '')
+
+    @contextlib.contextmanager
+    def instrumented(self, kind, query=None, params=None, table=None):
+        """Context manager timing the statement run inside it and passing
+        the resulting StatementEvent to the instrumentation hooks.
+        Yields the event, so callers can fill in rowcount and bytes_sent,
+        or None when no hooks are registered.
+        :param kind: 'execute', 'prepared', 'copy', 'export' or 'upsert'.
+        :param query: sql text the event is fingerprinted by.
+        :param params: values interpolated into query.
+        :param table: table written to, if any.
+        """
+        instrumentation = self.instrumentation
+        if not instrumentation.hooks:
+            yield None
+            return
+        # Hooks never see credentials, e.g. the aws_creds of a COPY.
+        event = StatementEvent(
+            kind, query, hide_secrets(params), table, self.conn_wait)
+        event.connection = self.connection
+        self.conn_wait = 0.0
+        instrumentation.before(event)
+        started_at = time.time()
+        try:
+            yield event
+        except Exception as err:
+            event.error = err
+            raise
+        finally:
+            event.wall_time = time.time() - started_at
+            if (event.rowcount is None and event.error is None and
+                    not self.closed):
+                event.rowcount = self.rowcount
+            instrumentation.after(event)
+
+    @contextlib.contextmanager
+    def timeout(self, seconds, grace=timeouts.DEFAULT_GRACE):
+        """Context manager limiting the statements run inside it to
+        seconds each. The server enforces it with statement_timeout, and a
+        watchdog thread cancels the statement seconds + grace after the
+        block starts in case the server doesn't. Overruns raise
+        psycopg2.extensions.QueryCanceledError.
+        :param seconds: timeout, None to keep the connection's, or 0 for
+            no limit.
+        :param grace: extra seconds before the client-side cancel.
+        """
+        if seconds is None:
+            yield
+            return
+        default = getattr(self.connection, 'statement_timeout', None) or 0
+        if seconds != default:
+            self._set_statement_timeout(seconds)
+        # 0 means no limit, so there is nothing to watch.
+        token = None
+        if seconds:
+            token = timeouts.WATCHDOG.watch(self.connection, seconds + grace)
+        try:
+            yield
+        finally:
+            if token is not None:
+                timeouts.WATCHDOG.unwatch(token)
+            # In a failed transaction the SET is undone by the rollback.
+            if seconds != default and (
+                    self.connection.get_transaction_status() !=
+                    psycopg2.extensions.TRANSACTION_STATUS_INERROR):
+                self._set_statement_timeout(default)
+
+    def _set_statement_timeout(self, seconds):
+        self.execute_raw(
+            'SET statement_timeout = %s',
+            (int(seconds * 1000) if seconds else 0,))
+
+    @contextlib.contextmanager
+    def plain_rows(self):
+        """Context manager making fetches return plain tuples instead of
+        DictRows, which avoids building a column mapping per row.
+        """
+        row_factory, self.row_factory = self.row_factory, None
+        try:
+            yield
+        finally:
+            self.row_factory = row_factory
+
+    def fetch_as(
+            self,
+            row_format='dict',
+            batch_size=10000,
+            typecodes=None,
+            use_numpy=False):
+        """Fetches all remaining rows in the given format.
+        :param row_format: one of ROW_FORMATS. 'dict' returns DictRows,
+            'tuple' plain tuples, 'record' namedtuples and 'columnar' an
+            ordered dictionary of one sequence per column.
+        :param batch_size: rows fetched at a time for 'record'/'columnar'.
+        :param typecodes: 'columnar' only, see fetch_columns.
+        :param use_numpy: 'columnar' only, see fetch_columns.
+        """
+        if row_format == 'dict':
+            return self.fetchall()
+        elif row_format == 'tuple':
+            with self.plain_rows():
+                return self.fetchall()
+        elif row_format == 'record':
+            return self.fetch_records(batch_size)
+        elif row_format == 'columnar':
+            return self.fetch_columns(batch_size, typecodes, use_numpy)
+        raise ValueError('Unknown row format {!r}, expected one of {}'.format(
+            row_format, ', '.join(ROW_FORMATS)))
+
+    def record_type(self):
+        """Returns a namedtuple class matching the current result columns."""
+        return collections.namedtuple(
+            'Record', [col[0] for col in self.description], rename=True)
+
+    def fetch_records(self, batch_size=10000):
+        """Fetches all remaining rows as namedtuples. These have no
+        per-instance dictionary, unlike DictRows.
+        :param batch_size: rows fetched from the result at a time.
+        """
+        record = self.record_type()
+        records = []
+        with self.plain_rows():
+            while True:
+                rows = self.fetchmany(batch_size)
+                if not rows:
+                    break
+                records.extend(record._make(row) for row in rows)
+        return records
+
+    def fetch_columns(self, batch_size=10000, typecodes=None, use_numpy=False):
+        """Fetches all remaining rows as one sequence per column.
+        :param batch_size: rows fetched from the result at a time.
+        :param typecodes: optional dictionary mapping column names to
+            `array` typecodes ('l', 'd', ...). Those columns are stored in
+            compact `array.array`s instead of lists, and must not hold NULLs.
+        :param use_numpy: if True, return every column as a NumPy array.
+            Requires numpy to be installed.
+        :return: ordered dictionary mapping column names to their values.
+        """
+        if use_numpy:
+            import numpy
+        typecodes = typecodes or {}
+        names = [col[0] for col in self.description]
+        columns = [
+            array.array(typecodes[name]) if name in typecodes else []
+            for name in names
+        ]
+        chunks = [[] for _ in names]
+        with self.plain_rows():
+            while True:
+                rows = self.fetchmany(batch_size)
+                if not rows:
+                    break
+                for idx, values in enumerate(zip(*rows)):
+                    if use_numpy:
+                        chunks[idx].append(numpy.array(
+                            values, dtype=typecodes.get(names[idx])))
+                    else:
+                        columns[idx].extend(values)
+        if use_numpy:
+            columns = [
+                numpy.concatenate(chunk) if chunk else numpy.array([])
+                for chunk in chunks
+            ]
+        return collections.OrderedDict(zip(names, columns))
+
+    def execute_raw(self, query, q_vars=None):
+        """Execute query as-is, without dedenting it first."""
+        if logging.getLogger().isEnabledFor(logging.DEBUG):
+            logging.debug('Executing sql query:\n%s', query)
+        self._send(query, q_vars)
+
+    def execute_values(
+            self,
+            query,
+            argslist,
+            template=None,
+            page_size=DEFAULT_PAGE_SIZE):
+        """Execute a statement with a multi-row VALUES list, page_size rows
+        per round trip.
+        :param query: sql string with a single %s placeholder where the
+            VALUES list goes, e.g. 'INSERT INTO t (a, b) VALUES %s'. Use %%
+            for a literal %.
+        :param argslist: iterable of row sequences, or of dictionaries when
+            template uses named placeholders.
+        :param template: placeholder of one row, e.g. '(%s, %s, GETDATE())'.
+            Defaults to one %s per value of the first row.
+        :param page_size: rows sent per statement.
+        :return: total number of rows affected across all pages.
+        """
+        pre, post = self._split_values_query(query)
+        logging.debug(
+            'Executing sql query in pages of %s rows:\n%s', page_size, query)
+        total = 0
+        for page in _pages(argslist, page_size):
+            if template is None:
+                template = '({})'.format(', '.join(['%s'] * len(page[0])))
+            values = b','.join(self.mogrify(template, args) for args in page)
+            self._send(pre + values + post, event_query=query)
+            total += max(self.rowcount, 0)
+        return total
+
+    def execute_batch(self, query, argslist, page_size=DEFAULT_PAGE_SIZE):
+        """Execute a statement once per parameter set, sending page_size
+        statements per round trip.
+        :param query: sql string to execute.
+        :param argslist: iterable of parameter sets for query.
+        :param page_size: statements sent per round trip.
+        :return: number of statements executed. The server only reports
+            the rowcount of a page's last statement, so use execute_values
+            when the affected row total is needed.
+        """
+        query = textwrap.dedent(query)
+        logging.debug(
+            'Executing sql query in pages of %s statements:\n%s',
+            page_size, query)
+        count = 0
+        for page in _pages(argslist, page_size):
+            self._send(
+                b';'.join(self.mogrify(query, args) for args in page),
+                event_query=query)
+            count += len(page)
+        return count
+
+    def _split_values_query(self, query):
+        """Returns the sql before and after the %s of an execute_values
+        query, as bytes.
+        """
+        parts = textwrap.dedent(query).split('%s')
+        if len(parts) != 2:
+            raise ValueError(
+                'execute_values query needs exactly one %s placeholder')
+        if not isinstance(query, bytes):
+            encoding = psycopg2.extensions.encodings[self.connection.encoding]
+            parts = [part.encode(encoding) for part in parts]
+        pre, post = [part.replace(b'%%', b'%') for part in parts]
+        return pre, post
+
+    def execute_prepared(self, query, q_vars=None):
+        """Execute query through a server-side prepared statement.
+        The statement is PREPAREd once per connection and kept in the
+        connection's LRU, so repeated calls only send EXECUTE with the new
+        values. Falls back to `execute` on non-AmgConnection connections or
+        when there are no values to bind.
+        :param query: sql string using %(name)s or %s placeholders.
+        :param q_vars: dictionary or sequence of values for the placeholders.
+        """
+        cache = getattr(self.connection, 'prepared', None)
+        if cache is None or not q_vars:
+            self.execute(query, q_vars)
+            return
+        with self.instrumented('prepared', query, q_vars):
+            self._execute_prepared(cache, query, q_vars)
+
+    def _execute_prepared(self, cache, query, q_vars):
+        statement, values = amg_connection.parameterize(
+            query, q_vars, self.mogrify)
+        for attempt in (1, 2):
+            name = cache.get_name(self, statement)
+            if values:
+                execute_sql = 'EXECUTE {} ({})'.format(
+                    name, ', '.join(['%s'] * len(values)))
+            else:
+                execute_sql = 'EXECUTE {}'.format(name)
+            try:
+                self.execute_raw(execute_sql, values or None)
+                return
+            except psycopg2.Error as err:
+                if not amg_connection.is_missing_statement_error(err):
+                    raise
+                # The server lost the statement (e.g. its PREPARE was rolled
+                # back). Only autocommit connections can retry right away.
+                cache.forget(statement)
+                if attempt == 2 or not self.connection.autocommit:
+                    raise
 
     def execute_file(self, file_path, params=None):
         """Execute sql statement inside a file.
@@ -17,8 +364,26 @@ class AmgCursor(psycopg2.extras.DictCursor):
         :param params: dictionary of values to use in the corresponding sql.
         """
         logging.info('Executing sql file: %s', file_path)
-        with open(file_path, 'r') as exec_f:
-            self.execute(exec_f.read(), params)
+        compiled = sql_cache.get_compiled(file_path)
+        compiled.check_params(params)
+        self.execute(compiled.text, params, dedent=False)
+
+    def execute_files(self, file_paths, params=None):
+        """Execute several sql files, in order, as one batch.
+        The files are joined into a single query string so they cost one
+        network round trip.
+        :param file_paths: ordered list of sql file paths to execute.
+        :param params: dictionary of values to use in the corresponding sql.
+        """
+        logging.info('Executing sql files: %s', ', '.join(file_paths))
+        sql_texts = []
+        for file_path in file_paths:
+            compiled = sql_cache.get_compiled(file_path)
+            compiled.check_params(params)
+            sql_texts.append(compiled.text)
+        # A file may end in a comment or omit its final semicolon, so each
+        # one is terminated on its own line.
+        self.execute('\n;\n'.join(sql_texts), params, dedent=False)
 
     def execute_copy(
             self,
@@ -34,8 +399,27 @@ class AmgCursor(psycopg2.extras.DictCursor):
         :param columns: list of columns to use for the COPY statement.
         :param copy_options: additional Redshift COPY options.
         """
+        logging.info(
+            'Copying from: s3://%s/%s to %s',
+            s3_conn.bucket_name, s3_prefix, tablename)
+        query, params = self.build_copy(
+            tablename, s3_conn, s3_prefix, columns, copy_options)
+        # Credentials are only in params, and the statement text is the same
+        # for every table, so the event is keyed by table instead.
+        with self.instrumented('copy', table=tablename):
+            self.execute(query, params)
+
+    @staticmethod
+    def build_copy(
+            tablename,
+            s3_conn,
+            s3_prefix,
+            columns=None,
+            copy_options=()):
+        """Returns the (query, params) of a Redshift COPY statement.
+        Takes the same arguments as execute_copy.
+        """
         s3_path = 's3://{}/{}'.format(s3_conn.bucket_name, s3_prefix)
-        logging.info('Copying from: %s to %s', s3_path, tablename)
         col_string = '({})'.format(
             ', '.join(columns)) if columns is not None else ''
         copy_string = (
@@ -51,14 +435,108 @@ class AmgCursor(psycopg2.extras.DictCursor):
             s3_conn.get_aws_access_key_id(),
             s3_conn.get_aws_secret_access_key())
 
-        self.execute(
-            copy_string,
-            {
-                'tablename': no_quotes(tablename),
-                'columns': no_quotes(col_string),
-                's3_path': s3_path,
-                'aws_creds': rs_cred_string,
-            })
+        return copy_string, {
+            'tablename': no_quotes(tablename),
+            'columns': no_quotes(col_string),
+            's3_path': s3_path,
+            'aws_creds': rs_cred_string,
+        }
+
+    def copy_from_rows(
+            self,
+            tablename,
+            rows,
+            columns=None,
+            chunk_size=bulk_load.DEFAULT_CHUNK_SIZE):
+        """Stream rows into a table with COPY ... FROM STDIN.
+        Rows are encoded chunk_size bytes at a time, so any iterable
+        (including a generator) can be loaded in bounded memory.
+        :param tablename: full tablename to copy to.
+        :param rows: iterable of row tuples/lists. None is loaded as NULL.
+        :param columns: list of columns to use for the COPY statement.
+        :param chunk_size: number of bytes sent per chunk.
+        :return: a bulk_load.LoadStats.
+        """
+        stream = bulk_load.RowStream(rows, chunk_size)
+        sql = bulk_load.copy_from_sql(tablename, columns)
+        with self.instrumented('copy', sql, table=tablename) as event:
+            with bulk_load.Timer() as timer:
+                self.copy_expert(sql, stream, size=chunk_size)
+            if event is not None:
+                event.rowcount, event.bytes_sent = stream.rows, stream.bytes
+        stats = bulk_load.LoadStats(stream.rows, stream.bytes, timer.elapsed)
+        logging.info('Loaded into %s: %s', tablename, stats)
+        return stats
+
+    def copy_from_file(
+            self,
+            tablename,
+            fileobj,
+            columns=None,
+            copy_options=(),
+            gzipped=False,
+            chunk_size=bulk_load.DEFAULT_CHUNK_SIZE):
+        """Stream a file object or mmap into a table with COPY ... FROM STDIN.
+        :param tablename: full tablename to copy to.
+        :param fileobj: binary file object, or mmap, holding the data.
+        :param columns: list of columns to use for the COPY statement.
+        :param copy_options: additional COPY options, e.g. ('CSV', 'HEADER').
+        :param gzipped: if True, fileobj holds gzip data that is decompressed
+            on the fly.
+        :param chunk_size: number of bytes sent per chunk.
+        :return: a bulk_load.LoadStats. Its row count is the rowcount
+            reported by the server.
+        """
+        reader = bulk_load.open_source(fileobj, gzipped)
+        sql = bulk_load.copy_from_sql(tablename, columns, copy_options)
+        with self.instrumented('copy', sql, table=tablename) as event:
+            with bulk_load.Timer() as timer:
+                self.copy_expert(sql, reader, size=chunk_size)
+            if event is not None:
+                event.bytes_sent = reader.bytes
+        rows = self.rowcount if self.rowcount >= 0 else None
+        stats = bulk_load.LoadStats(rows, reader.bytes, timer.elapsed)
+        logging.info('Loaded into %s: %s', tablename, stats)
+        return stats
+
+    def copy_to(
+            self,
+            query,
+            params=None,
+            dest=None,
+            copy_options=('CSV',),
+            **writer_kwargs):
+        """Stream the results of a query out with COPY (query) TO STDOUT.
+        Rows go straight from the server into dest, chunk by chunk, without
+        building a result set in Python.
+        :param query: select query to export.
+        :param params: dictionary of values to use in the query.
+        :param dest: writable binary file object, or a path template. See
+            export.ExportWriter. Required; ValueError is raised without it.
+        :param copy_options: COPY options, e.g. ('CSV', 'HEADER').
+        :param writer_kwargs: chunk_size, max_bytes, compression and
+            path_fields for export.ExportWriter.
+        :return: an export.ExportStats.
+        """
+        select_query = self.mogrify(query, params)
+        if not isinstance(select_query, str):
+            select_query = select_query.decode('utf-8')
+        # Imported here so programs not exporting skip loading it.
+        import export
+        writer = export.ExportWriter(dest, **writer_kwargs)
+        sql = export.copy_to_sql(select_query, copy_options)
+        with self.instrumented('export', sql) as event:
+            with bulk_load.Timer() as timer:
+                try:
+                    self.copy_expert(sql, writer)
+                finally:
+                    writer.close()
+            if event is not None:
+                event.rowcount, event.bytes_sent = (
+                    writer.stats.rows, len(sql))
+        writer.stats.elapsed = timer.elapsed
+        logging.info('Exported query: %s', writer.stats)
+        return writer.stats
 
     def upsert(
             self,
@@ -67,7 +545,12 @@ class AmgCursor(psycopg2.extras.DictCursor):
             uniqueness_keys,
             col_list,
             col_functions=None,
-            has_timestamps=True):
+            has_timestamps=True,
+            strategy='compare',
+            hash_column='row_hash',
+            partition=None,
+            partition_hash=DEFAULT_PARTITION_HASH,
+            text_type=DEFAULT_HASH_TEXT_TYPE):
         """Performs an 'upsert' - an UPDATE followed by an INSERT.
         :param source_table: table holding new staging data.
         :param target_table: table being inserted/updated into.
@@ -80,6 +563,83 @@ class AmgCursor(psycopg2.extras.DictCursor):
             i.e. {'name': ['TRIM','UPPER']} generates sql: UPPER(TRIM(name))
         :param has_timestamps: if true, will assume table has created_at and
             updated_at columns.
+        :param strategy: how changed rows are detected. 'compare' checks
+            every column of col_list. 'hash' only compares hash_column,
+            which both tables must hold (see fill_row_hash).
+        :param hash_column: precomputed row hash column for 'hash'.
+        :param partition: optional (index, count) tuple restricting the
+            upsert to source rows whose uniqueness keys hash to index.
+        :param partition_hash: sql expression with a {keys} placeholder
+            turning the concatenated keys into a non-negative integer.
+        :param text_type: sql type the keys are cast to before they are
+            concatenated for partition_hash. Use 'TEXT' on PostgreSQL.
+        :return: tuple of (updated rows, inserted rows).
+        """
+        update_query, insert_query = self.build_upsert(
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions,
+            has_timestamps,
+            strategy,
+            hash_column,
+            partition,
+            partition_hash,
+            text_type)
+
+        logging.debug(
+            'Running upsert from %s to %s', source_table, target_table)
+        with self.instrumented('upsert', table=target_table) as event:
+            self.execute(*update_query)
+            logging.debug('[Upsert] Updated %s records', self.rowcount)
+
+            updated = self.rowcount
+
+            self.execute(*insert_query)
+            logging.debug('[Upsert] Inserted %s new records', self.rowcount)
+            inserted = self.rowcount
+            if event is not None:
+                event.rowcount = updated + inserted
+        return updated, inserted
+
+    def fill_row_hash(
+            self,
+            table,
+            col_list,
+            hash_column='row_hash',
+            text_type=DEFAULT_HASH_TEXT_TYPE):
+        """Stores the hash of col_list in hash_column for every row of
+        table, e.g. a staging table before a 'hash' upsert.
+        :param table: table to update.
+        :param col_list: list of columns making up the row hash.
+        :param hash_column: column receiving the hash.
+        :param text_type: sql type values are cast to before hashing. It
+            must hold the longest value in full.
+        """
+        self.execute(
+            'UPDATE %(table)s SET %(hash_column)s = %(hash)s',
+            {
+                'table': no_quotes(table),
+                'hash_column': no_quotes(hash_column),
+                'hash': no_quotes(row_hash_expression(col_list, text_type)),
+            })
+
+    @staticmethod
+    def build_upsert(
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions=None,
+            has_timestamps=True,
+            strategy='compare',
+            hash_column='row_hash',
+            partition=None,
+            partition_hash=DEFAULT_PARTITION_HASH,
+            text_type=DEFAULT_HASH_TEXT_TYPE):
+        """Returns the UPDATE and INSERT (query, params) pairs of an upsert.
+        Takes the same arguments as upsert.
         """
         # TODO: ability to insert static values. ex: INSERT ... (column1,
         # column2, 'STATIC_VALUE', 42, column3)
@@ -123,17 +683,44 @@ class AmgCursor(psycopg2.extras.DictCursor):
                 target_unique_cols_fn[idx], source_unique_cols_fn[idx])
             for idx, _ in enumerate(uniqueness_keys)
         ]
-        identical_row_predicates = [
-            '%s = %s' % (target_cols_fn[idx], source_cols_fn[idx])
-            for idx, _ in enumerate(col_list)
-        ]
         update_clauses = [
             '%s = %s' % (col_list[idx], source_cols_fn[idx])
             for idx in range(len(col_list))
         ]
+        if strategy == 'compare':
+            identical_row_predicates = [
+                '%s = %s' % (target_cols_fn[idx], source_cols_fn[idx])
+                for idx, _ in enumerate(col_list)
+            ]
+        elif strategy == 'hash':
+            # A NULL target hash must count as changed.
+            target_hash = '{}.{}'.format(target_table, hash_column)
+            identical_row_predicates = [
+                '{} IS NOT NULL'.format(target_hash),
+                '{} = s.{}'.format(target_hash, hash_column),
+            ]
+            update_clauses.append('{0} = s.{0}'.format(hash_column))
+            col_list = list(col_list) + [hash_column]
+            source_cols_fn = source_cols_fn + ['s.{}'.format(hash_column)]
+        else:
+            raise ValueError(
+                'Unknown upsert strategy {!r}, expected one of {}'.format(
+                    strategy, ', '.join(UPSERT_STRATEGIES)))
+
+        partition_filter = ''
+        if partition is not None:
+            index, count = partition
+            partition_filter = 'AND MOD({}, {}) = {}'.format(
+                partition_hash.format(
+                    keys=_concat_expression(
+                        source_unique_cols_fn, text_type)),
+                int(count),
+                int(index))
+
         if has_timestamps:
             update_clauses.append('updated_at = GETDATE()')
-            col_list += ['created_at', 'updated_at']
+            # Copy so the caller's list is left untouched.
+            col_list = list(col_list) + ['created_at', 'updated_at']
             source_cols_fn += ['GETDATE()', 'GETDATE()']
         params = {
             'source_table': no_quotes(source_table),
@@ -147,33 +734,28 @@ class AmgCursor(psycopg2.extras.DictCursor):
             'update_clause': no_quotes(', '.join(update_clauses)),
             'a_join_key': no_quotes('{}.{}'.format(
                 target_table, uniqueness_keys[0])),
+            'partition_filter': no_quotes(partition_filter),
         }
 
-        logging.debug(
-            'Running upsert from %s to %s', source_table, target_table)
-        self.execute(
-            """
+        update_query = """
             -- Update target records that are already present.
             UPDATE %(target_table)s
             SET %(update_clause)s
             FROM %(source_table)s s
             WHERE (%(unique_predicates)s)
                 AND NOT (%(identical_row_predicate)s)
-            """,
-            params)
-        logging.debug('[Upsert] Updated %s records', self.rowcount)
-
-        self.execute(
+                %(partition_filter)s
             """
+        insert_query = """
             -- Insert new records, that are not already present.
             INSERT INTO %(target_table)s (%(target_cols)s)
             SELECT DISTINCT %(source_cols)s
             FROM %(source_table)s s
             LEFT JOIN %(target_table)s ON %(unique_predicates)s
             WHERE %(a_join_key)s IS NULL
-            """,
-            params)
-        logging.debug('[Upsert] Inserted %s new records', self.rowcount)
+                %(partition_filter)s
+            """
+        return (update_query, params), (insert_query, params)
 
     def update_media_imports(
             self,
@@ -194,3 +776,26 @@ class AmgCursor(psycopg2.extras.DictCursor):
                 'table_append': no_quotes(table_append),
             })
 
+
+def _pages(iterable, page_size):
+    """Yields lists of up to page_size items of iterable."""
+    page = []
+    for item in iterable:
+        page.append(item)
+        if len(page) >= page_size:
+            yield page
+            page = []
+    if page:
+        yield page
+
+
+def _concat_expression(columns, text_type=DEFAULT_HASH_TEXT_TYPE):
+    """Returns a NULL-safe sql expression concatenating columns as text."""
+    return " || '|' || ".join(
+        "COALESCE(CAST({} AS {}), '')".format(col, text_type)
+        for col in columns)
+
+
+def row_hash_expression(col_list, text_type=DEFAULT_HASH_TEXT_TYPE):
+    """Returns a sql expression hashing the values of col_list."""
+    return 'MD5({})'.format(_concat_expression(col_list, text_type))
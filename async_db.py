@@ -0,0 +1,417 @@
+"""Non-blocking counterpart of DbConnection built on psycopg2's async mode.
+
+Operations are generator-based coroutines: they yield waitables (pending
+queries, connection attempts, pool waits) and finish by raising `Return`.
+Many of them can run at once from a single thread, driven by
+`AsyncDbConnection.run` (a select() loop).
+
+Async connections are always in autocommit mode, so operations that need a
+multi-statement transaction should use the blocking DbConnection instead.
+"""
+import logging
+import select
+import sys
+import types
+
+import psycopg2
+import psycopg2.extensions
+
+import sql_cache
+from amg_connection import AmgConnection
+from amg_cursor import AmgCursor
+from db_connection import DbConnection
+from lru_cache import LruCache
+
+POLL_OK = psycopg2.extensions.POLL_OK
+POLL_READ = psycopg2.extensions.POLL_READ
+POLL_WRITE = psycopg2.extensions.POLL_WRITE
+# Returned by waitables that are not waiting on a socket.
+POLL_WAIT = 'wait'
+
+
+class Return(Exception):
+    """Raised by a coroutine to finish with a value."""
+
+    def __init__(self, value=None):
+        super(Return, self).__init__(value)
+        self.value = value
+
+
+class _ConnectOp(object):
+    """Waitable opening a new async connection."""
+
+    def __init__(self, connect_kwargs):
+        self.conn = psycopg2.connect(
+            async_=True,
+            connection_factory=AmgConnection,
+            cursor_factory=AmgCursor,
+            **connect_kwargs)
+        self.value = None
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def poll(self):
+        state = self.conn.poll()
+        if state == POLL_OK:
+            self.value = self.conn
+        return state
+
+
+class _CursorOp(object):
+    """Waitable running statement(s) started by `start(cursor)`."""
+
+    def __init__(self, conn, start, return_results=False):
+        self.conn = conn
+        self.return_results = return_results
+        self.cursor = conn.cursor()
+        self.value = None
+        try:
+            start(self.cursor)
+        except Exception:
+            self.cursor.close()
+            raise
+
+    def fileno(self):
+        return self.conn.fileno()
+
+    def poll(self):
+        try:
+            state = self.conn.poll()
+            if state == POLL_OK:
+                if self.return_results:
+                    self.value = self.cursor.fetchall()
+                else:
+                    self.value = self.cursor.rowcount
+        except Exception:
+            self.cursor.close()
+            raise
+        if state == POLL_OK:
+            self.cursor.close()
+        return state
+
+
+class _PoolWait(object):
+    """Waitable ready once the pool can lend or open a connection."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        self.value = None
+
+    def fileno(self):
+        return None
+
+    def poll(self):
+        return POLL_OK if self.pool.available() else POLL_WAIT
+
+
+class AsyncConnectionPool(object):
+    """Pool of async connections shared by concurrent coroutines.
+    Not thread-safe: use it from the thread driving the coroutines.
+    """
+
+    def __init__(self, connect_kwargs, max_size=10):
+        self.connect_kwargs = connect_kwargs
+        self.max_size = max_size
+        self.size = 0
+        self._idle = []
+
+    def available(self):
+        return bool(self._idle) or self.size < self.max_size
+
+    def acquire(self):
+        """Coroutine returning a connection. Must be released afterwards."""
+        while True:
+            if self._idle:
+                raise Return(self._idle.pop())
+            if self.size < self.max_size:
+                self.size += 1
+                try:
+                    conn = yield _ConnectOp(self.connect_kwargs)
+                except Exception:
+                    self.size -= 1
+                    raise
+                raise Return(conn)
+            yield _PoolWait(self)
+
+    def release(self, conn):
+        if conn.closed:
+            self.size -= 1
+        else:
+            self._idle.append(conn)
+
+    def close(self):
+        for conn in self._idle:
+            conn.close()
+        self.size -= len(self._idle)
+        self._idle = []
+
+
+class _Task(object):
+    """Steps a coroutine, running nested coroutines it yields inline."""
+
+    def __init__(self, coroutine):
+        self.stack = [coroutine]
+        self.result = None
+        self.error = None
+
+    def step(self, value=None, error=None):
+        """Resumes the coroutine with value (or throws error, an exc_info
+        tuple into it) until it yields a waitable.
+        :return: the waitable, or None once the coroutine has finished.
+        """
+        while self.stack:
+            coroutine = self.stack[-1]
+            try:
+                if error is not None:
+                    exc_info, error = error, None
+                    yielded = coroutine.throw(*exc_info)
+                else:
+                    yielded = coroutine.send(value)
+            except Return as ret:
+                self.stack.pop()
+                value = ret.value
+                continue
+            except StopIteration:
+                self.stack.pop()
+                value = None
+                continue
+            except Exception:
+                self.stack.pop()
+                error = sys.exc_info()
+                value = None
+                continue
+            if isinstance(yielded, types.GeneratorType):
+                self.stack.append(yielded)
+                value = None
+                continue
+            return yielded
+        self.result = value
+        self.error = error
+        return None
+
+
+class AsyncDbConnection(object):
+    """Non-blocking database wrapper mirroring DbConnection's API.
+    Every operation method returns a coroutine; pass it to `run`, or
+    yield it from another coroutine.
+    """
+
+    @classmethod
+    def from_yaml(cls, file_path, *yaml_scope, **kwargs):
+        """Returns a new AsyncDbConnection from a DbConnection yaml file.
+        :param kwargs: extra AsyncDbConnection arguments, e.g. pool_size.
+        """
+        db_conn = DbConnection.from_yaml(file_path, *yaml_scope)
+        return cls(
+            host=db_conn.host,
+            database=db_conn.database,
+            user=db_conn.user,
+            password=db_conn.password,
+            port=db_conn.port,
+            **kwargs)
+
+    def __init__(
+            self,
+            host,
+            database,
+            user,
+            password,
+            port,
+            pool_size=10,
+            import_id_cache_size=10000):
+        """
+        :param pool_size: maximum number of queries in flight at once.
+        :param import_id_cache_size: number of import ids kept in cache.
+        """
+        self.host = host
+        self.database = database
+        self.port = port
+        self.pool = AsyncConnectionPool(
+            {
+                'host': host,
+                'database': database,
+                'user': user,
+                'password': password,
+                'port': port,
+            },
+            pool_size)
+        self.import_id_cache = LruCache(import_id_cache_size)
+
+    def close(self):
+        """Closes every idle pooled connection."""
+        self.pool.close()
+
+    # Drivers.
+
+    def run(self, *coroutines):
+        """Runs coroutines concurrently until all of them finish.
+        :return: list of the coroutines' results, in order.
+        """
+        tasks = [_Task(coroutine) for coroutine in coroutines]
+        waiting = {}
+        for task in tasks:
+            waitable = task.step()
+            if waitable is not None:
+                waiting[task] = waitable
+
+        while waiting:
+            progressed = False
+            readers, writers = [], []
+            for task, waitable in list(waiting.items()):
+                try:
+                    state = waitable.poll()
+                except Exception:
+                    state, error = None, sys.exc_info()
+                else:
+                    error = None
+                if error is not None or state == POLL_OK:
+                    progressed = True
+                    value = None if error else waitable.value
+                    next_waitable = task.step(value, error)
+                    if next_waitable is None:
+                        del waiting[task]
+                    else:
+                        waiting[task] = next_waitable
+                elif state == POLL_READ:
+                    readers.append(waitable.fileno())
+                elif state == POLL_WRITE:
+                    writers.append(waitable.fileno())
+            if not progressed:
+                if not readers and not writers:
+                    raise RuntimeError(
+                        'Coroutines are deadlocked waiting on the pool.')
+                select.select(readers, writers, [])
+
+        for task in tasks:
+            if task.error is not None:
+                raise task.error[1]
+        return [task.result for task in tasks]
+
+    # Operations.
+
+    def run_cursor(self, start, return_results=False):
+        """Coroutine running `start(cursor)` on a pooled connection.
+        :param start: callable issuing one statement on the given cursor.
+        :return: the fetched rows if return_results, else the rowcount.
+        """
+        conn = yield self.pool.acquire()
+        try:
+            result = yield _CursorOp(conn, start, return_results)
+        finally:
+            self.pool.release(conn)
+        raise Return(result)
+
+    def execute(self, query, params=None, return_results=False):
+        """Coroutine executing a query.
+        :param query: sql string to execute.
+        :param params: dictionary of values to use in the corresponding sql.
+        :param return_results: if True, return the query results.
+        :return: the query results, or the rowcount.
+        """
+        result = yield self.run_cursor(
+            lambda cursor: cursor.execute(query, params), return_results)
+        raise Return(result)
+
+    def execute_file(self, file_path, params=None, return_results=False):
+        """Coroutine executing the contents of a sql file."""
+        logging.info('Executing sql file: %s', file_path)
+        compiled = sql_cache.get_compiled(file_path)
+        compiled.check_params(params)
+        result = yield self.run_cursor(
+            lambda cursor: cursor.execute(compiled.text, params, dedent=False),
+            return_results)
+        raise Return(result)
+
+    def execute_copy(
+            self,
+            tablename,
+            s3_conn,
+            s3_prefix,
+            columns=None,
+            copy_options=()):
+        """Coroutine running a Redshift COPY. See AmgCursor.execute_copy."""
+        yield self.run_cursor(lambda cursor: cursor.execute_copy(
+            tablename, s3_conn, s3_prefix, columns, copy_options))
+
+    def upsert(
+            self,
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions=None,
+            has_timestamps=True):
+        """Coroutine running an upsert. See AmgCursor.upsert.
+        :return: tuple of (updated rows, inserted rows).
+        """
+        update_query, insert_query = AmgCursor.build_upsert(
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions,
+            has_timestamps)
+        updated = yield self.execute(*update_query)
+        inserted = yield self.execute(*insert_query)
+        logging.debug(
+            '[Upsert] Updated %s and inserted %s records', updated, inserted)
+        raise Return((updated, inserted))
+
+    def get_media_import_id(
+            self,
+            media_schema,
+            data_source,
+            file_name,
+            table_append=''):
+        """Coroutine returning the import id of file_name, or None.
+        See DbConnection.get_media_import_id.
+        """
+        data_source = data_source.upper()
+        cache_key = (media_schema, table_append, data_source, file_name)
+        import_id = self.import_id_cache.get(cache_key)
+        if import_id is None:
+            query, params = DbConnection._import_id_query(
+                media_schema, data_source, file_name, table_append)
+            res = yield self.execute(query, params, return_results=True)
+            import_id = DbConnection._single_import_id(file_name, res)
+            if import_id is not None:
+                self.import_id_cache.put(cache_key, import_id)
+        raise Return(import_id)
+
+    def update_media_import(
+            self,
+            media_schema,
+            data_source,
+            file_name,
+            file_date,
+            status,
+            table_append='',
+            file_path=''):
+        """Coroutine updating or inserting an entry in media.imports.
+        See DbConnection.update_media_import.
+        :return: the import id that was created or found.
+        """
+        data_source = data_source.upper()
+        import_id = yield self.get_media_import_id(
+            media_schema, data_source, file_name, table_append)
+
+        if import_id is None and status.upper() in ('STARTED', 'SKIPPED'):
+            yield self.execute(*DbConnection._insert_import_query(
+                media_schema,
+                data_source,
+                file_name,
+                file_date,
+                status,
+                table_append,
+                file_path))
+            import_id = yield self.get_media_import_id(
+                media_schema, data_source, file_name, table_append)
+        elif import_id is None:
+            raise Exception(
+                'Cannot change status of {} to {}. No record '
+                'exists yet.'.format(file_name, status))
+        else:
+            yield self.execute(*DbConnection._update_import_query(
+                media_schema, import_id, status, table_append))
+        raise Return(import_id)
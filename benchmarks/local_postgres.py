@@ -0,0 +1,156 @@
+import logging
+import os
+import shutil
+import socket
+import subprocess
+import tempfile
+import time
+
+# Settings applied to every benchmark server so runs are comparable.
+# Durability is off since the data is thrown away.
+SERVER_SETTINGS = {
+    'fsync': 'off',
+    'synchronous_commit': 'off',
+    'full_page_writes': 'off',
+    'autovacuum': 'off',
+    'shared_buffers': '256MB',
+    'work_mem': '64MB',
+    'maintenance_work_mem': '256MB',
+    'max_connections': '50',
+}
+
+SCHEMA_SQL = """
+    -- Redshift's GETDATE(), used by upserts and import tracking.
+    CREATE FUNCTION getdate() RETURNS TIMESTAMP AS
+        'SELECT LOCALTIMESTAMP' LANGUAGE SQL STABLE;
+
+    CREATE SCHEMA media;
+    CREATE TABLE media.imports (
+        id SERIAL PRIMARY KEY,
+        file_name VARCHAR(256),
+        source VARCHAR(64),
+        file_date DATE,
+        status VARCHAR(32),
+        file_path VARCHAR(512),
+        time_imported TIMESTAMP
+    );
+    CREATE INDEX imports_source_file_name
+        ON media.imports (source, file_name);
+
+    -- Matches sql/sql1.sql and sql/sql2.sql.
+    CREATE TABLE employee (
+        lastname VARCHAR(64),
+        departmentid INTEGER
+    );
+"""
+
+
+def find_bin_dir():
+    """Returns the directory holding initdb and pg_ctl. Uses $PG_BIN, then
+    pg_config, then $PATH.
+    """
+    if os.environ.get('PG_BIN'):
+        return os.environ['PG_BIN']
+    try:
+        return subprocess.check_output(
+            ['pg_config', '--bindir']).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        pass
+    for path_dir in os.environ.get('PATH', '').split(os.pathsep):
+        if os.path.exists(os.path.join(path_dir, 'initdb')):
+            return path_dir
+    raise RuntimeError(
+        'Cannot find initdb. Install PostgreSQL or set PG_BIN.')
+
+
+def free_port():
+    sock = socket.socket()
+    try:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+    finally:
+        sock.close()
+
+
+class LocalPostgres(object):
+    """Throwaway PostgreSQL server in a temporary directory.
+
+    Usable as a context manager: the server is initialized and started on
+    enter, then stopped and deleted on exit.
+    """
+
+    def __init__(self, bin_dir=None, port=None, user='bench',
+                 database='bench'):
+        self.bin_dir = bin_dir or find_bin_dir()
+        self.port = port or free_port()
+        self.user = user
+        self.database = database
+        self.base_dir = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.stop()
+
+    @property
+    def data_dir(self):
+        return os.path.join(self.base_dir, 'data')
+
+    def connection_kwargs(self):
+        """Returns the DbConnection arguments for this server."""
+        return {
+            'host': '127.0.0.1',
+            'database': self.database,
+            'user': self.user,
+            'password': '',
+            'port': self.port,
+        }
+
+    def start(self):
+        self.base_dir = tempfile.mkdtemp(prefix='amg-bench-')
+        logging.info('Initializing PostgreSQL in %s', self.base_dir)
+        self._run(
+            'initdb', '-D', self.data_dir, '-U', self.user, '--auth=trust',
+            '--encoding=UTF8', '--no-locale')
+        options = ' '.join(
+            '-c {}={}'.format(name, value)
+            for name, value in sorted(SERVER_SETTINGS.items()))
+        self._run(
+            'pg_ctl', 'start', '-w', '-D', self.data_dir,
+            '-l', os.path.join(self.base_dir, 'server.log'),
+            '-o', '-p {} -k {} -h 127.0.0.1 {}'.format(
+                self.port, self.base_dir, options))
+        self._run(
+            'createdb', '-h', '127.0.0.1', '-p', str(self.port),
+            '-U', self.user, self.database)
+        self.psql(SCHEMA_SQL)
+
+    def stop(self):
+        if self.base_dir is None:
+            return
+        try:
+            self._run(
+                'pg_ctl', 'stop', '-w', '-m', 'fast', '-D', self.data_dir)
+        finally:
+            shutil.rmtree(self.base_dir, ignore_errors=True)
+            self.base_dir = None
+
+    def psql(self, sql):
+        """Runs sql with psql, stopping at the first error."""
+        self._run(
+            'psql', '-q', '-v', 'ON_ERROR_STOP=1', '-h', '127.0.0.1',
+            '-p', str(self.port), '-U', self.user, '-d', self.database,
+            '-c', sql)
+
+    def server_version(self):
+        return self._run('postgres', '--version').strip()
+
+    def _run(self, program, *args):
+        started_at = time.time()
+        output = subprocess.check_output(
+            (os.path.join(self.bin_dir, program),) + args,
+            stderr=subprocess.STDOUT)
+        logging.debug('%s took %.2fs', program, time.time() - started_at)
+        return output.decode('utf-8', 'replace')
@@ -0,0 +1,326 @@
+"""Benchmarks DbConnection and AmgCursor against a throwaway PostgreSQL.
+
+Usage:
+    python benchmarks/run_benchmarks.py --output results.json
+    python benchmarks/run_benchmarks.py --compare baseline.json results.json
+
+initdb, pg_ctl, createdb and psql are looked up through $PG_BIN, pg_config
+or $PATH. Data is generated deterministically and every benchmark runs
+warmup iterations first, so results of two versions can be compared.
+"""
+import argparse
+import datetime
+import json
+import logging
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.realpath(__file__))
+REPO_DIR = os.path.dirname(BENCH_DIR)
+sys.path.insert(0, REPO_DIR)
+
+import psycopg2  # noqa: E402
+
+from db_connection import DbConnection  # noqa: E402
+from local_postgres import LocalPostgres  # noqa: E402
+
+SQL_FILES = [
+    os.path.join(REPO_DIR, 'sql', 'sql1.sql'),
+    os.path.join(REPO_DIR, 'sql', 'sql2.sql'),
+]
+UPSERT_COLUMNS = ['id', 'name', 'value']
+
+
+def summarize(samples, rows=None):
+    """Returns timing statistics of a list of durations in seconds.
+    :param rows: rows processed per sample, to report rows per second.
+    """
+    ordered = sorted(samples)
+    count = len(ordered)
+    stats = {
+        'iterations': count,
+        'min': ordered[0],
+        'max': ordered[-1],
+        'mean': sum(ordered) / count,
+        'median': ordered[count // 2],
+        'p95': ordered[min(count - 1, int(count * 0.95))],
+    }
+    if rows:
+        stats['rows'] = rows
+        stats['rows_per_second'] = rows / stats['median']
+    return stats
+
+
+def measure(fn, iterations, warmup=3):
+    """Runs fn warmup times, then returns the durations of iterations
+    more runs.
+    """
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(iterations):
+        started_at = time.time()
+        fn()
+        samples.append(time.time() - started_at)
+    return samples
+
+
+def bench_connection_setup(server, iterations):
+    kwargs = server.connection_kwargs()
+
+    def connect_once():
+        db_conn = DbConnection(**kwargs)
+        db_conn.connect()
+        db_conn.close()
+
+    pooled = DbConnection(pool_max_size=2, **kwargs)
+    pooled.connect()
+
+    def pooled_cursor():
+        pooled.new_cursor().close()
+
+    try:
+        return {
+            'connect': summarize(measure(connect_once, iterations)),
+            'pooled_checkout': summarize(
+                measure(pooled_cursor, iterations * 10)),
+        }
+    finally:
+        pooled.close()
+
+
+def bench_execute_sql(server, iterations):
+    results = {}
+    query = 'SELECT lastname FROM employee WHERE departmentid = %(dept)s'
+    for label, options, prepare in (
+            ('default', {}, False),
+            ('fast_execute', {'fast_execute': True}, False),
+            ('prepared', {}, True)):
+        db_conn = DbConnection(**dict(server.connection_kwargs(), **options))
+        db_conn.connect()
+        try:
+            results[label] = summarize(measure(
+                lambda: db_conn.execute_sql(
+                    query, {'dept': 570}, return_results=True,
+                    prepare=prepare),
+                iterations))
+        finally:
+            db_conn.close()
+    return results
+
+
+def bench_execute_file(server, iterations):
+    db_conn = DbConnection(**server.connection_kwargs())
+    db_conn.connect()
+    try:
+        results = {}
+        for file_path in SQL_FILES:
+            samples = measure(
+                lambda: db_conn.execute_sql_file(file_path), iterations)
+            stats = summarize(samples)
+            stats['files_per_second'] = 1 / stats['median']
+            results[os.path.basename(file_path)] = stats
+        samples = measure(
+            lambda: db_conn.execute_sql_files(SQL_FILES), iterations)
+        stats = summarize(samples)
+        stats['files_per_second'] = len(SQL_FILES) / stats['median']
+        results['batched'] = stats
+        return results
+    finally:
+        db_conn.close()
+
+
+def prepare_upsert_tables(db_conn, num_rows):
+    """(Re)creates bench_target with num_rows rows and bench_source with
+    num_rows rows of which half are new, and a tenth of the rest changed.
+    """
+    db_conn.execute_sql("""
+        DROP TABLE IF EXISTS bench_target;
+        DROP TABLE IF EXISTS bench_source;
+        CREATE TABLE bench_target (
+            id INTEGER, name VARCHAR(64), value INTEGER,
+            created_at TIMESTAMP, updated_at TIMESTAMP);
+        CREATE TABLE bench_source (
+            id INTEGER, name VARCHAR(64), value INTEGER);
+        INSERT INTO bench_target
+            SELECT i, 'name-' || i, i, LOCALTIMESTAMP, LOCALTIMESTAMP
+            FROM generate_series(1, %(num_rows)s) AS i;
+        INSERT INTO bench_source
+            SELECT i, 'name-' || i,
+                CASE WHEN i %% 10 = 0 THEN -i ELSE i END
+            FROM generate_series(
+                %(num_rows)s / 2 + 1, %(num_rows)s / 2 + %(num_rows)s) AS i;
+        CREATE INDEX bench_target_id ON bench_target (id);
+        ANALYZE bench_target;
+        ANALYZE bench_source;
+        """, {'num_rows': num_rows})
+
+
+def bench_upsert(server, sizes, iterations):
+    db_conn = DbConnection(**server.connection_kwargs())
+    db_conn.connect()
+    try:
+        results = {}
+        for num_rows in sizes:
+            # Each run changes the target, so tables are rebuilt per run
+            # and only the upsert itself is timed.
+            samples = []
+            for _ in range(iterations):
+                prepare_upsert_tables(db_conn, num_rows)
+                started_at = time.time()
+                updated, inserted = db_conn.upsert(
+                    'bench_source', 'bench_target', ['id'], UPSERT_COLUMNS)
+                samples.append(time.time() - started_at)
+            stats = summarize(samples, rows=num_rows)
+            stats['updated'] = updated
+            stats['inserted'] = inserted
+            results[str(num_rows)] = stats
+            logging.info('Upsert of %s rows: %.2fs', num_rows, stats['median'])
+        db_conn.execute_sql(
+            'DROP TABLE bench_target; DROP TABLE bench_source;')
+        return results
+    finally:
+        db_conn.close()
+
+
+def bench_import_tracking(server, num_files, iterations):
+    db_conn = DbConnection(**server.connection_kwargs())
+    db_conn.connect()
+    sql_file = tempfile.NamedTemporaryFile(suffix='.sql', delete=False)
+    sql_file.write(b'SELECT 1;\n')
+    sql_file.close()
+    file_date = datetime.date(2020, 1, 1)
+    runs = [0]
+
+    def file_names():
+        return ['file-{}-{:06d}.csv'.format(runs[0], idx)
+                for idx in range(num_files)]
+
+    def update_each():
+        runs[0] += 1
+        for file_name in file_names():
+            db_conn.update_media_import(
+                'media', 'bench', file_name, file_date, 'STARTED')
+
+    def ingest():
+        # Marks the files last created by update_each as succeeded.
+        db_conn.run_ingest_queries(
+            'media', 'bench', sql_file.name, None,
+            [(file_name, file_date) for file_name in file_names()])
+
+    try:
+        return {
+            'update_media_import': summarize(
+                measure(update_each, iterations, warmup=1), rows=num_files),
+            'run_ingest_queries': summarize(
+                measure(ingest, iterations, warmup=1), rows=num_files),
+        }
+    finally:
+        db_conn.close()
+        os.remove(sql_file.name)
+
+
+def git_revision():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'], cwd=REPO_DIR).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(args):
+    with LocalPostgres(bin_dir=args.pg_bin) as server:
+        results = {
+            'metadata': {
+                'timestamp': datetime.datetime.utcnow().isoformat(),
+                'git_revision': git_revision(),
+                'python': platform.python_version(),
+                'psycopg2': psycopg2.__version__,
+                'server': server.server_version(),
+                'platform': platform.platform(),
+            },
+            'benchmarks': {},
+        }
+        benchmarks = results['benchmarks']
+        benchmarks['connection_setup'] = bench_connection_setup(
+            server, args.iterations)
+        benchmarks['execute_sql'] = bench_execute_sql(
+            server, args.iterations * 10)
+        benchmarks['execute_file'] = bench_execute_file(
+            server, args.iterations * 10)
+        benchmarks['upsert'] = bench_upsert(
+            server, args.upsert_sizes, args.slow_iterations)
+        benchmarks['import_tracking'] = bench_import_tracking(
+            server, args.num_files, args.slow_iterations)
+    return results
+
+
+def flatten(results, prefix=''):
+    """Returns {'benchmark.case': median} for every timed case."""
+    medians = {}
+    for key, value in results.items():
+        if isinstance(value, dict):
+            if 'median' in value:
+                medians[prefix + key] = value['median']
+            else:
+                medians.update(flatten(value, prefix + key + '.'))
+    return medians
+
+
+def compare(baseline_path, current_path, tolerance):
+    """Prints the median of every case of both runs. Returns the number of
+    cases slower than baseline by more than tolerance.
+    """
+    with open(baseline_path) as in_f:
+        baseline = flatten(json.load(in_f)['benchmarks'])
+    with open(current_path) as in_f:
+        current = flatten(json.load(in_f)['benchmarks'])
+    regressions = 0
+    for case in sorted(set(baseline) & set(current)):
+        ratio = current[case] / baseline[case] if baseline[case] else 1.0
+        flag = ''
+        if ratio > 1 + tolerance:
+            flag = '  REGRESSION'
+            regressions += 1
+        print '{:<50} {:>10.4f}s {:>10.4f}s {:>7.2f}x{}'.format(
+            case, baseline[case], current[case], ratio, flag)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n')[0])
+    parser.add_argument('--output', default='benchmark_results.json')
+    parser.add_argument('--pg-bin', help='directory holding initdb')
+    parser.add_argument('--iterations', type=int, default=20)
+    parser.add_argument(
+        '--upsert-sizes', type=lambda s: [int(n) for n in s.split(',')],
+        default=[10 ** 4, 10 ** 5, 10 ** 6],
+        help='comma separated row counts, e.g. 10000,10000000')
+    parser.add_argument('--slow-iterations', type=int, default=3,
+        help='iterations of the upsert and import tracking benchmarks')
+    parser.add_argument('--num-files', type=int, default=1000)
+    parser.add_argument(
+        '--compare', nargs=2, metavar=('BASELINE', 'CURRENT'),
+        help='compare two result files instead of running')
+    parser.add_argument(
+        '--tolerance', type=float, default=0.1,
+        help='slowdown ratio reported as a regression by --compare')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+
+    if args.compare:
+        sys.exit(1 if compare(
+            args.compare[0], args.compare[1], args.tolerance) else 0)
+
+    results = run(args)
+    with open(args.output, 'w') as out_f:
+        json.dump(results, out_f, indent=2, sort_keys=True)
+    print 'Wrote {}'.format(args.output)
+
+
+if __name__ == '__main__':
+    main()
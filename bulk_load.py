@@ -0,0 +1,162 @@
+import datetime
+import gzip
+import time
+
+# Default number of bytes handed to COPY per read.
+DEFAULT_CHUNK_SIZE = 1 << 20
+
+# Backslash escapes required by the COPY text format.
+_TEXT_ESCAPES = [
+    (b'\\', b'\\\\'),
+    (b'\t', b'\\t'),
+    (b'\n', b'\\n'),
+    (b'\r', b'\\r'),
+]
+
+
+class LoadStats(object):
+    """Rows, bytes and elapsed time of one bulk load."""
+
+    def __init__(self, rows, num_bytes, elapsed):
+        self.rows = rows
+        self.bytes = num_bytes
+        self.elapsed = elapsed
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def bytes_per_second(self):
+        return self.bytes / self.elapsed if self.elapsed else 0.0
+
+    def __str__(self):
+        rows = 'unknown' if self.rows is None else self.rows
+        return '{} rows, {} bytes in {:.2f}s ({:.0f} bytes/s{})'.format(
+            rows, self.bytes, self.elapsed, self.bytes_per_second,
+            '' if self.rows is None else ', {:.0f} rows/s'.format(
+                self.rows_per_second))
+
+
+class RowStream(object):
+    """Read-only file object encoding an iterable of rows in the COPY text
+    format. Rows are pulled lazily, so at most about one chunk is held in
+    memory regardless of how many rows the iterable yields.
+    """
+
+    def __init__(self, rows, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        :param rows: iterable of row tuples/lists. None is loaded as NULL.
+        :param chunk_size: default number of bytes returned per read.
+        """
+        self._rows = iter(rows)
+        self.chunk_size = chunk_size
+        self.rows = 0
+        self.bytes = 0
+        self._parts = []
+        self._buffered = 0
+        self._exhausted = False
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.chunk_size
+        while self._buffered < size and not self._exhausted:
+            try:
+                row = next(self._rows)
+            except StopIteration:
+                self._exhausted = True
+                break
+            line = encode_row(row)
+            self._parts.append(line)
+            self._buffered += len(line)
+            self.rows += 1
+
+        buf = b''.join(self._parts)
+        data, rest = buf[:size], buf[size:]
+        self._parts = [rest] if rest else []
+        self._buffered = len(rest)
+        self.bytes += len(data)
+        return data
+
+
+class CountingReader(object):
+    """Wraps a binary file object (or mmap) counting the bytes read."""
+
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.bytes = 0
+
+    def read(self, size=-1):
+        data = self.fileobj.read(size)
+        self.bytes += len(data)
+        return data
+
+    def readline(self, size=-1):
+        data = self.fileobj.readline(size)
+        self.bytes += len(data)
+        return data
+
+
+def open_source(fileobj, gzipped=False):
+    """Returns a CountingReader over fileobj, decompressing gzip data on
+    the fly if gzipped. COPY FROM STDIN only accepts uncompressed data.
+    """
+    if gzipped:
+        fileobj = gzip.GzipFile(fileobj=fileobj, mode='rb')
+    return CountingReader(fileobj)
+
+
+def copy_from_sql(tablename, columns=None, copy_options=()):
+    """Returns a COPY ... FROM STDIN statement.
+    :param tablename: full tablename to copy to.
+    :param columns: list of columns to use for the COPY statement.
+    :param copy_options: additional COPY options, e.g. ('CSV', 'HEADER').
+    """
+    sql = 'COPY {}'.format(tablename)
+    if columns is not None:
+        sql += ' ({})'.format(', '.join(columns))
+    sql += ' FROM STDIN'
+    if copy_options:
+        sql += ' WITH ' + ' '.join(copy_options)
+    return sql
+
+
+def encode_row(row):
+    """Encodes one row as a line of the COPY text format."""
+    return b'\t'.join(_encode_value(value) for value in row) + b'\n'
+
+
+def _encode_value(value):
+    if value is None:
+        return b'\\N'
+    if value is True:
+        return b't'
+    if value is False:
+        return b'f'
+    if isinstance(value, bytes):
+        data = value
+    elif isinstance(value, (datetime.date, datetime.time)):
+        data = value.isoformat().encode('ascii')
+    elif isinstance(value, float):
+        # str() keeps only 12 significant digits on Python 2.
+        data = repr(value).encode('ascii')
+    else:
+        if not isinstance(value, type(u'')):
+            value = u'{}'.format(value)
+        data = value.encode('utf-8')
+    for char, escaped in _TEXT_ESCAPES:
+        if char in data:
+            data = data.replace(char, escaped)
+    return data
+
+
+class Timer(object):
+    """Context manager measuring elapsed wall time."""
+
+    def __enter__(self):
+        self.started_at = time.time()
+        self.elapsed = 0.0
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.elapsed = time.time() - self.started_at
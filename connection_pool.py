@@ -0,0 +1,208 @@
+import logging
+import threading
+import time
+
+import psycopg2
+import psycopg2.extensions
+
+
+class PoolTimeout(Exception):
+    """Raised when no pooled connection becomes available in time."""
+
+
+class ConnectionPool(object):
+    """Thread-safe pool of psycopg2 connections.
+
+    Connections are created lazily by `connect_fn` up to `max_size`. At
+    least `min_size` connections are kept open; any connection above that
+    which sits idle longer than `max_idle` seconds is closed.
+    """
+
+    def __init__(
+            self,
+            connect_fn,
+            min_size=1,
+            max_size=10,
+            max_idle=300,
+            health_check_interval=30):
+        """
+        :param connect_fn: callable returning a new, configured connection.
+        :param min_size: number of connections kept open at all times.
+        :param max_size: maximum number of connections open at once.
+        :param max_idle: seconds an idle connection above min_size may live.
+        :param health_check_interval: connections idle for longer than this
+            many seconds are pinged with `SELECT 1` before being handed out.
+        """
+        if min_size < 0 or max_size < 1 or min_size > max_size:
+            raise ValueError(
+                'Invalid pool size: min_size={}, max_size={}'.format(
+                    min_size, max_size))
+        self.connect_fn = connect_fn
+        self.min_size = min_size
+        self.max_size = max_size
+        self.max_idle = max_idle
+        self.health_check_interval = health_check_interval
+
+        self._lock = threading.Condition(threading.Lock())
+        self._idle = []  # List of (connection, time returned to the pool).
+        self._in_use = set()
+        self._opening = 0  # Connections currently being created.
+        self._closed = False
+
+    @property
+    def size(self):
+        """Number of connections currently open (idle + in use)."""
+        with self._lock:
+            return len(self._idle) + len(self._in_use) + self._opening
+
+    def fill(self):
+        """Opens connections until min_size is reached."""
+        while True:
+            with self._lock:
+                if self._closed or (
+                        len(self._idle) + len(self._in_use) + self._opening
+                        >= self.min_size):
+                    return
+                self._opening += 1
+            self.checkin(self._open(), _new=True)
+
+    def checkout(self, timeout=None):
+        """Borrows a connection from the pool.
+        :param timeout: seconds to wait for a free connection. Waits forever
+            if None.
+        :return: an open connection. Must be returned with `checkin`.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            with self._lock:
+                if self._closed:
+                    raise psycopg2.InterfaceError('connection pool is closed')
+                self._evict_idle()
+                candidate = None
+                if self._idle:
+                    # LIFO keeps the hottest connections in use and lets
+                    # the rest age out through idle eviction.
+                    candidate = self._idle.pop()
+                    self._in_use.add(candidate[0])
+                elif (len(self._in_use) + self._opening) < self.max_size:
+                    self._opening += 1
+                else:
+                    remaining = None
+                    if deadline is not None:
+                        remaining = deadline - time.time()
+                        if remaining <= 0:
+                            raise PoolTimeout(
+                                'No connection available after {}s '
+                                '(max_size={})'.format(
+                                    timeout, self.max_size))
+                    self._lock.wait(remaining)
+                    continue
+
+            if candidate is None:
+                conn = self._open()
+                with self._lock:
+                    self._opening -= 1
+                    self._in_use.add(conn)
+                return conn
+
+            conn, returned_at = candidate
+            if self._is_healthy(conn, time.time() - returned_at):
+                return conn
+            self._discard(conn)
+
+    def checkin(self, conn, _new=False):
+        """Returns a borrowed connection to the pool.
+        :param conn: connection previously obtained through `checkout`.
+        """
+        reusable = conn.closed == 0
+        if reusable and not _new:
+            status = conn.get_transaction_status()
+            if status != psycopg2.extensions.TRANSACTION_STATUS_IDLE:
+                # Never hand a connection with a dangling transaction to the
+                # next borrower.
+                if status != psycopg2.extensions.TRANSACTION_STATUS_UNKNOWN:
+                    logging.warning(
+                        'Rolling back open transaction on connection '
+                        'returned to the pool.')
+                try:
+                    conn.rollback()
+                except psycopg2.Error:
+                    reusable = False
+
+        with self._lock:
+            if _new:
+                self._opening -= 1
+            else:
+                self._in_use.discard(conn)
+            if reusable and not self._closed:
+                self._idle.append((conn, time.time()))
+                conn = None
+            self._lock.notify()
+        if conn is not None:
+            self._close_quietly(conn)
+
+    def close(self):
+        """Closes every idle connection and refuses further checkouts.
+        Connections still in use are closed as they are checked back in.
+        """
+        with self._lock:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._lock.notify_all()
+        for conn, _ in idle:
+            self._close_quietly(conn)
+
+    def _open(self):
+        """Opens a new connection. Caller must have reserved an `_opening`
+        slot; on failure the slot is released and the error re-raised.
+        """
+        try:
+            return self.connect_fn()
+        except Exception:
+            with self._lock:
+                self._opening -= 1
+                self._lock.notify()
+            raise
+
+    def _is_healthy(self, conn, idle_seconds):
+        if conn.closed != 0:
+            return False
+        if idle_seconds < self.health_check_interval:
+            return True
+        try:
+            with conn.cursor() as cursor:
+                cursor.execute('SELECT 1')
+            if not conn.autocommit:
+                conn.rollback()
+            return True
+        except psycopg2.Error as err:
+            logging.info('Discarding unhealthy pooled connection: %s', err)
+            return False
+
+    def _discard(self, conn):
+        with self._lock:
+            self._in_use.discard(conn)
+            self._lock.notify()
+        self._close_quietly(conn)
+
+    def _evict_idle(self):
+        """Closes connections idle for longer than max_idle. Must be called
+        with the lock held.
+        """
+        if self.max_idle is None or not self._idle:
+            return
+        now = time.time()
+        keep = max(self.min_size - len(self._in_use) - self._opening, 0)
+        # The idle list is ordered by return time, oldest first.
+        while len(self._idle) > keep and (
+                now - self._idle[0][1] > self.max_idle):
+            conn, _ = self._idle.pop(0)
+            logging.debug('Evicting idle pooled connection.')
+            self._close_quietly(conn)
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
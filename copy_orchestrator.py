@@ -0,0 +1,239 @@
+import collections
+import json
+import logging
+import os
+import Queue
+import threading
+import time
+import uuid
+
+import psycopg2
+
+
+class LocalObjectStore(object):
+    """Directory-backed stand-in for an S3 bucket.
+
+    Implements the interface BulkCopyOrchestrator needs from a store:
+    `bucket_name`, `get_aws_access_key_id`, `get_aws_secret_access_key`,
+    `list_keys(prefix)` and `put_object(key, body)`. Any S3 wrapper that
+    provides the same methods can be used instead.
+    """
+
+    def __init__(self, root_dir, bucket_name='local'):
+        self.root_dir = root_dir
+        self.bucket_name = bucket_name
+
+    def get_aws_access_key_id(self):
+        return 'local'
+
+    def get_aws_secret_access_key(self):
+        return 'local'
+
+    def list_keys(self, prefix):
+        """Returns the sorted keys starting with prefix."""
+        keys = []
+        for dirpath, _, filenames in os.walk(self.root_dir):
+            for filename in filenames:
+                key = os.path.relpath(
+                    os.path.join(dirpath, filename), self.root_dir)
+                key = key.replace(os.sep, '/')
+                if key.startswith(prefix):
+                    keys.append(key)
+        return sorted(keys)
+
+    def put_object(self, key, body):
+        path = os.path.join(self.root_dir, *key.split('/'))
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as out_f:
+            out_f.write(body)
+
+
+class CopyResult(object):
+    """Outcome and timing of one manifest COPY."""
+
+    def __init__(self, tablename, manifest_key, prefixes, num_files):
+        self.tablename = tablename
+        self.manifest_key = manifest_key
+        self.prefixes = prefixes
+        self.num_files = num_files
+        self.attempts = 0
+        self.elapsed = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.elapsed is not None
+
+    def __repr__(self):
+        return 'CopyResult({!r}, files={}, attempts={}, elapsed={})'.format(
+            self.tablename, self.num_files, self.attempts, self.elapsed)
+
+
+class BulkCopyOrchestrator(object):
+    """Loads many (table, prefix) pairs with manifest-based COPYs.
+
+    Pairs sharing a table, column list and options are grouped into a
+    manifest listing every key under their prefixes, so each table costs
+    one COPY instead of one per prefix. The COPYs run concurrently on the
+    DbConnection's pooled connections and failed ones are retried.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            store,
+            manifest_prefix='manifests/',
+            max_concurrency=4,
+            max_manifest_entries=1000,
+            retries=2,
+            retry_delay=5):
+        """
+        :param db_conn: DbConnection to COPY through. Should be pooled for
+            the loads to run concurrently.
+        :param store: object store holding the files and manifests, e.g.
+            an S3Connection wrapper or a LocalObjectStore.
+        :param manifest_prefix: key prefix where manifests are written.
+        :param max_concurrency: maximum number of COPYs running at once.
+        :param max_manifest_entries: files per manifest before splitting.
+        :param retries: extra attempts for a failed COPY.
+        :param retry_delay: seconds to wait before the first retry. Doubles
+            on each following retry.
+        """
+        self.db_conn = db_conn
+        self.store = store
+        self.manifest_prefix = manifest_prefix
+        self.max_concurrency = max_concurrency
+        self.max_manifest_entries = max_manifest_entries
+        self.retries = retries
+        self.retry_delay = retry_delay
+
+    def run(self, loads, columns=None, copy_options=()):
+        """Runs every load.
+        :param loads: iterable of (tablename, s3_prefix) pairs, or of
+            (tablename, s3_prefix, columns, copy_options) tuples.
+        :param columns: default column list for pairs without one.
+        :param copy_options: default Redshift COPY options for pairs
+            without them. MANIFEST is added automatically.
+        :return: list of CopyResults. Failures are reported in them rather
+            than raised.
+        """
+        jobs = self.plan(loads, columns, copy_options)
+        work = Queue.Queue()
+        for job in jobs:
+            work.put(job)
+
+        def worker():
+            while True:
+                try:
+                    job = work.get_nowait()
+                except Queue.Empty:
+                    return
+                self._run_job(*job)
+
+        threads = [
+            threading.Thread(target=worker, name='copy-{}'.format(idx))
+            for idx in range(max(1, min(self.max_concurrency, len(jobs))))
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        results = [job[0] for job in jobs]
+        failed = [r for r in results if not r.succeeded]
+        logging.info(
+            'Bulk copy finished: %s manifests loaded, %s failed',
+            len(results) - len(failed), len(failed))
+        return results
+
+    def plan(self, loads, columns=None, copy_options=()):
+        """Groups loads and writes their manifests.
+        :return: list of (CopyResult, columns, copy_options) jobs.
+        """
+        groups = collections.OrderedDict()
+        for load in loads:
+            tablename, s3_prefix = load[0], load[1]
+            load_columns = load[2] if len(load) > 2 else columns
+            load_options = load[3] if len(load) > 3 else copy_options
+            key = (
+                tablename,
+                None if load_columns is None else tuple(load_columns),
+                tuple(load_options))
+            groups.setdefault(key, []).append(s3_prefix)
+
+        jobs = []
+        for (tablename, load_columns, load_options), prefixes in (
+                groups.iteritems()):
+            keys = []
+            seen = set()
+            for prefix in prefixes:
+                # Overlapping prefixes list the same keys more than once.
+                for key in self.store.list_keys(prefix):
+                    if key not in seen:
+                        seen.add(key)
+                        keys.append(key)
+            if not keys:
+                logging.warning(
+                    'No files to copy into %s under %s', tablename, prefixes)
+                continue
+            for start in range(0, len(keys), self.max_manifest_entries):
+                chunk = keys[start:start + self.max_manifest_entries]
+                manifest_key = self._write_manifest(tablename, chunk)
+                options = tuple(load_options)
+                if 'MANIFEST' not in [opt.upper() for opt in options]:
+                    options += ('MANIFEST',)
+                jobs.append((
+                    CopyResult(tablename, manifest_key, prefixes, len(chunk)),
+                    load_columns,
+                    options))
+        return jobs
+
+    def _write_manifest(self, tablename, keys):
+        manifest = {
+            'entries': [
+                {
+                    'url': 's3://{}/{}'.format(self.store.bucket_name, key),
+                    'mandatory': True,
+                }
+                for key in keys
+            ],
+        }
+        manifest_key = '{}{}.{}.manifest'.format(
+            self.manifest_prefix, tablename, uuid.uuid4().hex[:12])
+        self.store.put_object(manifest_key, json.dumps(manifest).encode())
+        return manifest_key
+
+    def _run_job(self, result, columns, copy_options):
+        delay = self.retry_delay
+        started_at = time.time()
+        while True:
+            result.attempts += 1
+            try:
+                self.db_conn.execute_copy(
+                    result.tablename,
+                    self.store,
+                    result.manifest_key,
+                    columns,
+                    copy_options)
+                result.error = None
+                result.elapsed = time.time() - started_at
+                logging.info(
+                    'Copied %s files into %s in %.2fs (attempt %s)',
+                    result.num_files, result.tablename, result.elapsed,
+                    result.attempts)
+                return
+            except psycopg2.Error as err:
+                result.error = err
+                if result.attempts > self.retries:
+                    result.elapsed = time.time() - started_at
+                    logging.error(
+                        'Copy into %s from %s failed after %s attempts: %s',
+                        result.tablename, result.manifest_key,
+                        result.attempts, err)
+                    return
+                logging.warning(
+                    'Copy into %s failed (attempt %s), retrying in %ss: %s',
+                    result.tablename, result.attempts, delay, err)
+                time.sleep(delay)
+                delay *= 2
@@ -1,9 +1,24 @@
+import contextlib
 import logging
+import threading
+import time
+import uuid
 
 import psycopg2
-import yaml
 
+from amg_connection import AmgConnection
+from amg_connection import PreparedStatementCache
+from amg_connection import PreparedStatementStats
 from amg_cursor import AmgCursor
+from amg_cursor import DEFAULT_HASH_TEXT_TYPE
+from amg_cursor import DEFAULT_PAGE_SIZE
+from amg_cursor import DEFAULT_PARTITION_HASH
+from instrumentation import INSTRUMENTATION
+from instrumentation import Instrumentation
+from lru_cache import LruCache
+from timeouts import retry
+from utils import no_quotes
+from utils import redshift_cred_string
 
 class DbConnection(object):
     """Wrapper class for holding a Redshift database connection.
@@ -19,7 +34,13 @@ class DbConnection(object):
     def from_yaml(cls, file_path, *yaml_scope):
         """Returns new DbConnection instance from the yaml file.
         Required values: host, database, user, password, port
-        Optional values: autocommit
+        Optional values: autocommit, pool_min_size, pool_max_size,
+            pool_max_idle, pool_timeout, fast_execute, prepared_cache_size,
+            import_id_cache_size, import_id_cache_ttl, statement_timeout,
+            read_timeout, read_retries, replicas, read_balancing,
+            primary_after_write, result_cache_bytes
+            Each entry of replicas may override host, port, database,
+            username, password and pool_max_size of the primary.
         :param file_path: path to the yaml configuration file.
         :param yaml_scope: the section of the yaml file to look into.
         :return: a new DbConnection instance.
@@ -29,6 +50,8 @@ class DbConnection(object):
             file_path,
             '->'.join(yaml_scope))
 
+        # Imported here so programs not using yaml configs skip loading it.
+        import yaml
         info = yaml.safe_load(file(file_path))
         for scope in yaml_scope:
             info = info[scope]
@@ -39,7 +62,25 @@ class DbConnection(object):
             user=info.get('username', ''),
             password=info['password'],
             port=info.get('port', 5432),
-            autocommit=info.get('autocommit', cls.DEFAULT_AUTOCOMMIT))
+            autocommit=info.get('autocommit', cls.DEFAULT_AUTOCOMMIT),
+            pool_min_size=info.get('pool_min_size', 1),
+            pool_max_size=info.get('pool_max_size'),
+            pool_max_idle=info.get('pool_max_idle', 300),
+            pool_timeout=info.get('pool_timeout'),
+            fast_execute=info.get('fast_execute', False),
+            prepared_cache_size=info.get('prepared_cache_size', 100),
+            import_id_cache_size=info.get('import_id_cache_size', 10000),
+            import_id_cache_ttl=info.get('import_id_cache_ttl'),
+            statement_timeout=info.get('statement_timeout'),
+            read_timeout=info.get('read_timeout'),
+            read_retries=info.get('read_retries', 0),
+            replicas=[
+                _replica_settings(replica)
+                for replica in info.get('replicas') or ()
+            ],
+            read_balancing=info.get('read_balancing', 'round_robin'),
+            primary_after_write=info.get('primary_after_write'),
+            result_cache_bytes=info.get('result_cache_bytes'))
 
     def __init__(
             self,
@@ -48,16 +89,117 @@ class DbConnection(object):
             user,
             password,
             port,
-            autocommit=DEFAULT_AUTOCOMMIT):
-        # TODO: add statement_timeout option
+            autocommit=DEFAULT_AUTOCOMMIT,
+            pool_min_size=1,
+            pool_max_size=None,
+            pool_max_idle=300,
+            pool_timeout=None,
+            fast_execute=False,
+            prepared_cache_size=100,
+            import_id_cache_size=10000,
+            import_id_cache_ttl=None,
+            instrumentation=None,
+            statement_timeout=None,
+            read_timeout=None,
+            read_retries=0,
+            retry_base_delay=0.1,
+            retry_max_delay=5.0,
+            replicas=None,
+            read_balancing='round_robin',
+            primary_after_write=None,
+            result_cache_bytes=None):
+        """
+        :param pool_min_size: connections kept open when pooled.
+        :param pool_max_size: enables pooled mode when set. Cursors then
+            borrow a connection from a thread-safe pool of at most this many
+            connections, and return it when closed.
+        :param pool_max_idle: seconds before an idle pooled connection above
+            pool_min_size is closed.
+        :param pool_timeout: seconds to wait for a free pooled connection.
+            Waits forever if None.
+        :param fast_execute: if True, cursors skip the client-side
+            mogrify/dedent pass and only log when DEBUG is enabled.
+        :param prepared_cache_size: number of prepared statements kept per
+            connection by `execute_sql(..., prepare=True)`.
+        :param import_id_cache_size: number of import ids kept in the LRU
+            cache used by get_media_import_id.
+        :param import_id_cache_ttl: seconds a cached import id stays valid.
+            Never expires if None.
+        :param instrumentation: instrumentation.Instrumentation whose hooks
+            see every statement run through this connection. Defaults to
+            one of its own, whose statements the hooks of the process-wide
+            instrumentation.INSTRUMENTATION see too.
+        :param statement_timeout: default seconds any statement may run
+            before it is cancelled. Unlimited if None or 0. Calls taking a
+            timeout argument can override it.
+        :param read_timeout: seconds per attempt of the idempotent lookups
+            (get_imported_files, get_media_import_id). Defaults to
+            statement_timeout.
+        :param read_retries: extra attempts of those lookups after a
+            timeout or connection error.
+        :param retry_base_delay: seconds capping the first retry's jittered
+            delay. The cap doubles on each following retry.
+        :param retry_max_delay: largest delay between retries.
+        :param replicas: list of dictionaries describing read replicas.
+            Each may override host, port, database, user, password and
+            pool_max_size; other settings are shared with the primary.
+            Read-only calls are routed to them; writes, COPY and upserts
+            stay on the primary.
+        :param read_balancing: 'round_robin' or 'least_loaded'.
+        :param primary_after_write: seconds reads stay on the primary after
+            this DbConnection ran a statement there that may have written,
+            so they see their own writes. Disabled if None.
+        :param result_cache_bytes: enables caching the results of
+            execute_sql(..., return_results=True) up to about this many
+            bytes. Entries are dropped when a statement run through this
+            DbConnection writes to a table they read.
+        """
         self.host = host
         self.database = database
         self.user = user
         self.password = password
         self.port = port
         self.autocommit = autocommit
-        self.cache = {}  # Cache for holding some query results.
+        # Import ids keyed by (schema, table_append, source, file_name).
+        self.import_id_cache = LruCache(
+            import_id_cache_size, import_id_cache_ttl)
         self.conn = None
+        self.pool_min_size = pool_min_size
+        self.pool_max_size = pool_max_size
+        self.pool_max_idle = pool_max_idle
+        self.pool_timeout = pool_timeout
+        self.pool = None
+        self._pool_lock = threading.Lock()
+        self.fast_execute = fast_execute
+        self.prepared_cache_size = prepared_cache_size
+        # Prepared statement hit/miss counters across all connections.
+        self.prepared_stats = PreparedStatementStats()
+        # Hooks of the result cache, plan capture and maintenance only see
+        # this DbConnection's statements, and go away with it.
+        self.instrumentation = instrumentation or Instrumentation(
+            INSTRUMENTATION)
+        # Hooks running a background thread, stopped by close().
+        self._services = []
+        self.statement_timeout = statement_timeout
+        self.read_timeout = read_timeout
+        self.read_retries = read_retries
+        self.retry_base_delay = retry_base_delay
+        self.retry_max_delay = retry_max_delay
+        self.primary_after_write = primary_after_write
+        self._last_write = None
+        # Optional subsystems are imported where first used, so programs
+        # not using them skip loading them.
+        self.replicas = None
+        if replicas:
+            from replica_router import ReplicaRouter
+            self.replicas = ReplicaRouter(
+                [self._replica(settings) for settings in replicas],
+                read_balancing)
+        self.result_cache = None
+        if result_cache_bytes:
+            from result_cache import ResultCache
+            self.result_cache = ResultCache(result_cache_bytes)
+            self.instrumentation.add_hook(self.result_cache)
 
     def __enter__(self):
         self.connect()
@@ -66,67 +208,489 @@ class DbConnection(object):
     def __exit__(self, exc_type, exc_val, exc_tb):
         self.close()
 
+    def is_pooled(self):
+        """Returns true if connections are borrowed from a pool."""
+        return self.pool_max_size is not None
+
     def is_connected(self):
         """Returns true if the database is actively connected."""
+        if self.is_pooled():
+            return self.pool is not None
         return self.conn is not None and self.conn.closed == 0
 
     def connect(self):
         """Reconnects the database connection."""
         if self.is_connected():
-            self.close()
+            self._disconnect()
+
+        if self.is_pooled():
+            with self._pool_lock:
+                self.pool = self._create_pool()
+            return
+
+        self.conn = self._open_connection()
+
+    def close(self):
+        """Disconnect the database connection, stopping the plan capture and
+        maintenance started on it.
+        """
+        services, self._services = self._services, []
+        for service in services:
+            self.instrumentation.remove_hook(service)
+            service.close()
+        self._disconnect()
+
+    def _disconnect(self):
+        logging.debug(
+            'Closing connection to %s:%s/%s...',
+            self.host,
+            self.port,
+            self.database)
+        if self.is_pooled():
+            with self._pool_lock:
+                pool, self.pool = self.pool, None
+            if pool is not None:
+                pool.close()
+        else:
+            self.conn.close()
+        if self.replicas is not None:
+            self.replicas.close()
+
+    def _replica(self, settings):
+        """Returns the DbConnection of one read replica."""
+        return DbConnection(
+            host=settings.get('host', self.host),
+            database=settings.get('database', self.database),
+            user=settings.get('user', self.user),
+            password=settings.get('password', self.password),
+            port=settings.get('port', self.port),
+            autocommit=self.autocommit,
+            pool_min_size=self.pool_min_size,
+            pool_max_size=settings.get('pool_max_size', self.pool_max_size),
+            pool_max_idle=self.pool_max_idle,
+            pool_timeout=self.pool_timeout,
+            fast_execute=self.fast_execute,
+            prepared_cache_size=self.prepared_cache_size,
+            instrumentation=self.instrumentation,
+            statement_timeout=self.statement_timeout)
+
+    def _read_replica(self, read_only):
+        """Returns true if a read_only call should go to a replica."""
+        if not read_only or self.replicas is None:
+            return False
+        last_write = self._last_write
+        return (
+            self.primary_after_write is None or last_write is None or
+            time.time() - last_write >= self.primary_after_write)
 
+    def _note_write(self, read_only):
+        if not read_only and self.primary_after_write is not None:
+            self._last_write = time.time()
+
+    def _open_connection(self):
+        """Opens and configures a new psycopg2 connection."""
         logging.info(
             'Connecting to %s:%s/%s...', self.host, self.port, self.database)
-        self.conn = psycopg2.connect(
+        conn = psycopg2.connect(
             host=self.host,
             database=self.database,
             user=self.user,
             password=self.password,
             port=self.port,
+            connection_factory=AmgConnection,
             cursor_factory=AmgCursor)
 
-        self.conn.autocommit = self.autocommit
+        conn.autocommit = self.autocommit
+        conn.fast_execute = self.fast_execute
+        conn.prepared = PreparedStatementCache(
+            self.prepared_cache_size, self.prepared_stats)
+        conn.instrumentation = self.instrumentation
+        if self.statement_timeout:
+            with conn.cursor() as cursor:
+                cursor.execute_raw(
+                    'SET statement_timeout = %s',
+                    (int(self.statement_timeout * 1000),))
+            if not conn.autocommit:
+                conn.commit()
+            conn.statement_timeout = self.statement_timeout
+        return conn
 
-    def close(self):
-        """Disconnect the database connection."""
-        logging.debug(
-            'Closing connection to %s:%s/%s...',
-            self.host,
-            self.port,
-            self.database)
-        self.conn.close()
+    def _create_pool(self):
+        from connection_pool import ConnectionPool
+        pool = ConnectionPool(
+            self._open_connection,
+            min_size=self.pool_min_size,
+            max_size=self.pool_max_size,
+            max_idle=self.pool_max_idle)
+        pool.fill()
+        return pool
+
+    def _get_pool(self):
+        """Returns the connection pool, creating it on first use."""
+        with self._pool_lock:
+            if self.pool is None:
+                logging.info('No connection pool yet. Connecting...')
+                self.pool = self._create_pool()
+            return self.pool
+
+    @contextlib.contextmanager
+    def connection(self, read_only=False):
+        """Context manager lending a connection for the with-block. Pooled
+        connections are returned to the pool on exit.
+        :param read_only: if True, the connection may come from a replica,
+            or from the primary when no replica can be reached.
+        """
+        if self._read_replica(read_only):
+            acquired = False
+            try:
+                with self.replicas.replica() as replica:
+                    with replica.connection() as conn:
+                        acquired = True
+                        yield conn
+                return
+            except psycopg2.OperationalError as err:
+                # Errors of the with-block are the caller's.
+                if acquired:
+                    raise
+                logging.warning(
+                    'No replica connection, reading from primary: %s', err)
+        self._note_write(read_only)
+        if not self.is_pooled():
+            if not self.is_connected():
+                logging.info('No connection to lend. Reconnecting...')
+                self.connect()
+            yield self.conn
+            return
+
+        pool = self._get_pool()
+        conn = pool.checkout(self.pool_timeout)
+        try:
+            yield conn
+        finally:
+            pool.checkin(conn)
+
+    @contextlib.contextmanager
+    def _exclusive_connection(self, read_only=False):
+        """Context manager lending a connection nothing else uses during
+        the with-block: a pooled one, or else a new connection closed on
+        exit, as the shared one may be used meanwhile.
+        :param read_only: if True, the connection may come from a replica,
+            or from the primary when no replica can be reached.
+        """
+        if self._read_replica(read_only):
+            acquired = False
+            try:
+                with self.replicas.replica() as replica:
+                    with replica._exclusive_connection() as conn:
+                        acquired = True
+                        yield conn
+                return
+            except psycopg2.OperationalError as err:
+                if acquired:
+                    raise
+                logging.warning(
+                    'No replica connection, reading from primary: %s', err)
+        self._note_write(read_only)
+        if self.is_pooled():
+            pool = self._get_pool()
+            conn = pool.checkout(self.pool_timeout)
+            try:
+                yield conn
+            finally:
+                pool.checkin(conn)
+            return
+        conn = self._open_connection()
+        try:
+            yield conn
+        finally:
+            conn.close()
+
+    def new_cursor(self, read_only=False):
+        """Returns a new cursor from the database connection. When pooled,
+        the cursor holds its connection until the cursor is closed.
+        :param read_only: if True, the cursor may come from a replica. Only
+            run statements that don't write through it.
+        """
+        if self._read_replica(read_only):
+            try:
+                return self.replicas.new_cursor()
+            except psycopg2.OperationalError as err:
+                logging.warning(
+                    'No replica connection, reading from primary: %s', err)
+        self._note_write(read_only)
+        if self.is_pooled():
+            pool = self._get_pool()
+            started_at = time.time()
+            conn = pool.checkout(self.pool_timeout)
+            try:
+                cursor = conn.cursor()
+            except Exception:
+                pool.checkin(conn)
+                raise
+            cursor.conn_wait = time.time() - started_at
+            cursor.on_close = lambda: pool.checkin(conn)
+            return cursor
 
-    def new_cursor(self):
-        """Returns a new cursor from the database connection."""
         if not self.is_connected():
             logging.info('No connection to get a cursor from. Reconnecting...')
             self.connect()
         return self.conn.cursor()
 
-    def execute_sql(self, query, params=None, return_results=False):
+    def capture_slow_plans(self, threshold=5.0, **kwargs):
+        """Starts capturing the plan of statements slower than threshold.
+        :param threshold: seconds a statement must run to be captured.
+        :param kwargs: other plan_capture.SlowQueryPlanCapture options.
+        :return: the SlowQueryPlanCapture. Its `store` holds the plans;
+            remove it from `instrumentation` and close it to stop early.
+            close() stops it otherwise.
+        """
+        from plan_capture import SlowQueryPlanCapture
+        capture = SlowQueryPlanCapture(self, threshold, **kwargs)
+        self.instrumentation.add_hook(capture)
+        self._services.append(capture)
+        return capture
+
+    def schedule_maintenance(self, analyze_rows=100000, **kwargs):
+        """Starts running ANALYZE and VACUUM on tables after many rows were
+        written to them.
+        :param analyze_rows: rows written to a table before it is ANALYZEd.
+        :param kwargs: other maintenance.MaintenanceScheduler options
+            (vacuum_rows, vacuum_mode, vacuum_to_percent, windows, ...).
+        :return: the MaintenanceScheduler. Its `history` records what ran;
+            remove it from `instrumentation` and close it to stop early.
+            close() stops it otherwise.
+        """
+        from maintenance import MaintenanceScheduler
+        scheduler = MaintenanceScheduler(self, analyze_rows, **kwargs)
+        self.instrumentation.add_hook(scheduler)
+        self._services.append(scheduler)
+        return scheduler
+
+    @contextlib.contextmanager
+    def transaction(self, sql_files=(), params=None, timeout=None):
+        """Context manager for a transaction pinned to one connection.
+        Commits when the with-block exits cleanly, rolls back otherwise.
+        Without a pool the shared connection is used, so it should not be
+        used concurrently from other threads meanwhile.
+        :param sql_files: ordered list of sql file paths to run first, sent
+            to the server in a single round trip.
+        :param params: dictionary of values to use in the sql files.
+        :param timeout: seconds the sql files may run. Defaults to
+            statement_timeout.
+        :yield: a cursor bound to the transaction's connection.
+        """
+        with self.connection() as conn:
+            autocommit = conn.autocommit
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cursor:
+                    if sql_files:
+                        with cursor.timeout(self._timeout(timeout)):
+                            cursor.execute_files(sql_files, params)
+                    yield cursor
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            finally:
+                conn.autocommit = autocommit
+
+    def execute_sql_files(self, file_paths, params=None, timeout=None):
+        """Execute several sql files in a single transaction.
+        :param file_paths: ordered list of sql file paths to execute.
+        :param params: dictionary of values to use in the corresponding sql.
+        :param timeout: seconds the files may run. Defaults to
+            statement_timeout.
+        """
+        with self.transaction(file_paths, params, timeout):
+            pass
+
+    def _timeout(self, timeout):
+        """Returns the timeout to use. A statement_timeout of 0 means no
+        limit, as in PostgreSQL, so it leaves the connection's as is.
+        """
+        if timeout is None:
+            return self.statement_timeout or None
+        return timeout
+
+    def _read(self, query, params, read_only=True):
+        """Runs an idempotent lookup, retrying timeouts and connection
+        errors with jittered backoff. Read-only lookups may run on a
+        replica, and each retry may pick a different one.
+        """
+        timeout = self._timeout(self.read_timeout)
+        return retry(
+            lambda: self.execute_sql(
+                query, params, return_results=True, timeout=timeout,
+                read_only=read_only),
+            self.read_retries,
+            self.retry_base_delay,
+            self.retry_max_delay)
+
+    def execute_sql(
+            self,
+            query,
+            params=None,
+            return_results=False,
+            prepare=False,
+            row_format='dict',
+            timeout=None,
+            read_only=False,
+            cache=True,
+            typecodes=None,
+            use_numpy=False):
         """Execute arbitrary query using a new cursor.
         :param query: sql string to execute.
         :param params: dictionary of values to use in the corresponding sql.
         :param return_results: if True, function will return the results of
             the query.
-        :return: the query results or None.
+        :param prepare: if True, run the query as a server-side prepared
+            statement that is reused by later calls on the same connection.
+        :param row_format: format of the returned results, one of
+            amg_cursor.ROW_FORMATS. See AmgCursor.fetch_as.
+        :param timeout: seconds the query may run. Defaults to
+            statement_timeout.
+        :param read_only: if True, the query doesn't write and may run on a
+            read replica.
+        :param cache: if False, bypass the result cache. Results of queries
+            calling volatile functions such as GETDATE() shouldn't be cached.
+            Replica reads are only cached if primary_after_write is set.
+        :param typecodes: with row_format 'columnar', dictionary mapping
+            column names to `array` typecodes. See AmgCursor.fetch_columns.
+        :param use_numpy: with row_format 'columnar', return NumPy arrays.
+        :return: the query results or None. Cached results are shared
+            between calls and must not be modified.
         """
-        with self.new_cursor() as cursor:
-            cursor.execute(query, params)
-            results = cursor.fetchall() if return_results else None
+        # A lagging replica may return rows older than writes the cache
+        # has seen, unless reads stay on the primary long enough after.
+        if read_only and self.replicas is not None:
+            cache = cache and self.primary_after_write is not None
+        with self.new_cursor(read_only) as cursor:
+            cache_key = None
+            if return_results and cache and self.result_cache is not None:
+                statement = cursor.mogrify(query, params)
+                cache_key = (
+                    statement,
+                    row_format,
+                    tuple(sorted((typecodes or {}).items())),
+                    use_numpy)
+                results = self.result_cache.get(cache_key)
+                if results is not None:
+                    return results
+                generation = self.result_cache.generation
+            with cursor.timeout(self._timeout(timeout)):
+                if prepare:
+                    cursor.execute_prepared(query, params)
+                else:
+                    cursor.execute(query, params)
+            results = None
+            if return_results:
+                results = cursor.fetch_as(
+                    row_format, typecodes=typecodes, use_numpy=use_numpy)
+        if cache_key is not None:
+            if isinstance(statement, bytes):
+                statement = statement.decode('utf-8', 'replace')
+            self.result_cache.put(cache_key, statement, results, generation)
         return results
 
-    def execute_sql_file(self, file_path, params=None, return_results=False):
+    def execute_values(
+            self,
+            query,
+            argslist,
+            template=None,
+            page_size=DEFAULT_PAGE_SIZE):
+        """Execute a multi-row VALUES statement in pages using a new cursor.
+        See AmgCursor.execute_values.
+        :return: total number of rows affected.
+        """
+        with self.new_cursor() as cursor:
+            return cursor.execute_values(query, argslist, template, page_size)
+
+    def execute_batch(self, query, argslist, page_size=DEFAULT_PAGE_SIZE):
+        """Execute a statement once per parameter set, in pages, using a
+        new cursor. See AmgCursor.execute_batch.
+        :return: number of statements executed.
+        """
+        with self.new_cursor() as cursor:
+            return cursor.execute_batch(query, argslist, page_size)
+
+    def insert_rows(
+            self,
+            tablename,
+            rows,
+            columns=None,
+            page_size=DEFAULT_PAGE_SIZE):
+        """Insert many rows with page_size rows per INSERT statement.
+        :param tablename: full tablename to insert into.
+        :param rows: iterable of row tuples/lists.
+        :param columns: list of column names the rows' values go to.
+        :param page_size: rows sent per statement.
+        :return: number of rows inserted.
+        """
+        col_string = ' ({})'.format(
+            ', '.join(columns)) if columns is not None else ''
+        return self.execute_values(
+            'INSERT INTO {}{} VALUES %s'.format(tablename, col_string),
+            rows,
+            page_size=page_size)
+
+    def iter_sql(self, query, params=None, batch_size=2000, read_only=False):
+        """Execute a query and yield its rows as they arrive.
+        Rows are read through a named server-side cursor, batch_size at a
+        time, so memory use stays bounded however large the result is. The
+        connection stays borrowed until the generator is exhausted or
+        closed. Without a pool, a connection of its own is opened for it,
+        so statements run while iterating aren't caught in its transaction.
+        :param query: sql string to execute.
+        :param params: dictionary of values to use in the corresponding sql.
+        :param batch_size: number of rows fetched per round trip.
+        :param read_only: if True, the query may run on a read replica.
+        """
+        with self._exclusive_connection(read_only) as conn:
+            # Server-side cursors only live inside a transaction, which is
+            # why the connection must not be shared meanwhile.
+            autocommit = conn.autocommit
+            if autocommit:
+                conn.autocommit = False
+            try:
+                cursor = conn.cursor(
+                    name='amg_iter_{}'.format(uuid.uuid4().hex[:12]))
+                cursor.itersize = batch_size
+                try:
+                    cursor.execute(query, params)
+                    while True:
+                        rows = cursor.fetchmany(batch_size)
+                        if not rows:
+                            break
+                        for row in rows:
+                            yield row
+                finally:
+                    cursor.close()
+            finally:
+                if autocommit:
+                    conn.rollback()
+                    conn.autocommit = True
+
+    def execute_sql_file(
+            self,
+            file_path,
+            params=None,
+            return_results=False,
+            timeout=None):
         """Execute contents of a sql file using a new cursor.
         :param file_path: path of sql file to execute.
         :param params: dictionary of values to use in the corresponding sql.
         :param return_results: if True, function will return the results of
             the query.
+        :param timeout: seconds the file may run. Defaults to
+            statement_timeout.
         :return: the query results or None.
         """
-        logging.info('Executing sql file: %s', file_path)
-        with open(file_path, 'r') as exec_f:
-            return self.execute_sql(exec_f.read(), params, return_results)
+        with self.new_cursor() as cursor:
+            with cursor.timeout(self._timeout(timeout)):
+                cursor.execute_file(file_path, params)
+            results = cursor.fetchall() if return_results else None
+        return results
 
     def execute_unload(
             self,
@@ -165,6 +729,22 @@ class DbConnection(object):
                 'aws_creds': rs_cred_string,
             })
 
+    def export_query(self, query, params=None, dest=None, **kwargs):
+        """Stream query results to local files or a writable buffer using
+        a new cursor. See AmgCursor.copy_to.
+        :return: an export.ExportStats.
+        """
+        with self.new_cursor() as cursor:
+            return cursor.copy_to(query, params, dest, **kwargs)
+
+    def export_ranges(self, query, ranges, path_template, **kwargs):
+        """Export slices of a query concurrently. See export.export_ranges.
+        :return: an export.ExportStats.
+        """
+        import export
+        return export.export_ranges(
+            self, query, ranges, path_template, **kwargs)
+
     def execute_copy(
             self,
             tablename,
@@ -183,6 +763,136 @@ class DbConnection(object):
             cursor.execute_copy(
                 tablename, s3_conn, s3_prefix, columns, copy_options)
 
+    def execute_copies(self, s3_conn, loads, **kwargs):
+        """Load many (tablename, s3_prefix) pairs with concurrent,
+        manifest-based COPYs. See BulkCopyOrchestrator.
+        :param s3_conn: object store holding the files and manifests.
+        :param loads: iterable of (tablename, s3_prefix) pairs.
+        :param kwargs: BulkCopyOrchestrator options (max_concurrency,
+            retries, manifest_prefix, ...).
+        :return: list of CopyResults.
+        """
+        from copy_orchestrator import BulkCopyOrchestrator
+        return BulkCopyOrchestrator(self, s3_conn, **kwargs).run(loads)
+
+    def pipelined_ingest(
+            self,
+            s3_conn,
+            batches,
+            target_table,
+            staging_table,
+            uniqueness_keys,
+            col_list,
+            media_schema,
+            data_source,
+            **kwargs):
+        """Load batches of files with overlapping COPY, upsert and imports
+        status stages. See PipelinedIngest.
+        :param s3_conn: S3Connection object that holds the files.
+        :param batches: iterable of IngestBatches.
+        :param kwargs: other PipelinedIngest options (copy_concurrency,
+            upsert_concurrency, queue_size, ...).
+        :return: tuple of (list of IngestBatches, dictionary of StageStats
+            by stage name).
+        """
+        from pipelined_ingest import PipelinedIngest
+        pipeline = PipelinedIngest(
+            self,
+            s3_conn,
+            target_table,
+            staging_table,
+            uniqueness_keys,
+            col_list,
+            media_schema,
+            data_source,
+            **kwargs)
+        return pipeline.run(batches), pipeline.stats
+
+    def copy_from_rows(self, tablename, rows, columns=None, **kwargs):
+        """Stream rows into a table using a new cursor.
+        See AmgCursor.copy_from_rows.
+        :return: a bulk_load.LoadStats.
+        """
+        with self.new_cursor() as cursor:
+            return cursor.copy_from_rows(tablename, rows, columns, **kwargs)
+
+    def copy_from_file(self, tablename, fileobj, columns=None, **kwargs):
+        """Stream a file object into a table using a new cursor.
+        See AmgCursor.copy_from_file.
+        :return: a bulk_load.LoadStats.
+        """
+        with self.new_cursor() as cursor:
+            return cursor.copy_from_file(tablename, fileobj, columns, **kwargs)
+
+    def upsert(
+            self,
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions=None,
+            has_timestamps=True,
+            strategy='compare',
+            hash_column='row_hash',
+            partitions=1,
+            partition_hash=DEFAULT_PARTITION_HASH,
+            text_type=DEFAULT_HASH_TEXT_TYPE):
+        """Performs an upsert using new cursors. See AmgCursor.upsert.
+        :param partitions: if more than 1, the source is split by a hash of
+            the uniqueness keys and each partition is upserted in its own
+            transaction. With a pool, partitions run concurrently on
+            separate connections.
+        :return: tuple of (updated rows, inserted rows).
+        """
+        args = (
+            source_table,
+            target_table,
+            uniqueness_keys,
+            col_list,
+            col_functions,
+            has_timestamps,
+            strategy,
+            hash_column)
+        if partitions <= 1:
+            with self.new_cursor() as cursor:
+                return cursor.upsert(*args)
+
+        counts = [None] * partitions
+        errors = []
+
+        def run_partition(index):
+            try:
+                with self.transaction() as cursor:
+                    counts[index] = cursor.upsert(
+                        *args,
+                        partition=(index, partitions),
+                        partition_hash=partition_hash,
+                        text_type=text_type)
+            except Exception as err:
+                logging.error(
+                    'Upsert partition %s/%s into %s failed: %s',
+                    index + 1, partitions, target_table, err)
+                errors.append(err)
+
+        if not self.is_pooled():
+            # One shared connection can only run a partition at a time.
+            for index in range(partitions):
+                run_partition(index)
+        else:
+            threads = [
+                threading.Thread(target=run_partition, args=(index,))
+                for index in range(partitions)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        if errors:
+            raise errors[0]
+        return (
+            sum(count[0] for count in counts if count is not None),
+            sum(count[1] for count in counts if count is not None))
+
     def drop_tables(self, tables, schema=None, use_if_exists=True):
         """Drops a list of tables.
         :param tables: iterable of tables to drop
@@ -201,51 +911,135 @@ class DbConnection(object):
             media_schema,
             data_source,
             file_name,
-            table_append=''):
+            table_append='',
+            read_only=True):
         """Get the import id from the associated file_name.
         :param media_schema: schema holding the imports table.
         :param data_source: restrict searching for a data source ('COMSCORE',
             'FYI', etc...)
         :param file_name: filename to get the id for.
+        :param read_only: if False, always read from the primary, e.g.
+            before writing based on the result.
         :return: the id associated with the file_name. None if not found.
         """
-        # Identifier for the cached import ids.
-        cache_key = 'filename_to_import_id'
         data_source = data_source.upper()
+        cache_key = (media_schema, table_append, data_source, file_name)
 
-        if cache_key in self.cache and file_name in self.cache[cache_key]:
+        import_id = self.import_id_cache.get(cache_key)
+        if import_id is not None:
             # If we already have the import id cached, no need to run the
             # query.
-            return self.cache[cache_key][file_name]
+            return import_id
         else:
-            query = """SELECT id FROM %(media_schema)s.imports%(table_append)s
+            query, params = self._import_id_query(
+                media_schema, data_source, file_name, table_append)
+            res = self._read(query, params, read_only)
+            import_id = self._single_import_id(file_name, res)
+            if import_id is not None:
+                # Cache the import_id for future calls.
+                self.import_id_cache.put(cache_key, import_id)
+            return import_id
+
+    @staticmethod
+    def _import_id_query(media_schema, data_source, file_name, table_append):
+        query = """SELECT id FROM %(media_schema)s.imports%(table_append)s
             WHERE source = %(data_source)s AND file_name = %(file_name)s"""
-            res = self.execute_sql(
-                query,
-                {
-                    'media_schema': no_quotes(media_schema),
-                    'data_source': data_source,
-                    'file_name': file_name,
-                    'table_append': no_quotes(table_append),
-                },
-                return_results=True)
-
-            if len(res) == 0:
-                logging.info('No associated import id found for %s', file_name)
-                return None
-            elif len(res) > 1:
-                msg = (
-                    '{} is associated with multiple import records: {}'.format(
-                        file_name, res))
+        params = {
+            'media_schema': no_quotes(media_schema),
+            'data_source': data_source,
+            'file_name': file_name,
+            'table_append': no_quotes(table_append),
+        }
+        return query, params
+
+    @staticmethod
+    def _single_import_id(file_name, res):
+        """Returns the import id held by the rows of an _import_id_query."""
+        if len(res) == 0:
+            logging.info('No associated import id found for %s', file_name)
+            return None
+        elif len(res) > 1:
+            msg = (
+                '{} is associated with multiple import records: {}'.format(
+                    file_name, res))
+            logging.critical(msg)
+            raise Exception(msg)
+        return res[0]['id']
+
+    def prefetch_import_ids(
+            self,
+            media_schema,
+            data_source,
+            file_names,
+            table_append=''):
+        """Loads the import ids of many files into the cache with one query.
+        Files whose id is already cached are not queried again.
+        :param media_schema: schema holding the imports table.
+        :param data_source: data source of the files ('COMSCORE', 'FYI',
+            etc...)
+        :param file_names: iterable of filenames to get the ids for.
+        :return: dictionary mapping each found file name to its import id.
+        """
+        data_source = data_source.upper()
+        import_ids = {}
+        missing = []
+        for file_name in set(file_names):
+            import_id = self.import_id_cache.get(
+                (media_schema, table_append, data_source, file_name))
+            if import_id is None:
+                missing.append(file_name)
+            else:
+                import_ids[file_name] = import_id
+        if not missing:
+            return import_ids
+
+        query = """SELECT id, file_name
+            FROM %(media_schema)s.imports%(table_append)s
+            WHERE source = %(data_source)s AND file_name IN %(file_names)s"""
+        res = self.execute_sql(
+            query,
+            {
+                'media_schema': no_quotes(media_schema),
+                'data_source': data_source,
+                'file_names': tuple(missing),
+                'table_append': no_quotes(table_append),
+            },
+            return_results=True,
+            read_only=True)
+        import_ids.update(self.cache_import_ids(
+            media_schema,
+            data_source,
+            [(row['id'], row['file_name']) for row in res],
+            table_append))
+        return import_ids
+
+    def cache_import_ids(
+            self,
+            media_schema,
+            data_source,
+            rows,
+            table_append=''):
+        """Caches (import id, file name) pairs read from an imports table.
+        :param rows: iterable of (import id, file name) pairs.
+        :return: dictionary mapping each file name to its import id.
+        """
+        data_source = data_source.upper()
+        import_ids = {}
+        for import_id, file_name in rows:
+            if file_name in import_ids:
+                msg = '{} is associated with multiple import records'.format(
+                    file_name)
                 logging.critical(msg)
                 raise Exception(msg)
-            else:
-                import_id = res[0]['id']
-                # Cache the import_id for future calls.
-                if cache_key not in self.cache:
-                    self.cache[cache_key] = {}
-                self.cache[cache_key][file_name] = import_id
-                return import_id
+            import_ids[file_name] = import_id
+        self.import_id_cache.update(
+            ((media_schema, table_append, data_source, file_name), import_id)
+            for file_name, import_id in import_ids.iteritems())
+        return import_ids
+
+    def import_id_cache_stats(self):
+        """Returns hit, miss and eviction counts of the import id cache."""
+        return self.import_id_cache.stats()
 
     def update_media_import(
             self,
@@ -266,30 +1060,25 @@ class DbConnection(object):
         :return: the import id that was created or found. None if error.
         """
         data_source = data_source.upper()
+        # A lagging replica could miss the record and cause a duplicate.
         import_id = self.get_media_import_id(
-            media_schema, data_source, file_name, table_append)
+            media_schema, data_source, file_name, table_append,
+            read_only=False)
 
         if import_id is None and (status.upper() in ('STARTED', 'SKIPPED')):
             # New 'STARTED' imports record.
-            query = """
-                INSERT INTO %(media_schema)s.imports%(table_append)s
-                    (file_name, source, file_date, status, file_path)
-                VALUES (%(file_name)s, %(data_source)s,
-                    %(file_date)s, %(status)s, %(file_path)s);"""
-            self.execute_sql(
-                query,
-                {
-                    'media_schema': no_quotes(media_schema),
-                    'file_name': file_name,
-                    'data_source': data_source,
-                    'file_date': file_date,
-                    'status': status.upper(),
-                    'table_append': no_quotes(table_append),
-                    'file_path': file_path,
-                })
+            self.execute_sql(*self._insert_import_query(
+                media_schema,
+                data_source,
+                file_name,
+                file_date,
+                status,
+                table_append,
+                file_path))
 
             import_id = self.get_media_import_id(
-                media_schema, data_source, file_name, table_append)
+                media_schema, data_source, file_name, table_append,
+                read_only=False)
         elif import_id is None:
             # Only 'STARTED' is a valid entry for a new imports record
             raise Exception(
@@ -297,23 +1086,52 @@ class DbConnection(object):
                 'exists yet.'.format(file_name, status))
         else:
             # Import record exists. Update it to the new status.
-            query = (
-                'UPDATE %(media_schema)s.imports%(table_append)s '
-                'SET status = %(status)s')
-            if status == 'STARTED':
-                # STARTED records get timestamped.
-                query += ', time_imported = GETDATE()'
-            query += ' WHERE id = %(import_id)s;'
-            self.execute_sql(
-                query,
-                {
-                    'media_schema': no_quotes(media_schema),
-                    'status': status,
-                    'import_id': import_id,
-                    'table_append': no_quotes(table_append),
-                })
+            self.execute_sql(*self._update_import_query(
+                media_schema, import_id, status, table_append))
         return import_id
 
+    @staticmethod
+    def _insert_import_query(
+            media_schema,
+            data_source,
+            file_name,
+            file_date,
+            status,
+            table_append,
+            file_path):
+        query = """
+            INSERT INTO %(media_schema)s.imports%(table_append)s
+                (file_name, source, file_date, status, file_path)
+            VALUES (%(file_name)s, %(data_source)s,
+                %(file_date)s, %(status)s, %(file_path)s);"""
+        params = {
+            'media_schema': no_quotes(media_schema),
+            'file_name': file_name,
+            'data_source': data_source,
+            'file_date': file_date,
+            'status': status.upper(),
+            'table_append': no_quotes(table_append),
+            'file_path': file_path,
+        }
+        return query, params
+
+    @staticmethod
+    def _update_import_query(media_schema, import_id, status, table_append):
+        query = (
+            'UPDATE %(media_schema)s.imports%(table_append)s '
+            'SET status = %(status)s')
+        if status == 'STARTED':
+            # STARTED records get timestamped.
+            query += ', time_imported = GETDATE()'
+        query += ' WHERE id = %(import_id)s;'
+        params = {
+            'media_schema': no_quotes(media_schema),
+            'status': status,
+            'import_id': import_id,
+            'table_append': no_quotes(table_append),
+        }
+        return query, params
+
     def update_media_imports(
             self,
             import_ids_list,
@@ -324,6 +1142,22 @@ class DbConnection(object):
             cursor.update_media_imports(
                 import_ids_list, new_status, media_schema, table_append)
 
+    def track_imports(
+            self,
+            media_schema,
+            data_source,
+            table_append='',
+            **kwargs):
+        """Returns an ImportTracker batching imports status changes.
+        :param media_schema: schema holding the imports table.
+        :param data_source: data source of the tracked files ('COMSCORE',
+            'FYI', etc...)
+        :param kwargs: max_pending / max_age flush limits.
+        """
+        from import_tracker import ImportTracker
+        return ImportTracker(
+            self, media_schema, data_source, table_append, **kwargs)
+
     def get_imported_files(self, media_schema, data_source, table_append=""):
         """Returns set of file names marked with 'SUCCESS' as their status.
         :param media_schema: schema holding the imports table.
@@ -331,22 +1165,42 @@ class DbConnection(object):
             'FYI', etc...)
         :return: set of relevant file names.
         """
-        data_source = data_source.upper()
+        query, params = self._imported_files_query(
+            media_schema, data_source, table_append)
+        res = self._read(query, params)
+
+        return set(row['file_name'] for row in res)
 
+    def iter_imported_files(
+            self,
+            media_schema,
+            data_source,
+            table_append='',
+            batch_size=10000):
+        """Streaming variant of get_imported_files.
+        :param media_schema: schema holding the imports table.
+        :param data_source: data source to restrict results to ('COMSCORE',
+            'FYI', etc...)
+        :param batch_size: number of rows fetched per round trip.
+        :return: generator of relevant file names.
+        """
+        query, params = self._imported_files_query(
+            media_schema, data_source, table_append)
+        for row in self.iter_sql(query, params, batch_size, read_only=True):
+            yield row['file_name']
+
+    @staticmethod
+    def _imported_files_query(media_schema, data_source, table_append):
         query = (
             "SELECT file_name FROM %(media_schema)s.imports%(table_append)s "
             "WHERE source = %(data_source)s AND (status = 'SUCCESS' OR "
-            "status = 'SKIPPED');")
-        res = self.execute_sql(
-            query,
-            {
-                'media_schema': no_quotes(media_schema),
-                'data_source': data_source,
-                'table_append': no_quotes(table_append),
-            },
-            return_results=True)
-
-        return set(row['file_name'] for row in res)
+            "status = 'SKIPPED')")
+        params = {
+            'media_schema': no_quotes(media_schema),
+            'data_source': data_source.upper(),
+            'table_append': no_quotes(table_append),
+        }
+        return query, params
 
     def run_ingest_queries(
             self,
@@ -355,7 +1209,9 @@ class DbConnection(object):
             sql_file,
             params,
             list_of_files,
-            table_append=''):
+            table_append='',
+            checkpoint=False,
+            use_savepoints=True):
         """Run the sql file and mark the files as 'SUCCEEDED'. Used to run
             final ingestion queries.
         :param media_schema: schema holding the imports table.
@@ -365,22 +1221,47 @@ class DbConnection(object):
         :param params: dictionary of values to use in the corresponding sql.
         :param list_of_files: list of filenames to update the imports
             records for
+        :param checkpoint: if True, run the file statement by statement,
+            checkpointing each one in the media_schema.ingest_checkpoints
+            table, so rerunning after a failure resumes at the failed
+            statement instead of the start of the file.
+        :param use_savepoints: with checkpoint, wrap each statement in a
+            SAVEPOINT. Set to False on Redshift, which lacks them.
         """
         data_source = data_source.upper()
         status = 'UNKNOWN'
         try:
-            self.execute_sql_file(sql_file, params)
+            if checkpoint:
+                from ingest_checkpoint import IngestCheckpointer
+                from ingest_checkpoint import ingest_run_key
+                checkpointer = IngestCheckpointer(
+                    self, media_schema, table_append,
+                    use_savepoints=use_savepoints)
+                checkpointer.run(sql_file, params, ingest_run_key(
+                    data_source, sql_file,
+                    [file_name for file_name, _ in list_of_files], params))
+            else:
+                self.execute_sql_file(sql_file, params)
             status = 'SUCCESS'
         except psycopg2.Error as err:
             logging.error('Failed to run ingest queries with error %s', err)
             status = 'FAIL'
             raise
         finally:
-            for file_name, file_date in list_of_files:
-                self.update_media_import(
+            # All statuses are written together in a few set-based
+            # statements rather than per file.
+            with self.track_imports(
                     media_schema,
                     data_source,
-                    file_name,
-                    file_date,
-                    status,
-                    table_append)
\ No newline at end of file
+                    table_append,
+                    max_pending=len(list_of_files) + 1) as tracker:
+                for file_name, file_date in list_of_files:
+                    tracker.record(file_name, file_date, status)
+
+
+def _replica_settings(info):
+    """Returns DbConnection replica settings from a yaml replica entry."""
+    settings = dict(info)
+    if 'username' in settings:
+        settings['user'] = settings.pop('username')
+    return settings
@@ -1,17 +1,45 @@
 import logging
 import db_connection
+import sql_cache
+import sql_dag
 import utils
 from utils import rel_path
 
 class Executive(object):
 
-    def __init__(self):
+    def __init__(self, max_workers=4):
         self.db_conn = db_connection.DbConnection.from_yaml(rel_path('config/database.yml'), 'larry')
+        self.max_workers = max_workers
+        # Compile every sql file up front rather than on each step's first
+        # run.
+        sql_cache.preload_dir(rel_path('sql'))
+        self.dag = self.declare_steps()
+
+    def declare_steps(self):
+        """Returns the SqlDag of this pipeline's sql steps."""
+        dag = sql_dag.SqlDag()
+        # sql1 opens the transaction sql2 rolls back, so they are one step.
+        dag.add_step(
+            'pipeline', [rel_path('sql/sql1.sql'), rel_path('sql/sql2.sql')])
+        return dag
 
     def run(self):
         print 'at the beginning of run'
-        self.do_sql1()
-        self.do_sql2()
+        # The whole pipeline shares one transaction on one connection.
+        self.db_conn.execute_sql_files(
+            [rel_path('sql/sql1.sql'), rel_path('sql/sql2.sql')])
+
+    def run_dag(self):
+        """Runs the declared steps, independent ones in parallel.
+        :return: ordered dictionary mapping step names to StepResults.
+        """
+        print 'at the beginning of run_dag'
+        results = self.dag.run(self.db_conn, self.max_workers)
+        for result in results.itervalues():
+            logging.info(
+                'Step %s: %s in %.3fs',
+                result.name, result.status, result.elapsed or 0)
+        return results
 
     def do_sql1(self):
         print 'at the beginning of sql1'
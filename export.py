@@ -0,0 +1,217 @@
+import gzip
+import logging
+import Queue
+import threading
+import time
+
+# Default number of bytes buffered before writing out.
+DEFAULT_CHUNK_SIZE = 1 << 20
+COMPRESSIONS = (None, 'gzip')
+
+
+class ExportStats(object):
+    """Rows, bytes, files and elapsed time of one export."""
+
+    def __init__(self, rows=0, num_bytes=0, files=(), elapsed=0.0):
+        self.rows = rows
+        self.bytes = num_bytes
+        self.files = list(files)
+        self.elapsed = elapsed
+
+    def merge(self, other):
+        """Adds the counts of another ExportStats to this one."""
+        self.rows += other.rows
+        self.bytes += other.bytes
+        self.files.extend(other.files)
+
+    def __str__(self):
+        return '{} rows, {} bytes, {} files in {:.2f}s'.format(
+            self.rows, self.bytes, len(self.files), self.elapsed)
+
+
+class ExportWriter(object):
+    """Writable target for COPY ... TO STDOUT.
+
+    psycopg2 writes one row per `write` call. Rows are buffered up to
+    chunk_size bytes and written out together. With a path template the
+    output rotates to a new file once max_bytes is reached, always on a row
+    boundary; otherwise everything goes to the given file object.
+    """
+
+    def __init__(
+            self,
+            dest,
+            chunk_size=DEFAULT_CHUNK_SIZE,
+            max_bytes=None,
+            compression=None,
+            path_fields=None):
+        """
+        :param dest: writable binary file object, or a path template
+            formatted with the file's rotation index, e.g.
+            '/data/users-{index:04d}.csv.gz'.
+        :param chunk_size: bytes buffered before writing out.
+        :param max_bytes: uncompressed bytes per file before rotating. Only
+            used with a path template.
+        :param compression: None or 'gzip'.
+        :param path_fields: extra fields used to format the path template.
+        """
+        if compression not in COMPRESSIONS:
+            raise ValueError('Unknown compression {!r}'.format(compression))
+        if not isinstance(dest, basestring) and not hasattr(dest, 'write'):
+            raise ValueError(
+                'Export dest must be a writable file object or a path '
+                'template, got {!r}'.format(dest))
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.compression = compression
+        self.stats = ExportStats()
+        self._path_template = dest if isinstance(dest, basestring) else None
+        self._path_fields = path_fields or {}
+        self._fileobj = None if self._path_template else dest
+        self._out = None
+        self._file_bytes = 0
+        self._parts = []
+        self._buffered = 0
+
+    def write(self, data):
+        if not isinstance(data, bytes):
+            data = data.encode('utf-8')
+        self._parts.append(data)
+        self._buffered += len(data)
+        self.stats.rows += 1
+        if self._buffered >= self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        if not self._parts:
+            return
+        if self._out is None or (
+                self._path_template is not None and
+                self.max_bytes is not None and
+                self._file_bytes >= self.max_bytes):
+            self._rotate()
+        data = b''.join(self._parts)
+        self._parts = []
+        self._buffered = 0
+        self._out.write(data)
+        self._file_bytes += len(data)
+        self.stats.bytes += len(data)
+
+    def close(self):
+        """Flushes buffered rows and closes any file opened by the writer.
+        A caller-provided file object is flushed but left open.
+        """
+        self.flush()
+        self._close_current()
+
+    def _rotate(self):
+        self._close_current()
+        if self._path_template is None:
+            target = self._fileobj
+            self._out = (
+                gzip.GzipFile(fileobj=target, mode='wb')
+                if self.compression == 'gzip' else target)
+        else:
+            path = self._path_template.format(
+                index=len(self.stats.files), **self._path_fields)
+            self.stats.files.append(path)
+            if self.compression == 'gzip':
+                self._out = gzip.open(path, 'wb')
+            else:
+                self._out = open(path, 'wb')
+        self._file_bytes = 0
+
+    def _close_current(self):
+        if self._out is None:
+            return
+        if self._out is self._fileobj:
+            self._out.flush()
+        else:
+            # Closing a GzipFile over a caller's file object writes the gzip
+            # trailer without closing the underlying file.
+            self._out.close()
+        self._out = None
+
+
+def copy_to_sql(select_query, copy_options=()):
+    """Returns a COPY (query) TO STDOUT statement.
+    :param select_query: fully interpolated query to export.
+    :param copy_options: COPY options, e.g. ('CSV', 'HEADER').
+    """
+    sql = 'COPY ({}) TO STDOUT'.format(select_query)
+    if copy_options:
+        sql += ' WITH ' + ' '.join(copy_options)
+    return sql
+
+
+def export_ranges(
+        db_conn,
+        query,
+        ranges,
+        path_template,
+        max_workers=4,
+        **writer_kwargs):
+    """Exports slices of a query concurrently. Slices are queued for
+    max_workers threads, each holding one connection at a time.
+    :param db_conn: DbConnection to export from. Should be pooled for the
+        slices to run concurrently.
+    :param query: sql string using %(range_start)s and %(range_end)s to
+        select one slice.
+    :param ranges: iterable of (range_start, range_end) pairs.
+    :param path_template: output path formatted with the slice number and
+        rotation index, e.g. '/data/users-{part:03d}-{index:04d}.csv'.
+    :param max_workers: threads exporting slices, and so the most
+        connections used at once.
+    :param writer_kwargs: ExportWriter and copy options (chunk_size,
+        max_bytes, compression, copy_options).
+    :return: combined ExportStats.
+    """
+    ranges = list(ranges)
+    copy_options = writer_kwargs.pop('copy_options', ('CSV',))
+    results = [None] * len(ranges)
+    errors = []
+    parts = Queue.Queue()
+    for part in range(len(ranges)):
+        parts.put(part)
+    started_at = time.time()
+
+    def export_part(part):
+        range_start, range_end = ranges[part]
+        try:
+            results[part] = db_conn.export_query(
+                query,
+                {'range_start': range_start, 'range_end': range_end},
+                path_template,
+                copy_options=copy_options,
+                path_fields={'part': part},
+                **writer_kwargs)
+        except Exception as err:
+            logging.error('Export of range %s failed: %s', ranges[part], err)
+            errors.append(err)
+
+    def worker():
+        while True:
+            try:
+                part = parts.get_nowait()
+            except Queue.Empty:
+                return
+            export_part(part)
+
+    # Each worker holds at most one connection at a time.
+    threads = [
+        threading.Thread(target=worker, name='export-{}'.format(idx))
+        for idx in range(max(1, min(max_workers, len(ranges))))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    if errors:
+        raise errors[0]
+
+    stats = ExportStats()
+    for result in results:
+        stats.merge(result)
+    stats.elapsed = time.time() - started_at
+    logging.info('Exported %s ranges: %s', len(ranges), stats)
+    return stats
@@ -0,0 +1,237 @@
+import logging
+import time
+import uuid
+
+from utils import no_quotes
+
+# Statuses allowed to create a new imports record.
+NEW_RECORD_STATUSES = ('STARTED', 'SKIPPED')
+
+
+class PendingImport(object):
+    """Merged, not yet written status change for one file."""
+
+    __slots__ = (
+        'file_name', 'file_date', 'status', 'file_path', 'stamp',
+        'may_create')
+
+    def __init__(self, file_name, file_date, status, file_path):
+        self.file_name = file_name
+        self.file_date = file_date
+        self.status = status
+        self.file_path = file_path
+        # STARTED records get their time_imported refreshed.
+        self.stamp = status == 'STARTED'
+        # Whether any merged status may create the record, as it would
+        # have had the changes been written one at a time.
+        self.may_create = status in NEW_RECORD_STATUSES
+
+    def merge(self, other):
+        """Merges other, an earlier change to the same file, into self."""
+        self.stamp = self.stamp or other.stamp
+        self.may_create = self.may_create or other.may_create
+        self.file_path = self.file_path or other.file_path
+
+
+class ImportTracker(object):
+    """Write-behind buffer of status changes to an imports table.
+
+    Changes are merged per file in memory and written with a handful of
+    set-based statements, instead of 2-3 round trips per file through
+    DbConnection.update_media_import. Pending changes are flushed when the
+    tracker is used as a context manager and exits, when `flush` is called,
+    or when max_pending / max_age is exceeded.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            media_schema,
+            data_source,
+            table_append='',
+            max_pending=1000,
+            max_age=30):
+        """
+        :param db_conn: DbConnection used for the writes.
+        :param media_schema: schema holding the imports table.
+        :param data_source: data source of the tracked files ('COMSCORE',
+            'FYI', etc...)
+        :param table_append: suffix of the imports table name.
+        :param max_pending: flush once this many files have pending changes.
+        :param max_age: flush once the oldest pending change is this many
+            seconds old. Checked whenever a change is recorded.
+        """
+        self.db_conn = db_conn
+        self.media_schema = media_schema
+        self.data_source = data_source.upper()
+        self.table_append = table_append
+        self.max_pending = max_pending
+        self.max_age = max_age
+        self._pending = {}
+        self._oldest = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        # Statuses recorded before a failure still describe what happened,
+        # so they are written either way.
+        self.flush()
+
+    def __len__(self):
+        return len(self._pending)
+
+    def record(self, file_name, file_date, status, file_path=''):
+        """Queues a status change for file_name. Later changes to the same
+        file overwrite the status of earlier ones.
+        :param file_name: filename to update the imports record for.
+        :param file_date: date associated with the file_name.
+        :param status: new status for the imports record.
+        :param file_path: path stored on newly created records.
+        """
+        status = status.upper()
+        pending = self._pending.get(file_name)
+        if pending is None:
+            self._pending[file_name] = PendingImport(
+                file_name, file_date, status, file_path)
+            if self._oldest is None:
+                self._oldest = time.time()
+        else:
+            pending.status = status
+            pending.stamp = pending.stamp or status == 'STARTED'
+            pending.may_create = (
+                pending.may_create or status in NEW_RECORD_STATUSES)
+            pending.file_path = file_path or pending.file_path
+
+        if (len(self._pending) >= self.max_pending or
+                time.time() - self._oldest >= self.max_age):
+            self.flush()
+
+    def flush(self):
+        """Writes every pending change in one transaction.
+        :return: dictionary mapping each flushed file name to its import id.
+        """
+        if not self._pending:
+            return {}
+        pending, self._pending = self._pending, {}
+        oldest, self._oldest = self._oldest, None
+        logging.info(
+            'Writing %s import status changes to %s.imports%s',
+            len(pending), self.media_schema, self.table_append)
+        try:
+            rows = self._write(pending)
+        except Exception:
+            self._restore(pending, oldest)
+            raise
+        return self.db_conn.cache_import_ids(
+            self.media_schema,
+            self.data_source,
+            [(row[0], row[1]) for row in rows],
+            self.table_append)
+
+    def discard(self, file_names):
+        """Drops the pending changes of file_names, e.g. those a failed
+        flush put back, so they are never written.
+        :param file_names: iterable of file names.
+        """
+        for file_name in file_names:
+            self._pending.pop(file_name, None)
+        if not self._pending:
+            self._oldest = None
+
+    def _restore(self, pending, oldest):
+        """Puts the changes of a failed flush back, under any recorded
+        since, so they are written by the next flush.
+        """
+        for file_name, change in pending.iteritems():
+            later = self._pending.get(file_name)
+            if later is None:
+                self._pending[file_name] = change
+            else:
+                later.merge(change)
+        if self._oldest is None or oldest < self._oldest:
+            self._oldest = oldest
+
+    def _write(self, pending):
+        """Writes pending changes in one transaction.
+        :return: list of (import id, file name) rows of the changed files.
+        """
+        staging = 'imports_staging_{}'.format(uuid.uuid4().hex[:12])
+        params = {
+            'imports': no_quotes('{}.imports{}'.format(
+                self.media_schema, self.table_append)),
+            'staging': no_quotes(staging),
+            'data_source': self.data_source,
+        }
+        with self.db_conn.transaction() as cursor:
+            # CTAS on an empty select copies the imports column types.
+            cursor.execute(
+                """
+                CREATE TEMP TABLE %(staging)s AS
+                SELECT file_name, file_date, status, file_path, time_imported,
+                    TRUE AS may_create
+                FROM %(imports)s WHERE 1 = 0
+                """,
+                params)
+            cursor.execute_values(
+                'INSERT INTO {} (file_name, file_date, status, file_path, '
+                'time_imported, may_create) VALUES %s'.format(staging),
+                [(p.file_name, p.file_date, p.status, p.file_path, p.stamp,
+                  p.may_create)
+                 for p in pending.itervalues()],
+                template=(
+                    '(%s, %s, %s, %s, CASE WHEN %s THEN GETDATE() END, %s)'))
+
+            # Only some statuses may create a record. A file merging, say,
+            # STARTED and SUCCESS may, as the STARTED would have.
+            cursor.execute(
+                """
+                SELECT s.file_name, s.status
+                FROM %(staging)s s
+                LEFT JOIN %(imports)s i
+                    ON i.source = %(data_source)s
+                    AND i.file_name = s.file_name
+                WHERE i.id IS NULL AND NOT s.may_create
+                """,
+                params)
+            invalid = cursor.fetchall()
+            if invalid:
+                raise Exception(
+                    'Cannot change status of {} to {}. No record '
+                    'exists yet.'.format(invalid[0][0], invalid[0][1]))
+
+            cursor.execute(
+                """
+                UPDATE %(imports)s
+                SET status = s.status,
+                    time_imported = COALESCE(
+                        s.time_imported, %(imports)s.time_imported)
+                FROM %(staging)s s
+                WHERE %(imports)s.source = %(data_source)s
+                    AND %(imports)s.file_name = s.file_name
+                """,
+                params)
+            cursor.execute(
+                """
+                INSERT INTO %(imports)s
+                    (file_name, source, file_date, status, file_path)
+                SELECT s.file_name, %(data_source)s, s.file_date, s.status,
+                    s.file_path
+                FROM %(staging)s s
+                WHERE NOT EXISTS (
+                    SELECT 1 FROM %(imports)s i
+                    WHERE i.source = %(data_source)s
+                        AND i.file_name = s.file_name)
+                """,
+                params)
+            cursor.execute(
+                """
+                SELECT i.id, i.file_name
+                FROM %(imports)s i
+                JOIN %(staging)s s ON i.file_name = s.file_name
+                WHERE i.source = %(data_source)s
+                """,
+                params)
+            rows = cursor.fetchall()
+            cursor.execute('DROP TABLE %(staging)s', params)
+        return rows
@@ -0,0 +1,238 @@
+import hashlib
+import logging
+import time
+
+import psycopg2
+
+import sql_cache
+from utils import no_quotes
+
+# Statements that would break the checkpointed transactions.
+TRANSACTION_CONTROL = (
+    'BEGIN', 'START', 'COMMIT', 'END', 'ROLLBACK', 'ABORT', 'SAVEPOINT',
+    'RELEASE')
+
+
+def statement_hash(statement):
+    return hashlib.md5(statement.encode('utf-8')).hexdigest()
+
+
+def ingest_run_key(data_source, sql_file, file_names, params=None):
+    """Returns a key identifying one ingest of file_names by sql_file with
+    params. A rerun with other params gets another key, so it doesn't
+    resume from statements run with the old values.
+    """
+    digest = hashlib.md5()
+    for file_name in sorted(file_names):
+        digest.update(file_name.encode('utf-8'))
+        digest.update(b'\n')
+    if params:
+        # Runs without params keep the keys they had before params counted.
+        digest.update(b'\0')
+        digest.update(_params_text(params).encode('utf-8'))
+    return '{}:{}:{}'.format(
+        data_source, sql_file, digest.hexdigest())[-256:]
+
+
+def _params_text(value):
+    """Returns a stable text form of sql params, for hashing. Dictionaries
+    are sorted, and no_quotes() values are represented by their text.
+    """
+    if isinstance(value, dict):
+        return u'{{{}}}'.format(u', '.join(
+            u'{}: {}'.format(_params_text(key), _params_text(value[key]))
+            for key in sorted(value)))
+    if isinstance(value, (list, tuple)):
+        return u'[{}]'.format(u', '.join(_params_text(item) for item in value))
+    # AsIs has no stable repr of its own.
+    value = getattr(value, 'adapted', value)
+    if isinstance(value, bytes):
+        # The same text as str or unicode hashes the same.
+        value = value.decode('utf-8', 'replace')
+    return repr(value).decode('utf-8', 'replace')
+
+
+class IngestCheckpointer(object):
+    """Runs a sql file statement by statement, recording each finished
+    statement in a checkpoint table so a failed run can resume where it
+    stopped.
+
+    Statements run on one connection in transactions of commit_every
+    statements. Each statement is wrapped in a SAVEPOINT: when one fails,
+    only it is rolled back, the statements before it in the transaction
+    are committed with their checkpoints, and the failure is recorded.
+    A rerun with the same run key then starts from the failed statement.
+    Checkpoints of a statement whose text changed since are ignored, so
+    an edited file resumes from its first edited statement.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            media_schema,
+            table_append='',
+            commit_every=1,
+            use_savepoints=True):
+        """
+        :param db_conn: DbConnection to run the statements on.
+        :param media_schema: schema holding the checkpoint table.
+        :param table_append: suffix of the checkpoint table name, as for
+            the imports table.
+        :param commit_every: statements per transaction.
+        :param use_savepoints: wrap each statement in a SAVEPOINT. Must be
+            False on servers without SAVEPOINT support, such as Redshift;
+            then commit_every is forced to 1.
+        """
+        self.db_conn = db_conn
+        self.table = '{}.ingest_checkpoints{}'.format(
+            media_schema, table_append)
+        self.use_savepoints = use_savepoints
+        self.commit_every = commit_every if use_savepoints else 1
+        self._table_ready = False
+
+    def create_table(self):
+        """Creates the checkpoint table if it doesn't exist."""
+        self.db_conn.execute_sql(
+            """
+            CREATE TABLE IF NOT EXISTS %(table)s (
+                run_key VARCHAR(256) NOT NULL,
+                statement_index INTEGER NOT NULL,
+                statement_hash VARCHAR(32) NOT NULL,
+                status VARCHAR(16) NOT NULL,
+                error VARCHAR(1024),
+                elapsed FLOAT,
+                finished_at TIMESTAMP
+            )""",
+            {'table': no_quotes(self.table)})
+        self._table_ready = True
+
+    def progress(self, run_key):
+        """Returns {statement index: (statement hash, status)} of a run."""
+        if not self._table_ready:
+            self.create_table()
+        rows = self.db_conn.execute_sql(
+            """
+            SELECT statement_index, statement_hash, status
+            FROM %(table)s WHERE run_key = %(run_key)s
+            """,
+            {'table': no_quotes(self.table), 'run_key': run_key},
+            return_results=True,
+            cache=False)
+        return {row[0]: (row[1], row[2]) for row in rows}
+
+    def reset(self, run_key):
+        """Forgets the checkpoints of a run."""
+        if not self._table_ready:
+            self.create_table()
+        self.db_conn.execute_sql(
+            'DELETE FROM %(table)s WHERE run_key = %(run_key)s',
+            {'table': no_quotes(self.table), 'run_key': run_key})
+
+    def run(self, sql_file, params, run_key, timeout=None,
+            keep_checkpoints=False):
+        """Runs the statements of sql_file not yet finished under run_key.
+        :param sql_file: path of sql file to execute.
+        :param params: dictionary of values to use in the sql.
+        :param run_key: identifies the run, e.g. from ingest_run_key.
+        :param timeout: seconds each statement may run. Defaults to the
+            connection's statement_timeout.
+        :param keep_checkpoints: if False, the run's checkpoints are deleted
+            once every statement finished.
+        :return: number of statements run, skipping resumed ones.
+        """
+        compiled = sql_cache.get_compiled(sql_file)
+        compiled.check_params(params)
+        statements = compiled.statements
+        for statement in statements:
+            first_word = sql_cache.first_keyword(statement)
+            if first_word in TRANSACTION_CONTROL:
+                raise ValueError(
+                    '{} controls transactions ({}), which checkpointed '
+                    'ingest manages itself'.format(sql_file, first_word))
+        hashes = [statement_hash(statement) for statement in statements]
+
+        done = self.progress(run_key)
+        start = 0
+        while start < len(statements) and (
+                done.get(start) == (hashes[start], 'DONE')):
+            start += 1
+        if start:
+            logging.info(
+                'Resuming %s at statement %s of %s',
+                sql_file, start + 1, len(statements))
+
+        if timeout is None:
+            timeout = self.db_conn.statement_timeout
+        with self.db_conn.connection() as conn:
+            autocommit = conn.autocommit
+            conn.autocommit = False
+            try:
+                with conn.cursor() as cursor:
+                    self._run_statements(
+                        conn, cursor, run_key, statements, hashes, start,
+                        params, timeout)
+            finally:
+                conn.rollback()
+                conn.autocommit = autocommit
+
+        if not keep_checkpoints:
+            self.reset(run_key)
+        return len(statements) - start
+
+    def _run_statements(
+            self, conn, cursor, run_key, statements, hashes, start, params,
+            timeout):
+        table = no_quotes(self.table)
+        for idx in range(start, len(statements)):
+            started_at = time.time()
+            if self.use_savepoints:
+                cursor.execute_raw('SAVEPOINT ingest_statement')
+            try:
+                # A SET made by the timeout is undone along with a failed
+                # statement.
+                with cursor.timeout(timeout):
+                    cursor.execute(statements[idx], params, dedent=False)
+            except psycopg2.Error as err:
+                if self.use_savepoints:
+                    cursor.execute_raw(
+                        'ROLLBACK TO SAVEPOINT ingest_statement')
+                else:
+                    conn.rollback()
+                logging.error(
+                    'Statement %s of ingest %s failed: %s',
+                    idx + 1, run_key, err)
+                self._record(
+                    cursor, table, run_key, idx, hashes[idx], 'FAILED',
+                    str(err).strip()[:1024], time.time() - started_at)
+                conn.commit()
+                raise
+            if self.use_savepoints:
+                cursor.execute_raw('RELEASE SAVEPOINT ingest_statement')
+            self._record(
+                cursor, table, run_key, idx, hashes[idx], 'DONE', None,
+                time.time() - started_at)
+            if (idx - start + 1) % self.commit_every == 0:
+                conn.commit()
+        conn.commit()
+
+    @staticmethod
+    def _record(
+            cursor, table, run_key, idx, stmt_hash, status, error, elapsed):
+        cursor.execute(
+            """
+            DELETE FROM %(table)s
+            WHERE run_key = %(run_key)s AND statement_index = %(idx)s;
+            INSERT INTO %(table)s (run_key, statement_index, statement_hash,
+                status, error, elapsed, finished_at)
+            VALUES (%(run_key)s, %(idx)s, %(hash)s, %(status)s, %(error)s,
+                %(elapsed)s, GETDATE())
+            """,
+            {
+                'table': table,
+                'run_key': run_key,
+                'idx': idx,
+                'hash': stmt_hash,
+                'status': status,
+                'error': error,
+                'elapsed': elapsed,
+            })
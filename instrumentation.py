@@ -0,0 +1,299 @@
+import bisect
+import hashlib
+import json
+import logging
+import re
+import threading
+import weakref
+
+# Upper bounds, in seconds, of the latency histogram buckets.
+DEFAULT_BUCKETS = (
+    0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5, 10, 30, 60, 300, 1800)
+
+_COMMENT_RE = re.compile(r'--[^\n]*|/\*.*?\*/', re.DOTALL)
+_LITERAL_RE = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+_IN_LIST_RE = re.compile(r'\(\s*\?(?:\s*,\s*\?)*\s*\)')
+_SPACE_RE = re.compile(r'\s+')
+
+
+def normalize_statement(query):
+    """Returns query with comments removed, literals replaced by '?' and
+    whitespace collapsed, so executions differing only in values match.
+    """
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    query = _COMMENT_RE.sub(' ', query)
+    query = _LITERAL_RE.sub('?', query)
+    query = _IN_LIST_RE.sub('(?)', query)
+    return _SPACE_RE.sub(' ', query).strip()
+
+
+def fingerprint(query):
+    """Returns a short stable hash of the normalized statement."""
+    normalized = normalize_statement(query)
+    return hashlib.md5(normalized.encode('utf-8')).hexdigest()[:16]
+
+
+class StatementEvent(object):
+    """Measurements of one execute, copy, upsert or commit."""
+
+    __slots__ = (
+        'kind', 'query', 'params', 'table', 'sql', 'wall_time', 'rowcount',
+        'bytes_sent', 'conn_wait', 'error', 'connection', '_fingerprint')
+
+    def __init__(self, kind, query=None, params=None, table=None,
+                 conn_wait=0.0):
+        self.kind = kind
+        self.query = query
+        self.params = params
+        self.table = table
+        # Statement text as sent to the server, with credentials redacted,
+        # set on 'execute' events.
+        self.sql = None
+        self.wall_time = None
+        self.rowcount = None
+        self.bytes_sent = None
+        self.conn_wait = conn_wait
+        self.error = None
+        # Connection the statement ran on, if known.
+        self.connection = None
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of the statement, or of the kind and table for
+        events without sql text.
+        """
+        if self._fingerprint is None:
+            text = self.query
+            if text is None:
+                text = '{} {}'.format(self.kind, self.table)
+            self._fingerprint = fingerprint(text)
+        return self._fingerprint
+
+
+class Hook(object):
+    """Base class for instrumentation hooks. Override either method."""
+
+    def before(self, event):
+        """Called before the statement runs. Only kind, query, params,
+        table and conn_wait are set.
+        """
+
+    def after(self, event):
+        """Called once the statement finished or failed."""
+
+
+class _CallableHook(Hook):
+
+    def __init__(self, callback):
+        self.callback = callback
+
+    def after(self, event):
+        self.callback(event)
+
+
+class Instrumentation(object):
+    """Registry of hooks run around every instrumented statement.
+    With no hooks registered, instrumentation costs a single check.
+    """
+
+    def __init__(self, parent=None):
+        """
+        :param parent: Instrumentation whose hooks also see the statements
+            reported here, e.g. the process-wide INSTRUMENTATION. Hooks
+            added here don't see the parent's statements.
+        """
+        self.parent = parent
+        # Hooks run on emit: the parent's, then our own.
+        self.hooks = []
+        self._own = []
+        self._children = weakref.WeakSet()
+        # Shared with the parent, as changes there rebuild our hooks.
+        self._lock = parent._lock if parent is not None else (
+            threading.Lock())
+        if parent is not None:
+            with self._lock:
+                parent._children.add(self)
+                self._refresh()
+
+    def add_hook(self, hook):
+        """Registers a Hook, or a callable run after each statement.
+        :return: the registered Hook, for remove_hook.
+        """
+        if not isinstance(hook, Hook):
+            hook = _CallableHook(hook)
+        with self._lock:
+            # Copy-on-write so emitting never needs the lock.
+            self._own = self._own + [hook]
+            self._refresh()
+        return hook
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._own = [h for h in self._own if h is not hook]
+            self._refresh()
+
+    def _refresh(self):
+        """Rebuilds hooks, and those of the children. Called holding the
+        lock.
+        """
+        parent_hooks = self.parent.hooks if self.parent is not None else []
+        self.hooks = parent_hooks + self._own
+        for child in list(self._children):
+            child._refresh()
+
+    def before(self, event):
+        for hook in self.hooks:
+            try:
+                hook.before(event)
+            except Exception:
+                logging.exception('Instrumentation hook failed')
+
+    def after(self, event):
+        for hook in self.hooks:
+            try:
+                hook.after(event)
+            except Exception:
+                logging.exception('Instrumentation hook failed')
+
+
+class Histogram(object):
+    """Fixed-bucket histogram."""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf.
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Returns (upper bound, cumulative count) pairs, ending at +Inf."""
+        total = 0
+        pairs = []
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            pairs.append((bound, total))
+        return pairs
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'buckets': [[str(b), c] for b, c in self.cumulative()],
+        }
+
+
+class _StatementStats(object):
+
+    def __init__(self, kind, sample, buckets):
+        self.kind = kind
+        self.sample = sample
+        self.latency = Histogram(buckets)
+        self.conn_wait = Histogram(buckets)
+        self.rows = 0
+        self.bytes_sent = 0
+        self.errors = 0
+
+
+class MetricsCollector(Hook):
+    """Hook aggregating events into per-statement histograms.
+    Statements are grouped by kind and fingerprint.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, sample_length=200):
+        """
+        :param buckets: latency histogram bucket upper bounds in seconds.
+        :param sample_length: characters of normalized sql kept per
+            statement as a readable sample.
+        """
+        self.buckets = buckets
+        self.sample_length = sample_length
+        self._stats = {}
+        self._lock = threading.Lock()
+
+    def after(self, event):
+        key = (event.kind, event.fingerprint)
+        with self._lock:
+            stats = self._stats.get(key)
+            if stats is None:
+                sample = normalize_statement(
+                    event.query or event.table or '')
+                stats = _StatementStats(
+                    event.kind, sample[:self.sample_length], self.buckets)
+                self._stats[key] = stats
+            stats.latency.observe(event.wall_time or 0.0)
+            stats.conn_wait.observe(event.conn_wait or 0.0)
+            if event.rowcount is not None and event.rowcount > 0:
+                stats.rows += event.rowcount
+            stats.bytes_sent += event.bytes_sent or 0
+            if event.error is not None:
+                stats.errors += 1
+
+    def reset(self):
+        with self._lock:
+            self._stats = {}
+
+    def as_dict(self):
+        """Returns the collected metrics, slowest statements first."""
+        with self._lock:
+            items = sorted(
+                self._stats.items(),
+                key=lambda item: item[1].latency.sum,
+                reverse=True)
+            return [
+                {
+                    'kind': stats.kind,
+                    'fingerprint': fp,
+                    'statement': stats.sample,
+                    'latency': stats.latency.as_dict(),
+                    'conn_wait': stats.conn_wait.as_dict(),
+                    'rows': stats.rows,
+                    'bytes_sent': stats.bytes_sent,
+                    'errors': stats.errors,
+                }
+                for (_, fp), stats in items
+            ]
+
+    def to_json(self, **json_kwargs):
+        return json.dumps(self.as_dict(), **json_kwargs)
+
+    def to_prometheus(self, prefix='amg'):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        for metric, help_text in (
+                ('statement_seconds', 'Statement wall time.'),
+                ('connection_wait_seconds', 'Time waiting for a connection.')):
+            lines.append('# HELP {}_{} {}'.format(prefix, metric, help_text))
+            lines.append('# TYPE {}_{} histogram'.format(prefix, metric))
+            for entry in self.as_dict():
+                labels = 'kind="{}",fingerprint="{}"'.format(
+                    entry['kind'], entry['fingerprint'])
+                hist = entry['latency' if metric == 'statement_seconds'
+                             else 'conn_wait']
+                for bound, count in hist['buckets']:
+                    lines.append('{}_{}_bucket{{{},le="{}"}} {}'.format(
+                        prefix, metric, labels, bound, count))
+                lines.append('{}_{}_sum{{{}}} {}'.format(
+                    prefix, metric, labels, hist['sum']))
+                lines.append('{}_{}_count{{{}}} {}'.format(
+                    prefix, metric, labels, hist['count']))
+        for metric, field in (
+                ('statement_rows_total', 'rows'),
+                ('statement_bytes_sent_total', 'bytes_sent'),
+                ('statement_errors_total', 'errors')):
+            lines.append('# TYPE {}_{} counter'.format(prefix, metric))
+            for entry in self.as_dict():
+                lines.append('{}_{}{{kind="{}",fingerprint="{}"}} {}'.format(
+                    prefix, metric, entry['kind'], entry['fingerprint'],
+                    entry[field]))
+        return '\n'.join(lines) + '\n'
+
+
+# Process-wide registry used by AmgCursor unless a cursor is given another.
+INSTRUMENTATION = Instrumentation()
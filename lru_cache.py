@@ -0,0 +1,87 @@
+import collections
+import threading
+import time
+
+
+class LruCache(object):
+    """Thread-safe LRU cache with an optional per-entry time-to-live.
+    Tracks hit, miss, eviction and expiration counts.
+    """
+
+    def __init__(self, max_size=10000, ttl=None):
+        """
+        :param max_size: maximum number of entries kept.
+        :param ttl: seconds an entry stays valid. Never expires if None.
+        """
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+        self._entries = collections.OrderedDict()  # key -> (value, expiry)
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, key, default=None):
+        """Returns the cached value for key, or default if absent/expired."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expiry = entry
+            if expiry is not None and expiry <= time.time():
+                self.expirations += 1
+                self.misses += 1
+                return default
+            # Re-insert to mark as most recently used.
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        """Caches value for key, evicting the least recently used entries
+        beyond max_size.
+        """
+        expiry = None if self.ttl is None else time.time() + self.ttl
+        with self._lock:
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expiry)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def update(self, items):
+        """Caches every (key, value) pair of the items iterable."""
+        for key, value in items:
+            self.put(key, value)
+
+    def invalidate(self, key):
+        """Drops key from the cache if present."""
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate_where(self, predicate):
+        """Drops every entry whose key satisfies predicate(key)."""
+        with self._lock:
+            for key in [k for k in self._entries if predicate(k)]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'max_size': self.max_size,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
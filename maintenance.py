@@ -0,0 +1,337 @@
+import collections
+import datetime
+import json
+import logging
+import re
+import threading
+import time
+
+from instrumentation import Hook
+from plan_capture import _Lent
+from result_cache import written_table_names
+
+# Redshift VACUUM variants. PostgreSQL only understands plain VACUUM here.
+VACUUM_MODES = ('FULL', 'SORT ONLY', 'DELETE ONLY', 'REINDEX', 'RECLUSTER')
+
+_DROP_RE = re.compile(r'^\s*(?:DROP\s+TABLE|TRUNCATE)\b', re.IGNORECASE)
+# EXPLAIN, e.g. of plan capture, names the tables without writing them.
+_EXPLAIN_RE = re.compile(r'^\s*EXPLAIN\b', re.IGNORECASE)
+_NAME_RE = re.compile(
+    r'^(?:"[^"]+"|[A-Za-z_][\w$]*)(?:\.(?:"[^"]+"|[A-Za-z_][\w$]*))*$')
+
+
+def _table_key(name):
+    return name.strip().lower()
+
+
+class MaintenanceRun(object):
+    """One ANALYZE or VACUUM the scheduler ran."""
+
+    def __init__(self, table, operation, statement, rows_changed):
+        self.table = table
+        self.operation = operation
+        self.statement = statement
+        self.rows_changed = rows_changed
+        self.started_at = None
+        self.elapsed = None
+        self.error = None
+
+    @property
+    def succeeded(self):
+        return self.error is None and self.elapsed is not None
+
+    def as_dict(self):
+        return {
+            'table': self.table,
+            'operation': self.operation,
+            'statement': self.statement,
+            'rows_changed': self.rows_changed,
+            'started_at': (
+                None if self.started_at is None
+                else datetime.datetime.fromtimestamp(
+                    self.started_at).isoformat()),
+            'elapsed': self.elapsed,
+            'error': None if self.error is None else str(self.error).strip(),
+        }
+
+    def __repr__(self):
+        return 'MaintenanceRun({!r}, {!r}, elapsed={})'.format(
+            self.table, self.statement, self.elapsed)
+
+
+class _TableWrites(object):
+
+    __slots__ = ('table', 'since_analyze', 'since_vacuum', 'pending')
+
+    def __init__(self, table):
+        self.table = table
+        self.since_analyze = 0
+        self.since_vacuum = 0
+        # Operations due, in the order they should run.
+        self.pending = []
+
+
+class MaintenanceScheduler(Hook):
+    """Instrumentation hook running ANALYZE and VACUUM on tables that had
+    many rows written to them.
+
+    Rows reported by upserts, COPYs and INSERT/UPDATE/DELETE statements
+    are added up per table. Once a table's total since its last ANALYZE
+    or VACUUM crosses analyze_rows or vacuum_rows, the operation is
+    scheduled. A background thread runs scheduled operations on an
+    autocommit connection during quiet windows: when no statement ran for
+    quiet_period seconds, and, if windows are given, within one of them.
+    Dropped and truncated tables are forgotten. Every operation run is
+    kept in `history`.
+
+    Like SlowQueryPlanCapture, the hook sees every statement of the
+    Instrumentation it is added to, so add it to the DbConnection's own,
+    as schedule_maintenance does.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            analyze_rows=100000,
+            vacuum_rows=1000000,
+            vacuum_mode=None,
+            vacuum_to_percent=None,
+            quiet_period=60,
+            windows=None,
+            check_interval=10,
+            timeout=None,
+            max_history=500):
+        """
+        :param db_conn: DbConnection the statements run on.
+        :param analyze_rows: rows written to a table before it is
+            ANALYZEd, or None to never ANALYZE.
+        :param vacuum_rows: rows written to a table before it is
+            VACUUMed, or None to never VACUUM.
+        :param vacuum_mode: Redshift VACUUM mode, one of VACUUM_MODES.
+        :param vacuum_to_percent: Redshift VACUUM threshold, e.g. 75 for
+            `VACUUM ... TO 75 PERCENT`.
+        :param quiet_period: seconds without statements before scheduled
+            operations start.
+        :param windows: optional list of (start, end) datetime.time tuples
+            of the local times maintenance may run. A window may wrap
+            around midnight.
+        :param check_interval: seconds between checks for a quiet window.
+        :param timeout: seconds each operation may run. Defaults to the
+            connection's statement_timeout.
+        :param max_history: MaintenanceRuns kept in history.
+        """
+        if vacuum_mode is not None and vacuum_mode.upper() not in (
+                VACUUM_MODES):
+            raise ValueError(
+                'Unknown vacuum_mode {!r}, expected one of {}'.format(
+                    vacuum_mode, ', '.join(VACUUM_MODES)))
+        self.db_conn = db_conn
+        self.analyze_rows = analyze_rows
+        self.vacuum_rows = vacuum_rows
+        self.vacuum_mode = vacuum_mode
+        self.vacuum_to_percent = vacuum_to_percent
+        self.quiet_period = quiet_period
+        self.windows = windows
+        self.check_interval = check_interval
+        self.timeout = timeout
+        self.history = collections.deque(maxlen=max_history)
+        self._tables = {}
+        self._last_activity = time.time()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        # Per thread: whether it runs maintenance, whose statements are not
+        # activity, and how many instrumented statements are running.
+        self._local = threading.local()
+        self._conn = None
+        self._worker = threading.Thread(
+            target=self._run, name='table-maintenance')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def before(self, event):
+        self._local.depth = getattr(self._local, 'depth', 0) + 1
+
+    def after(self, event):
+        depth = max(getattr(self._local, 'depth', 1) - 1, 0)
+        self._local.depth = depth
+        if depth or getattr(self._local, 'maintaining', False):
+            # Statements run by a copy or upsert are counted by its event.
+            return
+        self._last_activity = time.time()
+        if event.error is not None:
+            return
+        if event.table is not None:
+            if event.kind in ('copy', 'upsert'):
+                self.add_rows(event.table, event.rowcount)
+            return
+        sql = event.sql if event.kind == 'execute' else event.query
+        if event.kind not in ('execute', 'prepared') or not sql:
+            return
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        if _EXPLAIN_RE.match(sql):
+            return
+        tables = written_table_names(sql)
+        if _DROP_RE.match(sql):
+            self.forget(tables)
+        elif len(tables) == 1:
+            # The rowcount of a multi-table statement can't be split.
+            self.add_rows(tables[0], event.rowcount)
+
+    def add_rows(self, table, rows):
+        """Adds rows written to table, scheduling maintenance when a
+        threshold is crossed.
+        """
+        if not rows or rows < 0 or not _NAME_RE.match(table.strip()):
+            return
+        key = _table_key(table)
+        with self._lock:
+            writes = self._tables.get(key)
+            if writes is None:
+                writes = self._tables[key] = _TableWrites(table.strip())
+            writes.since_analyze += rows
+            writes.since_vacuum += rows
+            if (self.vacuum_rows is not None and
+                    writes.since_vacuum >= self.vacuum_rows and
+                    'VACUUM' not in writes.pending):
+                writes.pending.insert(0, 'VACUUM')
+            if (self.analyze_rows is not None and
+                    writes.since_analyze >= self.analyze_rows and
+                    'ANALYZE' not in writes.pending):
+                writes.pending.append('ANALYZE')
+
+    def forget(self, tables):
+        """Drops the counters and scheduled operations of tables."""
+        with self._lock:
+            for table in tables:
+                self._tables.pop(_table_key(table), None)
+
+    def pending(self):
+        """Returns (table, operation, rows changed) tuples of the scheduled
+        operations, busiest tables first.
+        """
+        with self._lock:
+            tables = sorted(
+                (w for w in self._tables.itervalues() if w.pending),
+                key=lambda w: w.since_vacuum,
+                reverse=True)
+            return [
+                (w.table, operation, w.since_vacuum
+                 if operation == 'VACUUM' else w.since_analyze)
+                for w in tables
+                for operation in w.pending
+            ]
+
+    def run_pending(self, force=False):
+        """Runs scheduled operations in the calling thread.
+        :param force: if False, stops once the database stops being quiet.
+        :return: list of the MaintenanceRuns.
+        """
+        runs = []
+        while force or self.is_quiet():
+            task = self._next_task()
+            if task is None:
+                break
+            runs.append(self._execute(*task))
+        return runs
+
+    def is_quiet(self):
+        """Returns true within a quiet window."""
+        if time.time() - self._last_activity < self.quiet_period:
+            return False
+        if not self.windows:
+            return True
+        now = datetime.datetime.now().time()
+        for start, end in self.windows:
+            if (start <= now < end if start <= end
+                    else now >= start or now < end):
+                return True
+        return False
+
+    def history_json(self, **json_kwargs):
+        return json.dumps(
+            [run.as_dict() for run in self.history], **json_kwargs)
+
+    def close(self):
+        """Stops the background thread and closes its own connection.
+        Scheduled operations that didn't run are dropped.
+        """
+        self._closed.set()
+        self._worker.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def vacuum_statement(self, table):
+        parts = ['VACUUM']
+        if self.vacuum_mode is not None:
+            parts.append(self.vacuum_mode.upper())
+        parts.append(table)
+        if self.vacuum_to_percent is not None:
+            parts.append('TO {:d} PERCENT'.format(int(self.vacuum_to_percent)))
+        return ' '.join(parts)
+
+    def _next_task(self):
+        """Pops the busiest table's next operation.
+        :return: tuple of (table, operation, rows changed) or None.
+        """
+        with self._lock:
+            tables = [w for w in self._tables.itervalues() if w.pending]
+            if not tables:
+                return None
+            writes = max(tables, key=lambda w: w.since_vacuum)
+            operation = writes.pending.pop(0)
+            # Counted from when the operation starts, so rows written
+            # while it runs count toward the next one.
+            if operation == 'VACUUM':
+                rows, writes.since_vacuum = writes.since_vacuum, 0
+            else:
+                rows, writes.since_analyze = writes.since_analyze, 0
+            return writes.table, operation, rows
+
+    def _execute(self, table, operation, rows):
+        statement = (
+            self.vacuum_statement(table) if operation == 'VACUUM'
+            else 'ANALYZE {}'.format(table))
+        run = MaintenanceRun(table, operation, statement, rows)
+        run.started_at = time.time()
+        self._local.maintaining = True
+        try:
+            with self._connection() as conn:
+                autocommit = conn.autocommit
+                # VACUUM can't run inside a transaction block.
+                conn.autocommit = True
+                try:
+                    with conn.cursor() as cursor:
+                        with cursor.timeout(self.timeout):
+                            cursor.execute_raw(statement)
+                finally:
+                    conn.autocommit = autocommit
+        except Exception as err:
+            run.error = err
+            logging.error('%s failed: %s', statement, err)
+        finally:
+            self._local.maintaining = False
+        run.elapsed = time.time() - run.started_at
+        if run.error is None:
+            logging.info(
+                '%s after %s rows changed took %.2fs',
+                statement, rows, run.elapsed)
+        self.history.append(run)
+        return run
+
+    def _run(self):
+        while not self._closed.wait(self.check_interval):
+            while self.is_quiet() and not self._closed.is_set():
+                task = self._next_task()
+                if task is None:
+                    break
+                self._execute(*task)
+
+    def _connection(self):
+        if self.db_conn.is_pooled():
+            return self.db_conn.connection()
+        if self._conn is None or self._conn.closed:
+            self._conn = self.db_conn._open_connection()
+        return _Lent(self._conn)
+
@@ -0,0 +1,482 @@
+import logging
+import Queue
+import threading
+import time
+import uuid
+
+# Stages of PipelinedIngest, in the order batches go through them.
+STAGES = ('copy', 'upsert', 'status')
+
+
+class IngestBatch(object):
+    """Files loaded together: COPYed into one staging table, upserted and
+    marked in the imports table as a unit.
+    """
+
+    def __init__(self, s3_prefixes, files):
+        """
+        :param s3_prefixes: prefix, or list of prefixes, of the files to
+            COPY.
+        :param files: list of (file_name, file_date) tuples whose imports
+            records are updated once the batch is loaded.
+        """
+        if isinstance(s3_prefixes, basestring):
+            s3_prefixes = [s3_prefixes]
+        self.s3_prefixes = list(s3_prefixes)
+        self.files = list(files)
+        self.staging_table = None
+        self.copied = None
+        self.updated = None
+        self.inserted = None
+        self.error = None
+        self.failed_stage = None
+
+    @property
+    def succeeded(self):
+        return self.error is None
+
+    def __repr__(self):
+        return 'IngestBatch({!r}, files={}, error={!r})'.format(
+            self.s3_prefixes, len(self.files), self.error)
+
+
+class StageStats(object):
+    """Work done by one pipeline stage.
+
+    busy is the time spent processing batches, summed over the stage's
+    workers. blocked is the time spent waiting for room in the next
+    stage's queue, and starved the time spent waiting for work: a stage
+    that is mostly blocked is faster than the one after it.
+    """
+
+    def __init__(self, name, concurrency):
+        self.name = name
+        self.concurrency = concurrency
+        self.batches = 0
+        self.files = 0
+        self.rows = 0
+        self.errors = 0
+        self.busy = 0.0
+        self.blocked = 0.0
+        self.starved = 0.0
+        self.started_at = None
+        self.finished_at = None
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.time()) - self.started_at
+
+    @property
+    def files_per_second(self):
+        return self.files / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.rows / self.elapsed if self.elapsed else 0.0
+
+    @property
+    def utilization(self):
+        """Fraction of the stage's worker time spent processing."""
+        capacity = self.elapsed * self.concurrency
+        return self.busy / capacity if capacity else 0.0
+
+    def as_dict(self):
+        return {
+            'stage': self.name,
+            'concurrency': self.concurrency,
+            'batches': self.batches,
+            'files': self.files,
+            'rows': self.rows,
+            'errors': self.errors,
+            'elapsed': self.elapsed,
+            'busy': self.busy,
+            'blocked': self.blocked,
+            'starved': self.starved,
+            'files_per_second': self.files_per_second,
+            'rows_per_second': self.rows_per_second,
+            'utilization': self.utilization,
+        }
+
+    def __str__(self):
+        return (
+            '{}: {} batches, {} files, {} rows in {:.2f}s '
+            '({:.1f} files/s, {:.0f} rows/s, {:.0%} busy, '
+            '{:.2f}s blocked, {} errors)'.format(
+                self.name, self.batches, self.files, self.rows,
+                self.elapsed, self.files_per_second, self.rows_per_second,
+                self.utilization, self.blocked, self.errors))
+
+    def add(self, batch, rows, busy, error):
+        """Counts one processed batch."""
+        with self._lock:
+            self.batches += 1
+            self.files += len(batch.files)
+            self.rows += max(rows or 0, 0)
+            self.busy += busy
+            if error is not None:
+                self.errors += 1
+
+    def waited(self, wait, seconds):
+        """Adds seconds to the 'blocked' or 'starved' time."""
+        with self._lock:
+            setattr(self, wait, getattr(self, wait) + seconds)
+
+
+class PipelinedIngest(object):
+    """Loads batches of files through overlapping COPY, upsert and imports
+    status stages.
+
+    Batches flow through bounded queues, so while batch N is upserted,
+    batch N+1 is copied and batch N-1's statuses are written. A full queue
+    blocks the stage feeding it, and batches are only pulled from the input
+    iterable as the copy stage has room for them. Each copy and upsert
+    worker holds its own pooled connection for the whole run; the status
+    stage writes through an ImportTracker.
+
+    Every batch in flight gets its own staging table, created LIKE
+    staging_table and dropped when the run ends. A failed COPY or upsert
+    fails only its batch, whose files are marked FAIL. A batch whose
+    statuses can't be written fails too.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            s3_conn,
+            target_table,
+            staging_table,
+            uniqueness_keys,
+            col_list,
+            media_schema,
+            data_source,
+            table_append='',
+            columns=None,
+            copy_options=(),
+            copy_concurrency=2,
+            upsert_concurrency=1,
+            queue_size=2,
+            upsert_kwargs=None):
+        """
+        :param db_conn: pooled DbConnection. Its pool_max_size must allow
+            copy_concurrency + upsert_concurrency + 1 connections.
+        :param s3_conn: S3Connection object that holds the files.
+        :param target_table: table being upserted into.
+        :param staging_table: table the per-batch staging tables are
+            created LIKE.
+        :param uniqueness_keys: see AmgCursor.upsert.
+        :param col_list: see AmgCursor.upsert.
+        :param media_schema: schema holding the imports table.
+        :param data_source: data source of the files ('COMSCORE', 'FYI',
+            etc...)
+        :param table_append: suffix of the imports table name.
+        :param columns: list of columns to use for the COPY statements.
+        :param copy_options: additional Redshift COPY options.
+        :param copy_concurrency: batches copied at once.
+        :param upsert_concurrency: batches upserted at once. Only raise it
+            when batches never share uniqueness keys.
+        :param queue_size: batches waiting between two stages.
+        :param upsert_kwargs: other AmgCursor.upsert options, such as
+            strategy or has_timestamps.
+        """
+        needed = copy_concurrency + upsert_concurrency + 1
+        if not db_conn.is_pooled() or db_conn.pool_max_size < needed:
+            raise ValueError(
+                'PipelinedIngest needs a pooled DbConnection with '
+                'pool_max_size of at least {}'.format(needed))
+        self.db_conn = db_conn
+        self.s3_conn = s3_conn
+        self.target_table = target_table
+        self.staging_table = staging_table
+        self.uniqueness_keys = uniqueness_keys
+        self.col_list = col_list
+        self.media_schema = media_schema
+        self.data_source = data_source.upper()
+        self.table_append = table_append
+        self.columns = columns
+        self.copy_options = copy_options
+        self.copy_concurrency = copy_concurrency
+        self.upsert_concurrency = upsert_concurrency
+        self.queue_size = queue_size
+        self.upsert_kwargs = upsert_kwargs or {}
+        self.stats = {}
+
+    def run(self, batches):
+        """Loads every batch.
+        :param batches: iterable of IngestBatch objects. Consumed lazily.
+        :return: list of the IngestBatches, in the order they finished.
+            Failures are reported in them rather than raised.
+        """
+        self.stats = {
+            'copy': StageStats('copy', self.copy_concurrency),
+            'upsert': StageStats('upsert', self.upsert_concurrency),
+            'status': StageStats('status', 1),
+        }
+        batches = iter(batches)
+        batches_lock = threading.Lock()
+        upsert_q = Queue.Queue(self.queue_size)
+        status_q = Queue.Queue(self.queue_size)
+        # Every batch between the start of its COPY and the end of its
+        # upsert holds a staging table, which caps the batches in flight.
+        staging = Queue.Queue()
+        # Suffixed per run, so concurrent runs sharing a staging_table
+        # don't load into or drop each other's tables.
+        run_id = uuid.uuid4().hex[:8]
+        staging_tables = [
+            '{}_{}_p{}'.format(self.staging_table, run_id, idx)
+            for idx in range(
+                self.copy_concurrency + self.queue_size +
+                self.upsert_concurrency)
+        ]
+        for table in staging_tables:
+            self.db_conn.execute_sql(
+                'CREATE TABLE {} (LIKE {})'.format(
+                    table, self.staging_table))
+            staging.put(table)
+        done = []
+
+        def next_batch():
+            with batches_lock:
+                return next(batches, None)
+
+        def copy_worker(cursor, stats):
+            while True:
+                # A free staging table means the upsert stage has room.
+                table = _get(staging, stats, 'blocked')
+                batch = _get_batch(next_batch, stats)
+                if batch is None:
+                    staging.put(table)
+                    return
+                batch.staging_table = table
+                # The upsert stage must see every batch, failed or not, to
+                # free its staging table.
+                try:
+                    self._copy(cursor, batch, stats)
+                except Exception as err:
+                    if batch.error is None:
+                        self._fail(None, batch, 'copy', err)
+                    raise
+                finally:
+                    _put(upsert_q, batch, stats)
+
+        def upsert_worker(cursor, stats):
+            while True:
+                batch = _get(upsert_q, stats)
+                if batch is None:
+                    return
+                try:
+                    self._upsert(cursor, batch, stats)
+                except Exception as err:
+                    if batch.error is None:
+                        self._fail(None, batch, 'upsert', err)
+                    raise
+                finally:
+                    staging.put(batch.staging_table)
+                    _put(status_q, batch, stats)
+
+        def status_worker(_, stats):
+            with self.db_conn.track_imports(
+                    self.media_schema,
+                    self.data_source,
+                    self.table_append,
+                    max_pending=float('inf'),
+                    max_age=float('inf')) as tracker:
+                while True:
+                    batch = _get(status_q, stats)
+                    if batch is None:
+                        return
+                    self._write_status(tracker, batch, stats)
+                    done.append(batch)
+
+        threads = (
+            self._start_stage(
+                'copy', self.copy_concurrency, copy_worker, upsert_q,
+                self.upsert_concurrency) +
+            self._start_stage(
+                'upsert', self.upsert_concurrency, upsert_worker, status_q,
+                1) +
+            self._start_stage('status', 1, status_worker))
+        try:
+            for thread in threads:
+                thread.join()
+        finally:
+            self.db_conn.drop_tables(staging_tables)
+
+        for name in STAGES:
+            logging.info('Pipelined ingest %s', self.stats[name])
+        failed = [batch for batch in done if not batch.succeeded]
+        logging.info(
+            'Pipelined ingest finished: %s batches loaded, %s failed',
+            len(done) - len(failed), len(failed))
+        return done
+
+    def _start_stage(
+            self, name, concurrency, worker, next_q=None, next_workers=0):
+        """Starts the stage's worker threads. Copy and upsert workers get a
+        cursor on a connection of their own. Once the last worker exits,
+        one None per next-stage worker is queued to stop them. A worker
+        that fails leaves its batches to the others; when none is left,
+        the remaining batches are failed.
+        """
+        stats = self.stats[name]
+        stats.started_at = time.time()
+        remaining = [concurrency]
+        lock = threading.Lock()
+
+        def run():
+            error = None
+            try:
+                if name == 'status':
+                    worker(None, stats)
+                else:
+                    with self.db_conn.connection() as conn:
+                        with conn.cursor() as cursor:
+                            worker(cursor, stats)
+            except Exception as err:
+                logging.exception('Pipelined ingest %s worker failed', name)
+                error = err
+            with lock:
+                remaining[0] -= 1
+                last = remaining[0] == 0
+            if not last:
+                return
+            try:
+                if error is not None:
+                    # No worker of the stage is left, so the batches still
+                    # coming fail and the stages after it can finish.
+                    worker(_NoConnection(error), stats)
+            finally:
+                stats.finished_at = time.time()
+                for _ in range(next_workers):
+                    next_q.put(None)
+
+        threads = [
+            threading.Thread(target=run, name='ingest-{}-{}'.format(name, idx))
+            for idx in range(concurrency)
+        ]
+        for thread in threads:
+            thread.daemon = True
+            thread.start()
+        return threads
+
+    def _copy(self, cursor, batch, stats):
+        started_at = time.time()
+        rows = 0
+        try:
+            if isinstance(cursor, _NoConnection):
+                raise cursor.error
+            cursor.execute('TRUNCATE {}'.format(batch.staging_table))
+            for s3_prefix in batch.s3_prefixes:
+                cursor.execute_copy(
+                    batch.staging_table,
+                    self.s3_conn,
+                    s3_prefix,
+                    self.columns,
+                    self.copy_options)
+                rows += max(cursor.rowcount, 0)
+            batch.copied = rows
+        except Exception as err:
+            self._fail(cursor, batch, 'copy', err)
+        stats.add(batch, rows, time.time() - started_at, batch.error)
+
+    def _upsert(self, cursor, batch, stats):
+        if batch.error is not None:
+            return
+        started_at = time.time()
+        if isinstance(cursor, _NoConnection):
+            self._fail(None, batch, 'upsert', cursor.error)
+            stats.add(batch, 0, time.time() - started_at, batch.error)
+            return
+        conn = cursor.connection
+        autocommit = conn.autocommit
+        # The UPDATE and INSERT of a batch commit together.
+        conn.autocommit = False
+        try:
+            batch.updated, batch.inserted = cursor.upsert(
+                batch.staging_table,
+                self.target_table,
+                self.uniqueness_keys,
+                self.col_list,
+                **self.upsert_kwargs)
+            conn.commit()
+        except Exception as err:
+            self._fail(cursor, batch, 'upsert', err)
+        finally:
+            # Setting it on a closed connection would raise.
+            if not conn.closed:
+                conn.autocommit = autocommit
+        stats.add(
+            batch, (batch.updated or 0) + (batch.inserted or 0),
+            time.time() - started_at, batch.error)
+
+    def _write_status(self, tracker, batch, stats):
+        started_at = time.time()
+        status = 'SUCCESS' if batch.error is None else 'FAIL'
+        error = None
+        try:
+            for file_name, file_date in batch.files:
+                tracker.record(file_name, file_date, status)
+            tracker.flush()
+        except Exception as err:
+            logging.error(
+                'Could not mark %s files %s: %s',
+                len(batch.files), status, err)
+            error = err
+            # The tracker put the changes back for its next flush. They are
+            # dropped, so the stored statuses match the failed batch.
+            tracker.discard(file_name for file_name, _ in batch.files)
+            # A loaded batch whose statuses weren't written didn't succeed.
+            if batch.error is None:
+                batch.error = err
+                batch.failed_stage = 'status'
+        stats.add(batch, len(batch.files), time.time() - started_at, error)
+
+    @staticmethod
+    def _fail(cursor, batch, stage, err):
+        logging.error(
+            'Pipelined ingest %s of %s failed: %s',
+            stage, batch.s3_prefixes, err)
+        batch.error = err
+        batch.failed_stage = stage
+        conn = getattr(cursor, 'connection', None)
+        if conn is None:
+            return
+        try:
+            if not conn.autocommit:
+                conn.rollback()
+        except Exception as rollback_err:
+            # Likely the connection the batch failed on is gone.
+            logging.error(
+                'Rollback after failed %s of %s failed: %s',
+                stage, batch.s3_prefixes, rollback_err)
+
+
+class _NoConnection(object):
+    """Stands in for the cursor of a worker that lost its connection."""
+
+    def __init__(self, error):
+        self.error = error
+
+
+def _get(queue, stats, wait='starved'):
+    """Takes the next item of queue, adding the wait to stats."""
+    waited_at = time.time()
+    item = queue.get()
+    stats.waited(wait, time.time() - waited_at)
+    return item
+
+
+def _get_batch(next_batch, stats):
+    waited_at = time.time()
+    batch = next_batch()
+    stats.waited('starved', time.time() - waited_at)
+    return batch
+
+
+def _put(queue, item, stats):
+    """Puts item in queue, counting the wait as blocked."""
+    waited_at = time.time()
+    queue.put(item)
+    stats.waited('blocked', time.time() - waited_at)
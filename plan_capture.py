@@ -0,0 +1,311 @@
+import collections
+import json
+import logging
+import Queue
+import random
+import re
+import threading
+import time
+
+from instrumentation import Hook
+from sql_cache import first_keyword
+from sql_cache import split_statements
+
+# Statements EXPLAIN accepts. Others (DDL, COPY, EXECUTE, ...) are skipped.
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH', 'VALUES')
+# Parameter names whose values are never stored.
+SECRET_PARAMS = ('aws_creds', 'password', 'credentials', 'secret', 'token')
+REDACTED = '<redacted>'
+
+_SECRET_SQL_RES = [
+    re.compile(r"(CREDENTIALS\s+)'(?:[^']|'')*'", re.IGNORECASE),
+    re.compile(r"(PASSWORD\s+)'(?:[^']|'')*'", re.IGNORECASE),
+    re.compile(r'(aws_secret_access_key=)[^;\'"\s]*', re.IGNORECASE),
+]
+_SECRET_VALUE_RE = re.compile(r'aws_secret_access_key=', re.IGNORECASE)
+
+
+def redact_sql(query):
+    """Returns query with credentials and passwords replaced."""
+    for secret_re in _SECRET_SQL_RES:
+        query = secret_re.sub(r"\1'{}'".format(REDACTED), query)
+    return query
+
+
+def redact_params(params):
+    """Returns a copy of params safe to store. Values of SECRET_PARAMS
+    keys, and strings holding AWS secrets, are replaced.
+    """
+    if params is None:
+        return None
+
+    def redact_value(value):
+        if isinstance(value, basestring) and _SECRET_VALUE_RE.search(value):
+            return REDACTED
+        return value if isinstance(
+            value, (basestring, int, long, float, bool, type(None))) else (
+                repr(value))
+
+    if isinstance(params, dict):
+        return {
+            key: REDACTED if any(
+                secret in key.lower() for secret in SECRET_PARAMS)
+            else redact_value(value)
+            for key, value in params.iteritems()
+        }
+    return [redact_value(value) for value in params]
+
+
+def hide_secrets(params):
+    """Returns params with the values redact_params treats as secret
+    replaced, and every other value left as is, so the statement can still
+    be interpolated. params itself is returned if it holds no secret.
+    """
+    if isinstance(params, dict):
+        secret = [
+            key for key, value in params.iteritems()
+            if _is_secret_value(value) or any(
+                name in key.lower() for name in SECRET_PARAMS)
+        ]
+        if not secret:
+            return params
+        hidden = dict(params)
+        for key in secret:
+            hidden[key] = REDACTED
+        return hidden
+    if isinstance(params, (list, tuple)) and any(
+            _is_secret_value(value) for value in params):
+        return [
+            REDACTED if _is_secret_value(value) else value
+            for value in params
+        ]
+    return params
+
+
+def _is_secret_value(value):
+    # no_quotes() values wrap their text in `adapted`.
+    value = getattr(value, 'adapted', value)
+    return isinstance(value, basestring) and bool(
+        _SECRET_VALUE_RE.search(value))
+
+
+def is_explainable(statement):
+    """Returns true if EXPLAIN can be run on statement."""
+    return first_keyword(statement) in EXPLAINABLE
+
+
+class CapturedPlan(object):
+    """Plan of one slow statement."""
+
+    def __init__(self, fingerprint, kind, query, params, wall_time):
+        self.fingerprint = fingerprint
+        self.kind = kind
+        self.query = query
+        self.params = params
+        self.wall_time = wall_time
+        self.captured_at = time.time()
+        # One list of plan lines per explainable statement of query.
+        self.plans = []
+        self.errors = []
+
+    def as_dict(self):
+        return {
+            'fingerprint': self.fingerprint,
+            'kind': self.kind,
+            'query': self.query,
+            'params': self.params,
+            'wall_time': self.wall_time,
+            'captured_at': self.captured_at,
+            'plans': self.plans,
+            'errors': self.errors,
+        }
+
+
+class PlanStore(object):
+    """Bounded in-memory store of CapturedPlans, oldest dropped first."""
+
+    def __init__(self, max_plans=200):
+        self._plans = collections.deque(maxlen=max_plans)
+        self._lock = threading.Lock()
+
+    def add(self, plan):
+        with self._lock:
+            self._plans.append(plan)
+
+    def plans(self, fingerprint=None):
+        """Returns the stored plans, newest first, optionally only those of
+        one statement fingerprint.
+        """
+        with self._lock:
+            plans = list(reversed(self._plans))
+        if fingerprint is not None:
+            plans = [p for p in plans if p.fingerprint == fingerprint]
+        return plans
+
+    def to_json(self, **json_kwargs):
+        return json.dumps(
+            [plan.as_dict() for plan in self.plans()], **json_kwargs)
+
+
+class SlowQueryPlanCapture(Hook):
+    """Instrumentation hook capturing the plan of slow statements.
+
+    Statements slower than threshold are sampled, rate limited, and
+    EXPLAINed by a background thread on a separate connection: a pooled
+    one when the DbConnection is pooled, otherwise one dedicated to the
+    capture. Plans are kept in a PlanStore with redacted parameters.
+
+    The hook sees every statement of the Instrumentation it is added to,
+    so add it to the DbConnection's own, as capture_slow_plans does, not
+    to the process-wide one.
+    """
+
+    def __init__(
+            self,
+            db_conn,
+            threshold=5.0,
+            sample_rate=1.0,
+            max_per_minute=6,
+            min_interval=300,
+            store=None,
+            kinds=('execute', 'prepared'),
+            queue_size=100):
+        """
+        :param db_conn: DbConnection the statements run on.
+        :param threshold: seconds a statement must run to be captured.
+        :param sample_rate: fraction of slow statements considered.
+        :param max_per_minute: maximum captures across all statements.
+        :param min_interval: seconds before the same fingerprint is
+            captured again.
+        :param store: PlanStore receiving the plans. A new one by default.
+        :param kinds: StatementEvent kinds considered.
+        :param queue_size: captures waiting for the background thread
+            before new ones are dropped.
+        """
+        self.db_conn = db_conn
+        self.threshold = threshold
+        self.sample_rate = sample_rate
+        self.max_per_minute = max_per_minute
+        self.min_interval = min_interval
+        self.store = store if store is not None else PlanStore()
+        self.kinds = kinds
+        self._queue = Queue.Queue(queue_size)
+        self._recent = collections.deque()
+        self._last_by_fingerprint = {}
+        self._lock = threading.Lock()
+        self._conn = None
+        self._worker = threading.Thread(
+            target=self._run, name='plan-capture')
+        self._worker.daemon = True
+        self._worker.start()
+
+    def after(self, event):
+        if (event.kind not in self.kinds or
+                event.error is not None or
+                event.wall_time < self.threshold or
+                threading.current_thread() is self._worker or
+                not event.query):
+            return
+        if self.sample_rate < 1 and random.random() >= self.sample_rate:
+            return
+        if not self._allow(event.fingerprint):
+            return
+        try:
+            self._queue.put_nowait(event)
+        except Queue.Full:
+            logging.debug('Plan capture queue full, dropping capture')
+
+    def close(self):
+        """Stops the background thread and closes its own connection."""
+        self._queue.put(None)
+        self._worker.join()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def _allow(self, fingerprint):
+        now = time.time()
+        with self._lock:
+            while self._recent and self._recent[0] <= now - 60:
+                self._recent.popleft()
+            last = self._last_by_fingerprint.get(fingerprint)
+            if len(self._recent) >= self.max_per_minute or (
+                    last is not None and now - last < self.min_interval):
+                return False
+            if len(self._last_by_fingerprint) > 10000:
+                self._last_by_fingerprint = {
+                    fp: at for fp, at in self._last_by_fingerprint.iteritems()
+                    if now - at < self.min_interval
+                }
+            self._recent.append(now)
+            self._last_by_fingerprint[fingerprint] = now
+            return True
+
+    def _run(self):
+        while True:
+            event = self._queue.get()
+            if event is None:
+                return
+            try:
+                self.store.add(self._capture(event))
+            except Exception:
+                logging.exception('Could not capture plan')
+
+    def _capture(self, event):
+        query = event.query
+        if isinstance(query, bytes):
+            query = query.decode('utf-8', 'replace')
+        plan = CapturedPlan(
+            event.fingerprint,
+            event.kind,
+            redact_sql(query),
+            redact_params(event.params),
+            event.wall_time)
+        with self._connection() as conn:
+            cursor = conn.cursor()
+            try:
+                if event.params is not None:
+                    query = cursor.mogrify(query, event.params)
+                    if isinstance(query, bytes):
+                        query = query.decode('utf-8', 'replace')
+                statements = [
+                    statement for statement in split_statements(query)
+                    if is_explainable(statement)
+                ]
+                with cursor.plain_rows():
+                    for statement in statements:
+                        try:
+                            cursor.execute_raw('EXPLAIN ' + statement)
+                            plan.plans.append(
+                                [row[0] for row in cursor.fetchall()])
+                        except Exception as err:
+                            plan.errors.append(str(err).strip())
+                            if not conn.autocommit:
+                                conn.rollback()
+            finally:
+                cursor.close()
+        logging.warning(
+            'Captured plan of slow %s (%.2fs, fingerprint %s)',
+            event.kind, event.wall_time, event.fingerprint)
+        return plan
+
+    def _connection(self):
+        if self.db_conn.is_pooled():
+            return self.db_conn.connection()
+        if self._conn is None or self._conn.closed:
+            self._conn = self.db_conn._open_connection()
+            self._conn.autocommit = True
+        return _Lent(self._conn)
+
+
+class _Lent(object):
+    """Context manager lending a connection without closing it."""
+
+    def __init__(self, conn):
+        self.conn = conn
+
+    def __enter__(self):
+        return self.conn
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        pass
@@ -0,0 +1,92 @@
+import contextlib
+import itertools
+import logging
+import threading
+
+# Replica selection strategies understood by ReplicaRouter.
+BALANCING = ('round_robin', 'least_loaded')
+
+
+class ReplicaRouter(object):
+    """Hands out cursors from a set of read replicas.
+
+    'round_robin' cycles through the replicas. 'least_loaded' picks the
+    replica with the fewest open cursors handed out by this router.
+    """
+
+    def __init__(self, replicas, balancing='round_robin'):
+        """
+        :param replicas: non-empty list of DbConnections, one per replica.
+        :param balancing: one of BALANCING.
+        """
+        if balancing not in BALANCING:
+            raise ValueError(
+                'Unknown balancing {!r}, expected one of {}'.format(
+                    balancing, ', '.join(BALANCING)))
+        if not replicas:
+            raise ValueError('ReplicaRouter needs at least one replica')
+        self.replicas = list(replicas)
+        self.balancing = balancing
+        self._in_use = [0] * len(self.replicas)
+        self._cycle = itertools.cycle(range(len(self.replicas)))
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Returns the number of open cursors per replica host."""
+        with self._lock:
+            return [
+                ('{}:{}'.format(replica.host, replica.port), in_use)
+                for replica, in_use in zip(self.replicas, self._in_use)
+            ]
+
+    @contextlib.contextmanager
+    def replica(self):
+        """Context manager lending the chosen replica's DbConnection. Its
+        load counts until the with-block exits.
+        """
+        idx = self._acquire()
+        try:
+            yield self.replicas[idx]
+        finally:
+            self._release(idx)
+
+    def new_cursor(self):
+        """Returns a cursor on the chosen replica. The replica's load is
+        released when the cursor is closed.
+        """
+        idx = self._acquire()
+        replica = self.replicas[idx]
+        try:
+            cursor = replica.new_cursor()
+        except Exception:
+            self._release(idx)
+            raise
+        logging.debug('Routing read to replica %s', replica.host)
+        on_close = cursor.on_close
+
+        def release():
+            self._release(idx)
+            if on_close is not None:
+                on_close()
+
+        cursor.on_close = release
+        return cursor
+
+    def close(self):
+        for replica in self.replicas:
+            if replica.is_connected():
+                replica.close()
+
+    def _acquire(self):
+        with self._lock:
+            if self.balancing == 'round_robin':
+                idx = next(self._cycle)
+            else:
+                idx = min(
+                    range(len(self.replicas)), key=self._in_use.__getitem__)
+            self._in_use[idx] += 1
+        return idx
+
+    def _release(self, idx):
+        with self._lock:
+            self._in_use[idx] -= 1
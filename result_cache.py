@@ -0,0 +1,230 @@
+import collections
+import re
+import sys
+import threading
+import weakref
+
+from instrumentation import Hook
+
+_NAME = r'(?:"[^"]+"|[A-Za-z_][\w$]*)(?:\.(?:"[^"]+"|[A-Za-z_][\w$]*))*'
+_READ_RE = re.compile(
+    r'\b(?:FROM|JOIN)\s+({})'.format(_NAME), re.IGNORECASE)
+_WRITE_RE = re.compile(
+    r'\b(?:INSERT\s+INTO|UPDATE|DELETE\s+FROM|COPY|MERGE\s+INTO|'
+    r'TRUNCATE(?:\s+TABLE)?|DROP\s+TABLE(?:\s+IF\s+EXISTS)?|'
+    r'ALTER\s+TABLE(?:\s+IF\s+EXISTS)?)\s+({0}(?:\s*,\s*{0})*)'.format(_NAME),
+    re.IGNORECASE)
+_WRITE_KEYWORD_RE = re.compile(
+    r'\b(?:INSERT|UPDATE|DELETE|COPY|MERGE|TRUNCATE|DROP|ALTER)\b',
+    re.IGNORECASE)
+
+
+def _table_key(name):
+    """Returns the unqualified, unquoted, lowercase name of a table.
+    Unqualified keys make invalidation err on the side of dropping more.
+    """
+    return name.strip().split('.')[-1].strip('"').lower()
+
+
+def read_tables(sql):
+    """Returns the set of table keys sql reads from."""
+    return set(_table_key(name) for name in _READ_RE.findall(sql))
+
+
+def written_table_names(sql):
+    """Returns the names of the tables sql writes to, as written in sql."""
+    return [
+        name.strip()
+        for names in _WRITE_RE.findall(sql)
+        for name in names.split(',')
+    ]
+
+
+def written_tables(sql):
+    """Returns the set of table keys sql writes to."""
+    return set(_table_key(name) for name in written_table_names(sql))
+
+
+def estimate_size(value):
+    """Returns the approximate memory used by a result set, in bytes."""
+    size = sys.getsizeof(value)
+    rows = value.values() if isinstance(value, dict) else value
+    for row in rows:
+        size += sys.getsizeof(row)
+        if isinstance(row, (list, tuple)):
+            size += sum(sys.getsizeof(item) for item in row)
+    return size
+
+
+class ResultCache(Hook):
+    """Memory-bounded LRU cache of query results.
+
+    Entries are keyed by the mogrified statement and remember the tables
+    they read. As an instrumentation hook it sees every statement run
+    through the DbConnection, and drops entries depending on a table that
+    an INSERT, UPDATE, DELETE, COPY, upsert or DDL statement touches.
+    Tables written inside a transaction are dropped again when it commits,
+    as other connections may have cached their old rows meanwhile.
+    Writes hidden inside functions or DO blocks are not detected; call
+    `clear` after running those.
+    """
+
+    def __init__(self, max_bytes=64 << 20):
+        """
+        :param max_bytes: approximate memory limit of the cached results.
+        """
+        self.max_bytes = max_bytes
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        # key -> (value, size, tables)
+        self._entries = collections.OrderedDict()
+        # table key -> set of entry keys reading it
+        self._by_table = {}
+        # Bumped on every invalidation, so results read before a write
+        # aren't cached after it.
+        self._generation = 0
+        # Connection -> table keys written in its open transaction, or None
+        # if it wrote to a table we can't name.
+        self._uncommitted = weakref.WeakKeyDictionary()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    @property
+    def generation(self):
+        return self._generation
+
+    def get(self, key, default=None):
+        """Returns the cached results for key, or default if absent."""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return default
+            self._entries[key] = entry
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, statement, value, generation):
+        """Caches value for key unless statement writes, reads no known
+        table, or any write happened since generation was read.
+        :param key: cache key, including the mogrified statement.
+        :param statement: mogrified statement text.
+        :param value: results to cache.
+        :param generation: `generation` read before running statement.
+        :return: true if value was cached.
+        """
+        tables = read_tables(statement)
+        if not tables or written_tables(statement):
+            return False
+        size = estimate_size(value) + sys.getsizeof(key)
+        if size > self.max_bytes:
+            return False
+        with self._lock:
+            if generation != self._generation:
+                return False
+            self._remove(key)
+            self._entries[key] = (value, size, tables)
+            self.bytes += size
+            for table in tables:
+                self._by_table.setdefault(table, set()).add(key)
+            while self.bytes > self.max_bytes:
+                self._remove(next(iter(self._entries)))
+                self.evictions += 1
+        return True
+
+    def invalidate_tables(self, tables):
+        """Drops every entry reading one of tables."""
+        keys = set(_table_key(table) for table in tables)
+        with self._lock:
+            self._generation += 1
+            for table in keys:
+                for key in list(self._by_table.get(table, ())):
+                    self._remove(key)
+                    self.invalidations += 1
+
+    def clear(self):
+        with self._lock:
+            self._generation += 1
+            self._entries.clear()
+            self._by_table.clear()
+            self.bytes = 0
+
+    def stats(self):
+        """Returns a dictionary of the cache counters."""
+        with self._lock:
+            return {
+                'size': len(self._entries),
+                'bytes': self.bytes,
+                'max_bytes': self.max_bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'invalidations': self.invalidations,
+            }
+
+    def after(self, event):
+        if event.kind == 'commit':
+            if event.error is None:
+                self._committed(event.connection)
+            return
+        if event.table is not None:
+            self._written(event.connection, [event.table])
+            return
+        # Prepared statements are only sent as EXECUTE, so their template
+        # is inspected instead.
+        sql = event.sql if event.kind == 'execute' else event.query
+        if event.kind not in ('execute', 'prepared') or not sql:
+            return
+        if isinstance(sql, bytes):
+            sql = sql.decode('utf-8', 'replace')
+        tables = written_tables(sql)
+        if tables:
+            self._written(event.connection, tables)
+        elif _WRITE_KEYWORD_RE.search(sql):
+            # A write to a table we can't name, e.g. a placeholder.
+            self._written(event.connection, None)
+
+    def _written(self, connection, tables):
+        """Drops entries reading tables, every entry if tables is None, and
+        remembers them until connection commits.
+        """
+        if tables is None:
+            self.clear()
+        else:
+            self.invalidate_tables(tables)
+        if connection is None or getattr(connection, 'autocommit', True):
+            return
+        with self._lock:
+            pending = self._uncommitted.get(connection, set())
+            if pending is not None:
+                pending = None if tables is None else pending.union(
+                    _table_key(table) for table in tables)
+            self._uncommitted[connection] = pending
+
+    def _committed(self, connection):
+        with self._lock:
+            if connection not in self._uncommitted:
+                return
+            tables = self._uncommitted.pop(connection)
+        if tables is None:
+            self.clear()
+        else:
+            self.invalidate_tables(tables)
+
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is None:
+            return
+        _, size, tables = entry
+        self.bytes -= size
+        for table in tables:
+            keys = self._by_table.get(table)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._by_table[table]
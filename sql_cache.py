@@ -0,0 +1,180 @@
+import logging
+import os
+import re
+import textwrap
+import threading
+
+# Matches psycopg2 named placeholders, skipping escaped '%%'.
+PARAM_RE = re.compile(r'%%|%\((\w+)\)s')
+DOLLAR_TAG_RE = re.compile(r'\$(?:[A-Za-z_][A-Za-z0-9_]*)?\$')
+LEADING_COMMENTS_RE = re.compile(r'^(?:\s+|--[^\n]*|/\*.*?\*/)*', re.DOTALL)
+
+
+class CompiledSqlFile(object):
+    """A sql file that has been read and pre-processed once."""
+
+    def __init__(self, path, mtime, size, text, inode=None):
+        self.path = path
+        self.mtime = mtime
+        self.size = size
+        self.inode = inode
+        self.text = textwrap.dedent(text)
+        self.statements = split_statements(self.text)
+        self.param_names = frozenset(
+            match.group(1) for match in PARAM_RE.finditer(self.text)
+            if match.group(1) is not None)
+
+    def check_params(self, params):
+        """Raises KeyError if params lacks a name used by the file.
+        :param params: dictionary of values to use in the sql, or None.
+        """
+        if not isinstance(params, dict):
+            return
+        missing = self.param_names.difference(params)
+        if missing:
+            raise KeyError('{} is missing sql parameters: {}'.format(
+                self.path, ', '.join(sorted(missing))))
+
+
+class SqlFileCache(object):
+    """Thread-safe cache of CompiledSqlFile objects keyed by path.
+    An entry is recompiled whenever the file's mtime, size or inode
+    changes, so a symlink repointed at another file is picked up.
+    """
+
+    def __init__(self):
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def get(self, file_path):
+        """Returns the CompiledSqlFile for file_path.
+        :param file_path: path of the sql file.
+        """
+        # Keyed on the path callers use rather than its real path: resolving
+        # symlinks once would pin a deploy link such as current/ to the
+        # release it pointed at first.
+        path = os.path.abspath(file_path)
+        stat = os.stat(path)
+        with self._lock:
+            entry = self._entries.get(path)
+        if (entry is not None and entry.mtime == stat.st_mtime
+                and entry.size == stat.st_size
+                and entry.inode == (stat.st_dev, stat.st_ino)):
+            return entry
+
+        logging.debug('Compiling sql file: %s', path)
+        with open(path, 'r') as sql_f:
+            entry = CompiledSqlFile(
+                path, stat.st_mtime, stat.st_size, sql_f.read(),
+                (stat.st_dev, stat.st_ino))
+        with self._lock:
+            self._entries[path] = entry
+        return entry
+
+    def preload(self, directory, extension='.sql'):
+        """Compiles every file under directory ending in extension, so the
+        first execution of each skips reading and parsing it.
+        :param directory: directory searched recursively.
+        :return: number of files compiled.
+        """
+        count = 0
+        for dirpath, _, filenames in os.walk(directory):
+            for filename in sorted(filenames):
+                if filename.endswith(extension):
+                    self.get(os.path.join(dirpath, filename))
+                    count += 1
+        logging.debug('Preloaded %s sql files from %s', count, directory)
+        return count
+
+    def invalidate(self, file_path=None):
+        """Drops one cached file, or every cached file if file_path is None.
+        """
+        with self._lock:
+            if file_path is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(os.path.abspath(file_path), None)
+
+
+def split_statements(sql):
+    """Splits sql text on top-level semicolons. Semicolons inside quotes,
+    dollar-quoted bodies and comments are ignored.
+    :param sql: sql text holding one or more statements.
+    :return: list of non-empty statements, without trailing semicolons.
+    """
+    statements = []
+    start = 0
+    idx = 0
+    length = len(sql)
+    while idx < length:
+        char = sql[idx]
+        if char in ('\'', '"'):
+            idx = _skip_quoted(sql, idx, char)
+        elif sql.startswith('--', idx):
+            newline = sql.find('\n', idx)
+            idx = length if newline == -1 else newline + 1
+        elif sql.startswith('/*', idx):
+            end = sql.find('*/', idx + 2)
+            idx = length if end == -1 else end + 2
+        elif char == '$':
+            tag = DOLLAR_TAG_RE.match(sql, idx)
+            if tag is None:
+                idx += 1
+            else:
+                end = sql.find(tag.group(0), tag.end())
+                idx = length if end == -1 else end + len(tag.group(0))
+        elif char == ';':
+            statements.append(sql[start:idx])
+            idx += 1
+            start = idx
+        else:
+            idx += 1
+    statements.append(sql[start:])
+    return [stmt.strip() for stmt in statements if _has_code(stmt)]
+
+
+def _skip_quoted(sql, idx, quote):
+    """Returns the index just past the quoted section starting at idx.
+    Doubled quotes are treated as escapes.
+    """
+    idx += 1
+    while True:
+        end = sql.find(quote, idx)
+        if end == -1:
+            return len(sql)
+        if sql.startswith(quote * 2, end):
+            idx = end + 2
+        else:
+            return end + 1
+
+
+def first_keyword(statement):
+    """Returns the uppercased first word of statement, skipping leading
+    comments, or '' if it has none. split_statements keeps the comments
+    before each statement.
+    """
+    words = LEADING_COMMENTS_RE.sub('', statement, count=1).split(None, 1)
+    return words[0].upper().rstrip(';') if words else ''
+
+
+def _has_code(statement):
+    """Returns true if statement holds more than whitespace and comments."""
+    for line in statement.splitlines():
+        line = line.strip()
+        if line and not line.startswith('--'):
+            return True
+    return False
+
+
+# Process-wide cache shared by AmgCursor and DbConnection.
+FILE_CACHE = SqlFileCache()
+
+
+def get_compiled(file_path):
+    """Returns the cached CompiledSqlFile for file_path."""
+    return FILE_CACHE.get(file_path)
+
+
+def preload_dir(directory, extension='.sql'):
+    """Compiles every sql file under directory into the shared cache."""
+    return FILE_CACHE.preload(directory, extension)
@@ -0,0 +1,213 @@
+import collections
+import logging
+import Queue
+import threading
+import time
+
+SUCCESS = 'SUCCESS'
+FAIL = 'FAIL'
+CANCELLED = 'CANCELLED'
+
+
+class SqlDagError(Exception):
+    """Raised when a step of a SqlDag fails. Holds every step's result."""
+
+    def __init__(self, message, results):
+        super(SqlDagError, self).__init__(message)
+        self.results = results
+
+
+class SqlStep(object):
+    """A named group of sql files run as one step of a SqlDag."""
+
+    def __init__(
+            self,
+            name,
+            sql_files,
+            depends_on=(),
+            params=None,
+            transactional=True):
+        """
+        :param name: unique name of the step.
+        :param sql_files: ordered list of sql file paths to execute.
+        :param depends_on: names of steps that must succeed first.
+        :param params: dictionary of values to use in the sql files.
+        :param transactional: if True, all files run in one transaction on
+            one connection. Otherwise each file runs on its own cursor
+            under the connection's autocommit setting.
+        """
+        self.name = name
+        self.sql_files = list(sql_files)
+        self.depends_on = tuple(depends_on)
+        self.params = params
+        self.transactional = transactional
+
+    def run(self, db_conn):
+        if self.transactional:
+            db_conn.execute_sql_files(self.sql_files, self.params)
+        else:
+            for sql_file in self.sql_files:
+                db_conn.execute_sql_file(sql_file, self.params)
+
+
+class StepResult(object):
+    """Outcome and timing of one SqlStep."""
+
+    def __init__(self, name, status, started_at=None, elapsed=None,
+                 error=None):
+        self.name = name
+        self.status = status
+        self.started_at = started_at
+        self.elapsed = elapsed
+        self.error = error
+
+    def __repr__(self):
+        return 'StepResult({!r}, {}, elapsed={})'.format(
+            self.name, self.status, self.elapsed)
+
+
+class SqlDag(object):
+    """Dependency graph of SqlSteps.
+
+    Steps whose dependencies have all succeeded run in parallel on a pool
+    of worker threads, each borrowing its own connection. When a step
+    fails, every step depending on it (directly or not) is cancelled while
+    independent branches carry on.
+    """
+
+    def __init__(self):
+        self.steps = collections.OrderedDict()
+
+    def add_step(self, name, sql_files, depends_on=(), **kwargs):
+        """Declares a step. See SqlStep for the arguments.
+        :return: the new SqlStep.
+        """
+        if name in self.steps:
+            raise ValueError('Duplicate sql step: {}'.format(name))
+        step = SqlStep(name, sql_files, depends_on, **kwargs)
+        self.steps[name] = step
+        return step
+
+    def validate(self):
+        """Raises ValueError on unknown dependencies or cycles."""
+        for step in self.steps.itervalues():
+            for dep in step.depends_on:
+                if dep not in self.steps:
+                    raise ValueError(
+                        'Step {} depends on unknown step {}'.format(
+                            step.name, dep))
+        # Kahn's algorithm: every step must eventually become ready.
+        remaining = dict(
+            (name, len(step.depends_on))
+            for name, step in self.steps.iteritems())
+        dependents = self._dependents()
+        ready = [name for name, count in remaining.iteritems() if count == 0]
+        seen = 0
+        while ready:
+            name = ready.pop()
+            seen += 1
+            for child in dependents[name]:
+                remaining[child] -= 1
+                if remaining[child] == 0:
+                    ready.append(child)
+        if seen != len(self.steps):
+            raise ValueError('Sql steps contain a dependency cycle.')
+
+    def run(self, db_conn, max_workers=4):
+        """Runs every step, honoring dependencies.
+        :param db_conn: DbConnection to run the steps on. Without a pool,
+            steps run one at a time since they would share one connection.
+        :param max_workers: maximum number of steps running at once.
+        :return: ordered dictionary mapping step names to StepResults.
+        """
+        self.validate()
+        if not db_conn.is_pooled() and max_workers > 1:
+            logging.warning(
+                'DbConnection is not pooled. Running sql steps serially.')
+            max_workers = 1
+
+        results = collections.OrderedDict(
+            (name, None) for name in self.steps)
+        remaining = dict(
+            (name, len(step.depends_on))
+            for name, step in self.steps.iteritems())
+        dependents = self._dependents()
+        ready = Queue.Queue()
+        done = Queue.Queue()
+
+        def worker():
+            while True:
+                step = ready.get()
+                if step is None:
+                    return
+                logging.info('Starting sql step %s', step.name)
+                started_at = time.time()
+                try:
+                    step.run(db_conn)
+                    result = StepResult(
+                        step.name, SUCCESS, started_at,
+                        time.time() - started_at)
+                except Exception as err:
+                    logging.exception('Sql step %s failed', step.name)
+                    result = StepResult(
+                        step.name, FAIL, started_at,
+                        time.time() - started_at, err)
+                done.put(result)
+
+        workers = [
+            threading.Thread(target=worker, name='sql-step-{}'.format(idx))
+            for idx in range(max(1, min(max_workers, len(self.steps))))
+        ]
+        for thread in workers:
+            thread.daemon = True
+            thread.start()
+
+        pending = 0
+        for name, count in remaining.iteritems():
+            if count == 0:
+                ready.put(self.steps[name])
+                pending += 1
+
+        try:
+            while pending:
+                result = done.get()
+                pending -= 1
+                results[result.name] = result
+                logging.info(
+                    'Sql step %s finished with %s in %.3fs',
+                    result.name, result.status, result.elapsed)
+                if result.status == SUCCESS:
+                    for child in dependents[result.name]:
+                        remaining[child] -= 1
+                        if remaining[child] == 0 and results[child] is None:
+                            ready.put(self.steps[child])
+                            pending += 1
+                else:
+                    self._cancel_dependents(result.name, dependents, results)
+        finally:
+            for _ in workers:
+                ready.put(None)
+
+        failed = [r.name for r in results.itervalues() if r.status == FAIL]
+        if failed:
+            raise SqlDagError(
+                'Sql steps failed: {}'.format(', '.join(failed)), results)
+        return results
+
+    def _dependents(self):
+        dependents = dict((name, []) for name in self.steps)
+        for step in self.steps.itervalues():
+            for dep in step.depends_on:
+                dependents[dep].append(step.name)
+        return dependents
+
+    @staticmethod
+    def _cancel_dependents(name, dependents, results):
+        stack = list(dependents[name])
+        while stack:
+            child = stack.pop()
+            if results[child] is None:
+                logging.info(
+                    'Cancelling sql step %s after %s failed', child, name)
+                results[child] = StepResult(child, CANCELLED)
+                stack.extend(dependents[child])
@@ -0,0 +1,63 @@
+import unittest
+
+from psycopg2.extensions import AsIs
+from psycopg2.extensions import adapt
+
+from amg_connection import parameterize
+
+
+def mogrify(query, q_vars):
+    """Stands in for cursor.mogrify, which needs a live connection."""
+    return query % tuple(adapt(value).getquoted() for value in q_vars)
+
+
+class ParameterizeTest(unittest.TestCase):
+
+    def test_named_params(self):
+        self.assertEqual(
+            parameterize(
+                'SELECT * FROM t WHERE a = %(a)s AND b = %(b)s',
+                {'a': 1, 'b': 'x'},
+                mogrify),
+            ('SELECT * FROM t WHERE a = $1 AND b = $2', [1, 'x']))
+
+    def test_repeated_named_param_is_sent_once(self):
+        self.assertEqual(
+            parameterize(
+                'SELECT %(a)s, %(b)s, %(a)s', {'a': 1, 'b': 2}, mogrify),
+            ('SELECT $1, $2, $1', [1, 2]))
+
+    def test_positional_params(self):
+        self.assertEqual(
+            parameterize('SELECT %s, %s', (1, 1), mogrify),
+            ('SELECT $1, $2', [1, 1]))
+
+    def test_escaped_percent(self):
+        self.assertEqual(
+            parameterize(
+                "SELECT '100%%' WHERE a LIKE %(a)s", {'a': 'x%'}, mogrify),
+            ("SELECT '100%' WHERE a LIKE $1", ['x%']))
+
+    def test_asis_is_inlined(self):
+        self.assertEqual(
+            parameterize(
+                'SELECT * FROM %(table)s WHERE a = %(a)s',
+                {'table': AsIs('media.imports'), 'a': 1},
+                mogrify),
+            ('SELECT * FROM media.imports WHERE a = $1', [1]))
+
+    def test_tuple_is_inlined(self):
+        self.assertEqual(
+            parameterize(
+                'SELECT 1 WHERE a IN %(ids)s AND b = %(b)s',
+                {'ids': (1, 2, 3), 'b': 4},
+                mogrify),
+            ('SELECT 1 WHERE a IN (1, 2, 3) AND b = $1', [4]))
+
+    def test_mixed_placeholders_raise(self):
+        with self.assertRaises(TypeError):
+            parameterize('SELECT %(a)s, %s', {'a': 1}, mogrify)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,78 @@
+import unittest
+
+from amg_cursor import AmgCursor
+from instrumentation import Instrumentation
+from utils import no_quotes
+
+
+class BuildUpsertTest(unittest.TestCase):
+
+    def build(self, **kwargs):
+        update, insert = AmgCursor.build_upsert(
+            'staging', 'target', ['id', 'day'], ['id', 'day', 'value'],
+            partition=(1, 4), **kwargs)
+        return update[1]['partition_filter'], insert[1]['partition_filter']
+
+    def test_partition_filter_casts_to_varchar_max(self):
+        for partition_filter in self.build():
+            self.assertIn(
+                'CAST(s.id AS VARCHAR(MAX))', partition_filter.adapted)
+            self.assertIn(') = 1', partition_filter.adapted)
+
+    def test_partition_filter_text_type(self):
+        for partition_filter in self.build(text_type='TEXT'):
+            self.assertIn('CAST(s.day AS TEXT)', partition_filter.adapted)
+            self.assertNotIn('VARCHAR', partition_filter.adapted)
+
+
+class FakeCursor(object):
+    """Runs AmgCursor.instrumented without a database."""
+
+    instrumented = AmgCursor.instrumented.__func__
+    closed = False
+    rowcount = 0
+    connection = None
+    conn_wait = 0.0
+
+    def __init__(self, instrumentation):
+        self.instrumentation = instrumentation
+
+
+class InstrumentedTest(unittest.TestCase):
+
+    def setUp(self):
+        self.events = []
+        instrumentation = Instrumentation()
+        instrumentation.add_hook(self.events.append)
+        self.cursor = FakeCursor(instrumentation)
+
+    def test_credentials_are_hidden_from_hooks(self):
+        creds = 'aws_access_key_id=KEY;aws_secret_access_key=SECRET'
+        params = {
+            'tablename': no_quotes('sales'),
+            's3_path': 's3://bucket/prefix',
+            'aws_creds': creds,
+        }
+        with self.cursor.instrumented('execute', 'COPY ...', params):
+            pass
+        event_params = self.events[0].params
+        self.assertNotIn('SECRET', repr(event_params))
+        self.assertIs(event_params['tablename'], params['tablename'])
+        self.assertEqual(event_params['s3_path'], 's3://bucket/prefix')
+        self.assertEqual(params['aws_creds'], creds)
+
+    def test_positional_secrets_are_hidden(self):
+        params = ('sales', no_quotes("'aws_secret_access_key=SECRET'"))
+        with self.cursor.instrumented('execute', 'COPY ...', params):
+            pass
+        self.assertEqual(self.events[0].params, ['sales', '<redacted>'])
+
+    def test_params_without_secrets_are_passed_as_is(self):
+        params = {'id': 1}
+        with self.cursor.instrumented('execute', 'SELECT ...', params):
+            pass
+        self.assertIs(self.events[0].params, params)
+
+
+if __name__ == '__main__':
+    unittest.main()
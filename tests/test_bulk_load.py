@@ -0,0 +1,44 @@
+import datetime
+import unittest
+
+from bulk_load import RowStream
+from bulk_load import encode_row
+
+
+class EncodeRowTest(unittest.TestCase):
+
+    def test_float_round_trips(self):
+        for value in (123456789.123456789, 0.1, 1e-300, -2.5e17, 1.0 / 3):
+            line = encode_row([value])
+            self.assertEqual(float(line.rstrip(b'\n')), value)
+
+    def test_special_values(self):
+        self.assertEqual(
+            encode_row([None, True, False, 7, datetime.date(2020, 1, 2)]),
+            b'\\N\tt\tf\t7\t2020-01-02\n')
+
+    def test_escapes(self):
+        self.assertEqual(
+            encode_row([u'a\tb\nc\\d\u00e9']),
+            u'a\\tb\\nc\\\\d\u00e9\n'.encode('utf-8'))
+
+
+class RowStreamTest(unittest.TestCase):
+
+    def test_reads_all_rows_in_chunks(self):
+        rows = [(idx, u'row {}'.format(idx)) for idx in range(100)]
+        stream = RowStream(rows, chunk_size=64)
+        data = b''
+        while True:
+            chunk = stream.read()
+            if not chunk:
+                break
+            self.assertLessEqual(len(chunk), 64)
+            data += chunk
+        self.assertEqual(data, b''.join(encode_row(row) for row in rows))
+        self.assertEqual(stream.rows, 100)
+        self.assertEqual(stream.bytes, len(data))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,45 @@
+import json
+import shutil
+import tempfile
+import unittest
+
+from copy_orchestrator import BulkCopyOrchestrator
+from copy_orchestrator import LocalObjectStore
+
+
+class PlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.store = LocalObjectStore(self.dir)
+        for key in ('data/2020-01-01.csv', 'data/2020-01-02.csv',
+                    'data/2020-02-01.csv'):
+            self.store.put_object(key, b'1\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def manifest_urls(self, manifest_key):
+        with open('{}/{}'.format(self.dir, manifest_key)) as in_f:
+            return [entry['url'] for entry in json.load(in_f)['entries']]
+
+    def test_overlapping_prefixes_list_each_file_once(self):
+        orchestrator = BulkCopyOrchestrator(None, self.store)
+        jobs = orchestrator.plan([
+            ('t', 'data/2020-01'),
+            ('t', 'data/2020-01-02'),
+            ('t', 'data/'),
+        ])
+        self.assertEqual(len(jobs), 1)
+        result, _, options = jobs[0]
+        self.assertEqual(result.num_files, 3)
+        self.assertIn('MANIFEST', options)
+        self.assertEqual(self.manifest_urls(result.manifest_key), [
+            's3://local/data/2020-01-01.csv',
+            's3://local/data/2020-01-02.csv',
+            's3://local/data/2020-02-01.csv',
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,113 @@
+import contextlib
+import logging
+import unittest
+
+import psycopg2
+
+from db_connection import DbConnection
+from instrumentation import INSTRUMENTATION
+
+
+class FakeConnection(object):
+    closed = 0
+
+    def close(self):
+        self.closed = 1
+
+
+class UnreachableReplica(object):
+
+    @contextlib.contextmanager
+    def connection(self):
+        raise psycopg2.OperationalError('could not connect')
+        yield
+
+    _exclusive_connection = connection
+
+
+class ReachableReplica(object):
+
+    def __init__(self):
+        self.conn = FakeConnection()
+
+    @contextlib.contextmanager
+    def connection(self):
+        yield self.conn
+
+    _exclusive_connection = connection
+
+
+class FakeRouter(object):
+
+    def __init__(self, replica):
+        self._replica = replica
+
+    @contextlib.contextmanager
+    def replica(self):
+        yield self._replica
+
+
+class ReplicaFallbackTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.WARNING)
+        self.db_conn = DbConnection('primary', 'db', 'user', 'pw', 5439)
+        self.db_conn.conn = FakeConnection()
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_unreachable_replica_reads_from_primary(self):
+        self.db_conn.replicas = FakeRouter(UnreachableReplica())
+        with self.db_conn.connection(read_only=True) as conn:
+            self.assertIs(conn, self.db_conn.conn)
+
+    def test_reads_from_reachable_replica(self):
+        replica = ReachableReplica()
+        self.db_conn.replicas = FakeRouter(replica)
+        with self.db_conn.connection(read_only=True) as conn:
+            self.assertIs(conn, replica.conn)
+
+    def test_errors_of_the_block_are_not_retried(self):
+        self.db_conn.replicas = FakeRouter(ReachableReplica())
+        used = []
+        with self.assertRaises(psycopg2.OperationalError):
+            with self.db_conn.connection(read_only=True) as conn:
+                used.append(conn)
+                raise psycopg2.OperationalError('server closed connection')
+        self.assertEqual(len(used), 1)
+
+    def test_exclusive_connection_falls_back(self):
+        self.db_conn.replicas = FakeRouter(UnreachableReplica())
+        self.db_conn.pool_max_size = 1
+        checked_out = []
+
+        class FakePool(object):
+            def checkout(self, timeout):
+                checked_out.append(FakeConnection())
+                return checked_out[-1]
+
+            def checkin(self, conn):
+                checked_out.remove(conn)
+
+        self.db_conn.pool = FakePool()
+        with self.db_conn._exclusive_connection(read_only=True) as conn:
+            self.assertEqual(checked_out, [conn])
+        self.assertEqual(checked_out, [])
+
+
+class ServicesTest(unittest.TestCase):
+
+    def test_maintenance_is_scoped_to_the_connection(self):
+        db_conn = DbConnection('primary', 'db', 'user', 'pw', 5439)
+        db_conn.conn = FakeConnection()
+        scheduler = db_conn.schedule_maintenance(check_interval=0.01)
+        self.assertEqual(db_conn.instrumentation.hooks, [scheduler])
+        self.assertNotIn(scheduler, INSTRUMENTATION.hooks)
+        db_conn.close()
+        self.assertEqual(db_conn.instrumentation.hooks, [])
+        self.assertFalse(scheduler._worker.is_alive())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import io
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+
+import export
+
+
+class ExportWriterTest(unittest.TestCase):
+
+    def test_dest_is_required(self):
+        with self.assertRaises(ValueError):
+            export.ExportWriter(None)
+
+    def test_writes_to_file_object(self):
+        out = io.BytesIO()
+        writer = export.ExportWriter(out, chunk_size=4)
+        for row in (b'1,a\n', b'2,b\n', b'3,c\n'):
+            writer.write(row)
+        writer.close()
+        self.assertEqual(out.getvalue(), b'1,a\n2,b\n3,c\n')
+        self.assertEqual(writer.stats.rows, 3)
+        self.assertEqual(writer.stats.bytes, 12)
+
+    def test_rotates_files_on_row_boundaries(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        writer = export.ExportWriter(
+            os.path.join(directory, 'part-{index}.csv'), chunk_size=1,
+            max_bytes=8)
+        for row in (b'1,a\n', b'2,b\n', b'3,c\n'):
+            writer.write(row)
+        writer.close()
+        self.assertEqual(len(writer.stats.files), 2)
+        with open(writer.stats.files[1], 'rb') as part_f:
+            self.assertEqual(part_f.read(), b'3,c\n')
+
+
+class FakeDb(object):
+    """DbConnection counting the exports running at once."""
+
+    def __init__(self):
+        self.running = 0
+        self.most_running = 0
+        self.params = []
+        self._lock = threading.Lock()
+
+    def export_query(self, query, params, dest, **kwargs):
+        with self._lock:
+            self.running += 1
+            self.most_running = max(self.most_running, self.running)
+            self.params.append(params)
+        time.sleep(0.01)
+        with self._lock:
+            self.running -= 1
+        return export.ExportStats(rows=1, files=[dest])
+
+
+class ExportRangesTest(unittest.TestCase):
+
+    def test_runs_at_most_max_workers_at_once(self):
+        db_conn = FakeDb()
+        ranges = [(idx, idx + 1) for idx in range(10)]
+        stats = export.export_ranges(
+            db_conn, 'SELECT 1', ranges, '/tmp/x', max_workers=3)
+        self.assertEqual(stats.rows, 10)
+        self.assertLessEqual(db_conn.most_running, 3)
+        self.assertEqual(
+            sorted(p['range_start'] for p in db_conn.params), range(10))
+
+
+if __name__ == '__main__':
+    unittest.main()
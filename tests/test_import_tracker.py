@@ -0,0 +1,48 @@
+import contextlib
+import unittest
+
+from import_tracker import ImportTracker
+
+
+class FailingDb(object):
+    """DbConnection whose transactions fail on the first statement."""
+
+    @contextlib.contextmanager
+    def transaction(self):
+        raise RuntimeError('connection lost')
+        yield
+
+
+class ImportTrackerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tracker = ImportTracker(
+            FailingDb(), 'media', 'fyi', max_pending=100)
+
+    def test_merged_status_keeps_may_create(self):
+        self.tracker.record('a.csv', '2020-01-01', 'STARTED')
+        self.tracker.record('a.csv', '2020-01-01', 'SUCCESS')
+        self.tracker.record('b.csv', '2020-01-01', 'SUCCESS')
+        pending = self.tracker._pending
+        self.assertEqual(pending['a.csv'].status, 'SUCCESS')
+        self.assertTrue(pending['a.csv'].may_create)
+        self.assertTrue(pending['a.csv'].stamp)
+        self.assertFalse(pending['b.csv'].may_create)
+
+    def test_failed_flush_keeps_changes(self):
+        self.tracker.record('a.csv', '2020-01-01', 'STARTED', 'in/a.csv')
+        self.tracker.record('b.csv', '2020-01-01', 'SKIPPED')
+        with self.assertRaises(RuntimeError):
+            self.tracker.flush()
+        self.assertEqual(len(self.tracker), 2)
+        self.tracker.record('a.csv', '2020-01-01', 'SUCCESS')
+        with self.assertRaises(RuntimeError):
+            self.tracker.flush()
+        change = self.tracker._pending['a.csv']
+        self.assertEqual(change.status, 'SUCCESS')
+        self.assertTrue(change.may_create)
+        self.assertEqual(change.file_path, 'in/a.csv')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+
+from ingest_checkpoint import IngestCheckpointer
+from ingest_checkpoint import ingest_run_key
+from utils import no_quotes
+
+
+class TransactionControlTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+        # No statement may reach the database.
+        self.checkpointer = IngestCheckpointer(None, 'media')
+
+    def run_sql(self, text):
+        path = os.path.join(self.dir, 'ingest.sql')
+        with open(path, 'w') as sql_f:
+            sql_f.write(text)
+        self.checkpointer.run(path, {}, 'run')
+
+    def test_rejects_transaction_control(self):
+        with self.assertRaises(ValueError):
+            self.run_sql('INSERT INTO a SELECT 1;\ncommit;')
+
+    def test_rejects_transaction_control_after_comments(self):
+        for text in (
+                'INSERT INTO a SELECT 1;\n-- done\nCOMMIT;',
+                'INSERT INTO a SELECT 1;\n/* done */ END;',
+                '-- load\n  /* all */\nBEGIN;\nINSERT INTO a SELECT 1;'):
+            with self.assertRaises(ValueError):
+                self.run_sql(text)
+
+
+class IngestRunKeyTest(unittest.TestCase):
+
+    def key(self, params=None, files=('b.csv', 'a.csv')):
+        return ingest_run_key('FYI', 'ingest.sql', files, params)
+
+    def test_same_files_in_any_order(self):
+        self.assertEqual(self.key(), self.key(files=['a.csv', 'b.csv']))
+
+    def test_params_change_the_key(self):
+        params = {'day': datetime.date(2020, 1, 1), 'table': 'sales'}
+        self.assertNotEqual(self.key(params), self.key())
+        self.assertNotEqual(
+            self.key(params),
+            self.key(dict(params, day=datetime.date(2020, 1, 2))))
+
+    def test_params_key_is_stable(self):
+        self.assertEqual(
+            self.key({'table': no_quotes('sales'), 'ids': (1, 2)}),
+            self.key({'ids': (1, 2), 'table': no_quotes('sales')}))
+        self.assertNotEqual(
+            self.key({'table': no_quotes('sales')}),
+            self.key({'table': no_quotes('returns')}))
+
+    def test_empty_params_keep_the_old_key(self):
+        self.assertEqual(self.key({}), self.key())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from instrumentation import Instrumentation
+from instrumentation import StatementEvent
+
+
+class InstrumentationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.parent = Instrumentation()
+        self.child = Instrumentation(self.parent)
+        self.seen = []
+
+    def record(self, name):
+        return lambda event: self.seen.append((name, event.kind))
+
+    def test_parent_hooks_see_child_statements(self):
+        self.parent.add_hook(self.record('parent'))
+        self.child.add_hook(self.record('child'))
+        self.child.after(StatementEvent('execute'))
+        self.assertEqual(
+            self.seen, [('parent', 'execute'), ('child', 'execute')])
+
+    def test_child_hooks_dont_see_parent_statements(self):
+        self.child.add_hook(self.record('child'))
+        self.assertEqual(self.parent.hooks, [])
+        self.parent.after(StatementEvent('execute'))
+        self.assertEqual(self.seen, [])
+
+    def test_parent_changes_reach_child(self):
+        hook = self.parent.add_hook(self.record('parent'))
+        self.assertEqual(self.child.hooks, [hook])
+        self.parent.remove_hook(hook)
+        self.assertEqual(self.child.hooks, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import unittest
+
+from instrumentation import StatementEvent
+from maintenance import MaintenanceScheduler
+
+
+class SchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.scheduler = MaintenanceScheduler(
+            None, analyze_rows=10, vacuum_rows=None, check_interval=60)
+
+    def tearDown(self):
+        self.scheduler.close()
+
+    def run_event(self, sql, rowcount):
+        event = StatementEvent('execute', sql)
+        event.sql = sql
+        self.scheduler.before(event)
+        event.rowcount = rowcount
+        self.scheduler.after(event)
+
+    def test_counts_written_rows(self):
+        self.run_event('INSERT INTO sales SELECT * FROM staging', 20)
+        self.assertEqual(self.scheduler.pending(), [('sales', 'ANALYZE', 20)])
+
+    def test_skips_explain(self):
+        self.run_event('EXPLAIN INSERT INTO sales SELECT * FROM staging', 20)
+        self.assertEqual(self.scheduler.pending(), [])
+
+    def test_drop_forgets_table(self):
+        self.run_event('INSERT INTO sales SELECT * FROM staging', 20)
+        self.run_event('DROP TABLE sales', -1)
+        self.assertEqual(self.scheduler.pending(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
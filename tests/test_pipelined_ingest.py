@@ -0,0 +1,132 @@
+import logging
+import unittest
+
+from import_tracker import ImportTracker
+from pipelined_ingest import IngestBatch
+from pipelined_ingest import PipelinedIngest
+from pipelined_ingest import StageStats
+
+
+class FakeDbConnection(object):
+    pool_max_size = 10
+
+    def is_pooled(self):
+        return True
+
+    def cache_import_ids(self, media_schema, data_source, rows,
+                         table_append):
+        return {}
+
+
+class FailingTracker(object):
+
+    def record(self, file_name, file_date, status):
+        pass
+
+    def flush(self):
+        raise Exception('connection lost')
+
+    def discard(self, file_names):
+        pass
+
+
+class FlakyTracker(ImportTracker):
+    """ImportTracker whose first write fails, recording later ones."""
+
+    def __init__(self):
+        super(FlakyTracker, self).__init__(
+            FakeDbConnection(), 'media', 'fyi', max_pending=float('inf'),
+            max_age=float('inf'))
+        self.writes = []
+
+    def _write(self, pending):
+        if not self.writes:
+            self.writes.append(None)
+            raise Exception('connection lost')
+        self.writes.append(
+            sorted((p.file_name, p.status) for p in pending.itervalues()))
+        return []
+
+
+class WriteStatusTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.ingest = PipelinedIngest(
+            FakeDbConnection(), None, 'target', 'staging', ['id'], ['id'],
+            'media', 'fyi')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_failed_flush_fails_batch(self):
+        batch = IngestBatch('prefix', [('a.csv', '2020-01-01')])
+        self.ingest._write_status(
+            FailingTracker(), batch, StageStats('status', 1))
+        self.assertFalse(batch.succeeded)
+        self.assertEqual(batch.failed_stage, 'status')
+
+    def test_earlier_failure_is_kept(self):
+        batch = IngestBatch('prefix', [('a.csv', '2020-01-01')])
+        error = Exception('copy failed')
+        batch.error, batch.failed_stage = error, 'copy'
+        self.ingest._write_status(
+            FailingTracker(), batch, StageStats('status', 1))
+        self.assertIs(batch.error, error)
+        self.assertEqual(batch.failed_stage, 'copy')
+
+    def test_failed_batch_statuses_are_not_written_later(self):
+        tracker = FlakyTracker()
+        failed = IngestBatch('one', [('a.csv', '2020-01-01')])
+        loaded = IngestBatch('two', [('b.csv', '2020-01-01')])
+        for batch in (failed, loaded):
+            self.ingest._write_status(
+                tracker, batch, StageStats('status', 1))
+        tracker.flush()
+        self.assertEqual(failed.failed_stage, 'status')
+        self.assertTrue(loaded.succeeded)
+        self.assertEqual(tracker.writes, [None, [('b.csv', 'SUCCESS')]])
+
+
+class DeadConnection(object):
+    autocommit = True
+    closed = 0
+
+    def commit(self):
+        raise Exception('server closed the connection')
+
+    def rollback(self):
+        self.closed = 2
+        raise Exception('connection already closed')
+
+
+class DeadCursor(object):
+
+    def __init__(self):
+        self.connection = DeadConnection()
+
+    def upsert(self, *args, **kwargs):
+        return 1, 2
+
+
+class UpsertTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.ERROR)
+        self.ingest = PipelinedIngest(
+            FakeDbConnection(), None, 'target', 'staging', ['id'], ['id'],
+            'media', 'fyi')
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def test_failed_rollback_still_fails_the_batch(self):
+        batch = IngestBatch('prefix', [('a.csv', '2020-01-01')])
+        batch.staging_table = 'staging_p0'
+        self.ingest._upsert(DeadCursor(), batch, StageStats('upsert', 1))
+        self.assertEqual(batch.failed_stage, 'upsert')
+        self.assertEqual(str(batch.error), 'server closed the connection')
+
+
+if __name__ == '__main__':
+    unittest.main()
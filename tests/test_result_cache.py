@@ -0,0 +1,72 @@
+import unittest
+
+from instrumentation import StatementEvent
+from result_cache import ResultCache
+
+
+class FakeConnection(object):
+
+    def __init__(self, autocommit):
+        self.autocommit = autocommit
+
+
+class ResultCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cache = ResultCache()
+
+    def run_event(self, kind, connection, sql=None, table=None):
+        event = StatementEvent(kind, sql, table=table)
+        event.sql = sql
+        event.connection = connection
+        self.cache.after(event)
+
+    def cache_read(self, table):
+        statement = 'SELECT * FROM {}'.format(table)
+        self.assertTrue(self.cache.put(
+            statement, statement, [(1,)], self.cache.generation))
+        return statement
+
+    def test_write_drops_entries(self):
+        key = self.cache_read('imports')
+        self.run_event(
+            'execute', FakeConnection(True), 'UPDATE imports SET x = 1')
+        self.assertIsNone(self.cache.get(key))
+
+    def test_commit_drops_entries_read_during_transaction(self):
+        conn = FakeConnection(False)
+        self.run_event('execute', conn, 'UPDATE imports SET x = 1')
+        # Another connection still sees the old rows until the commit.
+        key = self.cache_read('imports')
+        other = self.cache_read('other')
+        self.run_event('commit', conn)
+        self.assertIsNone(self.cache.get(key))
+        self.assertIsNotNone(self.cache.get(other))
+
+    def test_read_before_commit_is_not_cached_after(self):
+        conn = FakeConnection(False)
+        self.run_event('upsert', conn, table='imports')
+        generation = self.cache.generation
+        self.run_event('commit', conn)
+        self.assertFalse(self.cache.put(
+            'SELECT * FROM imports', 'SELECT * FROM imports', [],
+            generation))
+
+    def test_commit_of_unknown_write_clears(self):
+        conn = FakeConnection(False)
+        self.run_event('execute', conn, 'DELETE FROM %s')
+        key = self.cache_read('imports')
+        self.run_event('commit', conn)
+        self.assertEqual(len(self.cache), 0)
+        self.assertIsNone(self.cache.get(key))
+
+    def test_autocommit_writes_are_not_tracked(self):
+        conn = FakeConnection(True)
+        self.run_event('execute', conn, 'UPDATE imports SET x = 1')
+        key = self.cache_read('imports')
+        self.run_event('commit', conn)
+        self.assertIsNotNone(self.cache.get(key))
+
+
+if __name__ == '__main__':
+    unittest.main()
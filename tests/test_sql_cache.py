@@ -0,0 +1,126 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import sql_cache
+from sql_cache import split_statements
+
+
+class SplitStatementsTest(unittest.TestCase):
+
+    def test_splits_on_semicolons(self):
+        self.assertEqual(
+            split_statements('SELECT 1; SELECT 2;\nSELECT 3'),
+            ['SELECT 1', 'SELECT 2', 'SELECT 3'])
+
+    def test_ignores_semicolons_in_quotes(self):
+        sql = "SELECT 'a;b', 'it''s;'; SELECT \"odd;name\" FROM t"
+        self.assertEqual(
+            split_statements(sql),
+            ["SELECT 'a;b', 'it''s;'", 'SELECT "odd;name" FROM t'])
+
+    def test_ignores_semicolons_in_dollar_quotes(self):
+        sql = (
+            'CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ '
+            'LANGUAGE sql;\n'
+            'DO $body$ BEGIN PERFORM 1; END $body$;\n'
+            'SELECT $1')
+        self.assertEqual(split_statements(sql), [
+            'CREATE FUNCTION f() RETURNS int AS $$ SELECT 1; $$ '
+            'LANGUAGE sql',
+            'DO $body$ BEGIN PERFORM 1; END $body$',
+            'SELECT $1',
+        ])
+
+    def test_ignores_semicolons_in_comments(self):
+        sql = (
+            'SELECT 1 -- trailing; comment\n;'
+            '/* block; comment */ SELECT 2;')
+        self.assertEqual(
+            split_statements(sql),
+            ['SELECT 1 -- trailing; comment',
+             '/* block; comment */ SELECT 2'])
+
+    def test_drops_comment_only_statements(self):
+        self.assertEqual(
+            split_statements('-- header\n;\n  ;SELECT 1;\n-- footer\n'),
+            ['SELECT 1'])
+
+    def test_keeps_escaped_percents(self):
+        self.assertEqual(
+            split_statements("SELECT '%%'; SELECT %(x)s"),
+            ["SELECT '%%'", 'SELECT %(x)s'])
+
+    def test_unterminated_quote_runs_to_end(self):
+        self.assertEqual(
+            split_statements("SELECT 'a; SELECT 2"),
+            ["SELECT 'a; SELECT 2"])
+
+
+class FirstKeywordTest(unittest.TestCase):
+
+    def test_skips_leading_comments(self):
+        self.assertEqual(
+            sql_cache.first_keyword('-- a\n/* b\n c */ commit'), 'COMMIT')
+        self.assertEqual(sql_cache.first_keyword('  end;'), 'END')
+        self.assertEqual(sql_cache.first_keyword('-- only'), '')
+
+
+class SqlFileCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, 'query.sql')
+        self.write('SELECT %(a)s;\n    SELECT %(b)s, %%')
+        self.cache = sql_cache.SqlFileCache()
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def write(self, text, path=None):
+        with open(path or self.path, 'w') as out_f:
+            out_f.write(text)
+
+    def test_compiles_statements_and_params(self):
+        compiled = self.cache.get(self.path)
+        self.assertEqual(
+            compiled.statements, ['SELECT %(a)s', 'SELECT %(b)s, %%'])
+        self.assertEqual(compiled.param_names, frozenset(['a', 'b']))
+        self.assertIs(self.cache.get(self.path), compiled)
+
+    def test_check_params(self):
+        compiled = self.cache.get(self.path)
+        compiled.check_params({'a': 1, 'b': 2})
+        compiled.check_params(None)
+        with self.assertRaises(KeyError):
+            compiled.check_params({'a': 1})
+
+    def test_recompiles_changed_file(self):
+        self.cache.get(self.path)
+        self.write('SELECT 3; SELECT 4; SELECT 5')
+        stat = os.stat(self.path)
+        os.utime(self.path, (stat.st_atime, stat.st_mtime + 10))
+        self.assertEqual(len(self.cache.get(self.path).statements), 3)
+
+    def test_follows_repointed_symlink(self):
+        # Same size and mtime, so only the link target tells them apart.
+        releases = [os.path.join(self.dir, name) for name in ('r1', 'r2')]
+        for release, table in zip(releases, ('one', 'two')):
+            os.mkdir(release)
+            self.write('SELECT * FROM ' + table,
+                       os.path.join(release, 'query.sql'))
+            os.utime(os.path.join(release, 'query.sql'), (0, 0))
+        current = os.path.join(self.dir, 'current')
+        os.symlink(releases[0], current)
+        path = os.path.join(current, 'query.sql')
+        self.assertEqual(
+            self.cache.get(path).statements, ['SELECT * FROM one'])
+        os.remove(current)
+        os.symlink(releases[1], current)
+        self.assertEqual(
+            self.cache.get(path).statements, ['SELECT * FROM two'])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,120 @@
+import logging
+import threading
+import unittest
+
+import sql_dag
+from sql_dag import SqlDag
+from sql_dag import SqlDagError
+
+
+class FakeDb(object):
+    """DbConnection recording the sql files run, failing those in fail."""
+
+    def __init__(self, pooled=False, fail=()):
+        self.pooled = pooled
+        self.fail = set(fail)
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def is_pooled(self):
+        return self.pooled
+
+    def execute_sql_files(self, file_paths, params=None):
+        self._run('files', file_paths, params)
+
+    def execute_sql_file(self, file_path, params=None):
+        self._run('file', [file_path], params)
+
+    def _run(self, kind, file_paths, params):
+        with self._lock:
+            self.calls.append((kind, list(file_paths), params))
+        for file_path in file_paths:
+            if file_path in self.fail:
+                raise RuntimeError('{} failed'.format(file_path))
+
+
+class SqlDagTest(unittest.TestCase):
+
+    def setUp(self):
+        logging.disable(logging.ERROR)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def files_run(self, db_conn):
+        return [path for _, paths, _ in db_conn.calls for path in paths]
+
+    def test_runs_dependencies_first(self):
+        dag = SqlDag()
+        dag.add_step('report', ['report.sql'], depends_on=['load', 'dims'])
+        dag.add_step('load', ['load.sql'])
+        dag.add_step('dims', ['dims.sql'], depends_on=['load'])
+        db_conn = FakeDb()
+        results = dag.run(db_conn)
+        self.assertEqual(
+            self.files_run(db_conn), ['load.sql', 'dims.sql', 'report.sql'])
+        self.assertEqual(
+            [r.status for r in results.itervalues()], [sql_dag.SUCCESS] * 3)
+
+    def test_parallel_run_honors_dependencies(self):
+        dag = SqlDag()
+        dag.add_step('a', ['a.sql'])
+        dag.add_step('b', ['b.sql'])
+        dag.add_step('c', ['c.sql'], depends_on=['a', 'b'])
+        db_conn = FakeDb(pooled=True)
+        dag.run(db_conn, max_workers=3)
+        self.assertEqual(self.files_run(db_conn)[-1], 'c.sql')
+
+    def test_failure_cancels_dependents_only(self):
+        dag = SqlDag()
+        dag.add_step('a', ['a.sql'])
+        dag.add_step('b', ['b.sql'], depends_on=['a'])
+        dag.add_step('c', ['c.sql'], depends_on=['b'])
+        dag.add_step('other', ['other.sql'])
+        db_conn = FakeDb(fail=['a.sql'])
+        with self.assertRaises(SqlDagError) as ctx:
+            dag.run(db_conn)
+        results = ctx.exception.results
+        self.assertEqual(results['a'].status, sql_dag.FAIL)
+        self.assertIsInstance(results['a'].error, RuntimeError)
+        self.assertEqual(results['b'].status, sql_dag.CANCELLED)
+        self.assertEqual(results['c'].status, sql_dag.CANCELLED)
+        self.assertEqual(results['other'].status, sql_dag.SUCCESS)
+        self.assertNotIn('b.sql', self.files_run(db_conn))
+
+    def test_detects_cycles(self):
+        dag = SqlDag()
+        dag.add_step('a', ['a.sql'], depends_on=['b'])
+        dag.add_step('b', ['b.sql'], depends_on=['a'])
+        with self.assertRaises(ValueError):
+            dag.validate()
+
+    def test_detects_unknown_dependencies(self):
+        dag = SqlDag()
+        dag.add_step('a', ['a.sql'], depends_on=['missing'])
+        with self.assertRaises(ValueError):
+            dag.run(FakeDb())
+
+    def test_duplicate_step(self):
+        dag = SqlDag()
+        dag.add_step('a', ['a.sql'])
+        with self.assertRaises(ValueError):
+            dag.add_step('a', ['b.sql'])
+
+    def test_transactional_steps_run_files_together(self):
+        dag = SqlDag()
+        dag.add_step('tx', ['1.sql', '2.sql'], params={'x': 1})
+        dag.add_step(
+            'loose', ['3.sql', '4.sql'], depends_on=['tx'],
+            transactional=False)
+        db_conn = FakeDb()
+        dag.run(db_conn)
+        self.assertEqual(db_conn.calls, [
+            ('files', ['1.sql', '2.sql'], {'x': 1}),
+            ('file', ['3.sql'], None),
+            ('file', ['4.sql'], None),
+        ])
+
+
+if __name__ == '__main__':
+    unittest.main()
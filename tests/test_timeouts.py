@@ -0,0 +1,80 @@
+import unittest
+
+import psycopg2.extensions
+
+import timeouts
+from amg_cursor import AmgCursor
+
+
+class FakeConnection(object):
+    statement_timeout = None
+
+    def get_transaction_status(self):
+        return psycopg2.extensions.TRANSACTION_STATUS_IDLE
+
+
+class FakeCursor(object):
+    """Runs AmgCursor.timeout without a database."""
+
+    timeout = AmgCursor.timeout.__func__
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.timeouts = []
+
+    def _set_statement_timeout(self, seconds):
+        self.timeouts.append(seconds)
+
+
+class RecordingWatchdog(object):
+
+    def __init__(self):
+        self.watched = []
+
+    def watch(self, conn, timeout):
+        self.watched.append(timeout)
+        return len(self.watched)
+
+    def unwatch(self, token):
+        pass
+
+
+class CursorTimeoutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.watchdog = timeouts.WATCHDOG
+        timeouts.WATCHDOG = RecordingWatchdog()
+        self.conn = FakeConnection()
+        self.cursor = FakeCursor(self.conn)
+
+    def tearDown(self):
+        timeouts.WATCHDOG = self.watchdog
+
+    def run_with(self, seconds):
+        with self.cursor.timeout(seconds, grace=1):
+            pass
+
+    def test_none_keeps_connection_timeout(self):
+        self.run_with(None)
+        self.assertEqual(self.cursor.timeouts, [])
+        self.assertEqual(timeouts.WATCHDOG.watched, [])
+
+    def test_zero_is_unlimited(self):
+        self.run_with(0)
+        self.assertEqual(self.cursor.timeouts, [])
+        self.assertEqual(timeouts.WATCHDOG.watched, [])
+
+    def test_zero_lifts_connection_timeout(self):
+        self.conn.statement_timeout = 30
+        self.run_with(0)
+        self.assertEqual(self.cursor.timeouts, [0, 30])
+        self.assertEqual(timeouts.WATCHDOG.watched, [])
+
+    def test_timeout_is_set_and_watched(self):
+        self.run_with(5)
+        self.assertEqual(self.cursor.timeouts, [5, 0])
+        self.assertEqual(timeouts.WATCHDOG.watched, [6])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import utils
+
+
+class RelPathTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.dir)
+
+    def run_script(self, name):
+        """Runs a script calling rel_path as __main__, like runpy does."""
+        directory = os.path.join(self.dir, name)
+        os.mkdir(directory)
+        path = os.path.join(directory, 'script.py')
+        module_globals = {'__name__': '__main__', '__file__': path}
+        exec('import utils\nresult = utils.rel_path("sql/a.sql")',
+             module_globals)
+        return module_globals['result']
+
+    def test_scripts_named_main_resolve_their_own_paths(self):
+        first = self.run_script('one')
+        second = self.run_script('two')
+        self.assertEqual(
+            first, os.path.join(os.path.realpath(self.dir), 'one/sql/a.sql'))
+        self.assertEqual(
+            second, os.path.join(os.path.realpath(self.dir), 'two/sql/a.sql'))
+
+    def test_falls_back_to_cwd_without_file(self):
+        module_globals = {'__name__': '__main__'}
+        self.assertEqual(utils.module_dir(module_globals), os.getcwd())
+
+    def test_module_dir(self):
+        self.assertEqual(
+            utils.module_dir(globals()),
+            os.path.dirname(os.path.realpath(__file__)))
+
+
+if __name__ == '__main__':
+    unittest.main()
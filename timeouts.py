@@ -0,0 +1,108 @@
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+import psycopg2
+
+# Seconds the client-side watchdog waits past a statement's timeout before
+# cancelling it, so the server-side statement_timeout normally fires first.
+DEFAULT_GRACE = 1.0
+
+
+class Watchdog(object):
+    """Background thread cancelling statements that overrun a deadline.
+
+    Cancelling goes through `connection.cancel()`, which also reaches
+    statements the server cannot time out itself, e.g. ones stuck waiting
+    in a queue or on a dead network.
+    """
+
+    def __init__(self):
+        self._deadlines = []
+        self._active = {}
+        self._counter = itertools.count()
+        self._cond = threading.Condition()
+        self._thread = None
+
+    def watch(self, conn, timeout):
+        """Cancels conn's running statement in timeout seconds unless
+        unwatch is called first.
+        :return: token for unwatch.
+        """
+        token = next(self._counter)
+        with self._cond:
+            self._active[token] = conn
+            heapq.heappush(self._deadlines, (time.time() + timeout, token))
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name='statement-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+            self._cond.notify()
+        return token
+
+    def unwatch(self, token):
+        """Stops watching. Once this returns, the statement of token will
+        not be cancelled.
+        """
+        with self._cond:
+            self._active.pop(token, None)
+
+    def _run(self):
+        with self._cond:
+            while True:
+                now = time.time()
+                while self._deadlines and (
+                        self._deadlines[0][1] not in self._active):
+                    heapq.heappop(self._deadlines)
+                if not self._deadlines:
+                    self._cond.wait()
+                    continue
+                deadline, token = self._deadlines[0]
+                if deadline > now:
+                    self._cond.wait(deadline - now)
+                    continue
+                heapq.heappop(self._deadlines)
+                conn = self._active.pop(token)
+                # Cancelled under the lock so unwatch can't race with it.
+                logging.warning('Statement overran its timeout, cancelling')
+                try:
+                    conn.cancel()
+                except psycopg2.Error as err:
+                    logging.error('Could not cancel statement: %s', err)
+
+
+# Watchdog shared by every connection of the process.
+WATCHDOG = Watchdog()
+
+
+def backoff_delays(retries, base_delay, max_delay):
+    """Yields retries sleep durations with "full jitter": each is random
+    between 0 and an exponentially growing cap.
+    """
+    for attempt in range(retries):
+        yield random.uniform(0, min(max_delay, base_delay * 2 ** attempt))
+
+
+def retry(fn, retries, base_delay=0.1, max_delay=5.0,
+          retry_on=(psycopg2.OperationalError,)):
+    """Calls fn, retrying with jittered backoff when it raises one of
+    retry_on. Only use for idempotent reads. Statement timeouts and
+    cancellations raise QueryCanceledError, an OperationalError.
+    :param fn: callable taking no arguments.
+    :param retries: extra attempts after the first one.
+    :return: the result of fn.
+    """
+    delays = backoff_delays(retries, base_delay, max_delay)
+    while True:
+        try:
+            return fn()
+        except retry_on as err:
+            delay = next(delays, None)
+            if delay is None:
+                raise
+            logging.warning('Read failed, retrying in %.2fs: %s', delay, err)
+            time.sleep(delay)
@@ -1,20 +1,55 @@
-import inspect
 import os
+import sys
+
+import psycopg2.extensions
+
+# Real directory of each module that called rel_path, keyed by its
+# __file__. Module names can't be used: every script run directly, or
+# through runpy or exec, is __main__.
+_MODULE_DIRS = {}
+# Resolved paths keyed by (module __file__, relative filename).
+_RESOLVED = {}
 
 def rel_path(relative_filename):
     """Returns the full path of the file relative to the caller module.
+    Paths are resolved once per module file and filename, then cached.
     :param relative_filename: target filename relative to the caller's
         containing folder.
     :return: the full path of the target relative file.
     """
-    # Extract the filename of the caller's stack frame.
-    caller_frame = inspect.stack()[1]
-    try:
-        caller_filepath = inspect.getabsfile(caller_frame[0])
-    finally:
-        # Force remove frame reference to prevent garbage-collection issues.
-        del caller_frame
+    # Only the caller's frame is needed, not the whole stack.
+    caller_globals = sys._getframe(1).f_globals
+    module_file = caller_globals.get('__file__')
+    if not module_file:
+        return os.path.join(os.getcwd(), relative_filename)
+    key = (module_file, relative_filename)
+    path = _RESOLVED.get(key)
+    if path is None:
+        path = os.path.join(module_dir(caller_globals), relative_filename)
+        _RESOLVED[key] = path
+    return path
+
+def module_dir(module_globals):
+    """Returns the real directory of the module owning module_globals.
+    Falls back to the working directory for interactive sessions.
+    """
+    module_file = module_globals.get('__file__')
+    if not module_file:
+        return os.getcwd()
+    directory = _MODULE_DIRS.get(module_file)
+    if directory is None:
+        directory = os.path.dirname(os.path.realpath(module_file))
+        _MODULE_DIRS[module_file] = directory
+    return directory
+
+def no_quotes(value):
+    """Wraps value so psycopg2 interpolates it verbatim, without quoting.
+    Only use for trusted identifiers (schemas, tables, columns).
+    """
+    return psycopg2.extensions.AsIs(value)
+
 
-    return os.path.join(
-        os.path.dirname(os.path.realpath(caller_filepath)),
-        relative_filename)
\ No newline at end of file
+def redshift_cred_string(aws_access_key_id, aws_secret_access_key):
+    """Returns the CREDENTIALS string used by Redshift COPY and UNLOAD."""
+    return 'aws_access_key_id={};aws_secret_access_key={}'.format(
+        aws_access_key_id, aws_secret_access_key)